@@ -0,0 +1,148 @@
+"""Benchmark for the transcript analysis engine (the matching done by analyse_transcript).
+
+Reports throughput (items/s), per-call latency percentiles and peak memory for a grid of transcript sizes,
+sentence counts and matching modes, on synthetic Transcribe output. Before timing anything, the results
+for a fixed set of cases are checked against benchmarks/golden/analysis.json, so a faster matcher can't
+quietly change the answers. Runs offline, without AWS.
+
+Usage:
+    python benchmarks/bench_analysis.py [--items 10000 100000 1000000] [--sentences 1 16 256 1024]
+                                        [--max-errors 0 1] [--repeat 7] [--update-golden] [--skip-golden]
+"""
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'layers', 'common', 'python'))
+
+from analysis.transcript_analyzer import TranscriptAnalyzer  # noqa: E402
+from models.analysis_options import AnalysisOptions  # noqa: E402
+from models.sentence import Sentence  # noqa: E402
+from synthetic import generate_sentences, iter_transcript_items  # noqa: E402
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), 'golden', 'analysis.json')
+GOLDEN_CASES = {
+    'exact-10k-16': dict(items=10000, sentences=16, max_errors=0),
+    'exact-10k-256': dict(items=10000, sentences=256, max_errors=0),
+    'exact-10k-256-capped': dict(items=10000, sentences=256, max_errors=0, max_occurrences=3),
+    'exact-10k-64-confidence': dict(items=10000, sentences=64, max_errors=0, min_confidence='0.7'),
+    'fuzzy1-10k-64': dict(items=10000, sentences=64, max_errors=1),
+    'fuzzy2-10k-64-confidence': dict(items=10000, sentences=64, max_errors=2, min_confidence='0.7'),
+}
+
+
+def run_analysis(items: List[dict], texts: List[str], options: AnalysisOptions) -> List[Sentence]:
+    sentences = [Sentence(plain_text=text) for text in texts]
+    TranscriptAnalyzer(sentences, options).analyse(items)
+    return sentences
+
+
+def summarize(sentences: List[Sentence]) -> dict:
+    encoded = json.dumps([sentence.as_dict() for sentence in sentences], sort_keys=True, default=str)
+    return {
+        'sentences_found': sum(1 for sentence in sentences if sentence.was_present),
+        'occurrences': sum(sentence.occurrence_count for sentence in sentences),
+        'digest': hashlib.sha256(encoded.encode()).hexdigest()
+    }
+
+
+def run_golden_case(case: dict) -> dict:
+    items = list(iter_transcript_items(case['items']))
+    texts = generate_sentences(case['sentences'], case['items'])
+    options = AnalysisOptions(
+        max_occurrences=case.get('max_occurrences'),
+        max_errors=case.get('max_errors', 0),
+        min_confidence=case.get('min_confidence')
+    )
+    return summarize(run_analysis(items, texts, options))
+
+
+def check_golden(update: bool) -> bool:
+    results = {name: run_golden_case(case) for name, case in GOLDEN_CASES.items()}
+    if update:
+        os.makedirs(os.path.dirname(GOLDEN_PATH), exist_ok=True)
+        with open(GOLDEN_PATH, 'w') as golden_file:
+            json.dump(results, golden_file, indent=2, sort_keys=True)
+            golden_file.write('\n')
+        print(f'Golden results written to {GOLDEN_PATH}')
+        return True
+
+    with open(GOLDEN_PATH) as golden_file:
+        golden = json.load(golden_file)
+    ok = True
+    for name, result in results.items():
+        if golden.get(name) != result:
+            ok = False
+            print(f'GOLDEN MISMATCH {name}: expected {golden.get(name)}, got {result}')
+    print('Golden results match.' if ok else 'Golden results differ, see above.')
+    return ok
+
+
+def percentile(samples: List[float], pct: int) -> float:
+    if len(samples) < 2:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method='inclusive')[pct - 1]
+
+
+def benchmark(item_count: int, sentence_count: int, max_errors: int, repeat: int) -> dict:
+    items = list(iter_transcript_items(item_count))
+    texts = generate_sentences(sentence_count, item_count)
+    options = AnalysisOptions(max_errors=max_errors)
+
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run_analysis(items, texts, options)
+        latencies.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    run_analysis(items, texts, options)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    median = statistics.median(latencies)
+    return {
+        'items': item_count,
+        'sentences': sentence_count,
+        'mode': f'fuzzy{max_errors}' if max_errors else 'exact',
+        'items_per_s': item_count / median,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_mb': peak / 1024 / 1024
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--sentences', type=int, nargs='+', default=[1, 16, 256, 1024])
+    parser.add_argument('--max-errors', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--update-golden', action='store_true', help='Record the current results as golden.')
+    parser.add_argument('--skip-golden', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_golden and not check_golden(args.update_golden):
+        return 1
+
+    print(f'{"items":>8} {"sentences":>9} {"mode":>7} {"items/s":>10} {"p50 ms":>9} {"p95 ms":>9} '
+          f'{"p99 ms":>9} {"peak MB":>8}')
+    for item_count in args.items:
+        for sentence_count in args.sentences:
+            for max_errors in args.max_errors:
+                result = benchmark(item_count, sentence_count, max_errors, args.repeat)
+                print(f'{result["items"]:>8} {result["sentences"]:>9} {result["mode"]:>7} '
+                      f'{result["items_per_s"]:>10.0f} {result["p50_ms"]:>9.1f} {result["p95_ms"]:>9.1f} '
+                      f'{result["p99_ms"]:>9.1f} {result["peak_mb"]:>8.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
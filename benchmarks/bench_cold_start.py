@@ -0,0 +1,111 @@
+"""Cold start benchmark of the lambda handlers.
+
+Every sample runs in a fresh python process, like a new lambda container, and reports for each function:
+- import: importing the handler module (boto3, powertools, the common layer);
+- first: building the helper and the clients the function uses, the setup of a cold invocation;
+- warm: doing it again in the same process, what every warm invocation pays with the shared ClientProvider;
+- unshared: creating the same clients straight from boto3, what every invocation paid before ClientProvider.
+
+No request is sent (dummy credentials and region), so it only needs boto3 and aws_lambda_powertools installed.
+
+Usage: python benchmarks/bench_cold_start.py [--samples 10] [--functions transcripts_api process_audio ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+COMMON_LAYER = os.path.join(ROOT, 'src', 'layers', 'common', 'python')
+
+# function -> (expression building its helper, the (kind, service) clients it uses)
+FUNCTIONS = {
+    'transcripts_api': (
+        'analysis_helper.AnalysisHelper()',
+        [('resource', 'dynamodb'), ('client', 'sqs'), ('client', 's3')]
+    ),
+    'process_audio': (
+        "audio_processing_helper.AudioProcessingHelper('bench_table', 'bench_bucket')",
+        [('resource', 'dynamodb'), ('client', 's3'), ('client', 'transcribe')]
+    ),
+    'analyse_transcript': (
+        'analyse_transcript_helper.AnalyseTrascriptHelper()',
+        [('resource', 'dynamodb'), ('client', 's3')]
+    ),
+}
+
+SAMPLE = '''
+import json, sys, time
+started = time.perf_counter()
+import lambda_handler
+imported = time.perf_counter()
+
+import boto3
+import {helper_module}
+from services.providers.client_provider import ClientProvider
+
+def setup():
+    {helper_expression}
+    for kind, service in {services!r}:
+        ClientProvider.get_resource(service) if kind == 'resource' else ClientProvider.get_client(service)
+
+setup()
+first = time.perf_counter()
+setup()
+warm = time.perf_counter()
+for kind, service in {services!r}:
+    boto3.resource(service) if kind == 'resource' else boto3.client(service)
+unshared = time.perf_counter()
+
+print(json.dumps({{
+    'import': imported - started, 'first': first - imported, 'warm': warm - first, 'unshared': unshared - warm
+}}))
+'''
+
+
+def run_sample(function: str) -> dict:
+    helper_expression, services = FUNCTIONS[function]
+    code = SAMPLE.format(
+        helper_module=helper_expression.split('.')[0],
+        helper_expression=helper_expression,
+        services=services
+    )
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([os.path.join(ROOT, 'src', 'functions', function), COMMON_LAYER]),
+        AWS_DEFAULT_REGION='us-east-1',
+        AWS_ACCESS_KEY_ID='bench',
+        AWS_SECRET_ACCESS_KEY='bench',
+        TRANSCRIPTS_TABLE='bench_table',
+        TRANSCRIPTS_BUCKET='bench_bucket',
+        POWERTOOLS_SERVICE_NAME=function
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', code],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--functions', nargs='+', default=list(FUNCTIONS), choices=list(FUNCTIONS))
+    args = parser.parse_args()
+
+    print(f'{"function":>20} {"import ms":>10} {"first ms":>9} {"warm ms":>8} {"unshared ms":>12}')
+    for function in args.functions:
+        samples = [run_sample(function) for _ in range(args.samples)]
+        median = {key: statistics.median(sample[key] for sample in samples) * 1000 for key in samples[0]}
+        print(f'{function:>20} {median["import"]:>10.1f} {median["first"]:>9.1f} {median["warm"]:>8.2f} '
+              f'{median["unshared"]:>12.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
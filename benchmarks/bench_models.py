@@ -0,0 +1,91 @@
+"""Microbenchmark of the Transcript model (de)serialization done on every api call and pipeline stage.
+
+Compares, for analysed transcripts of growing sizes:
+- dict: the plain encoding (Transcript(**as_dict()) / as_dict()), what was stored in dynamo before;
+- item: the compact dynamo encoding (Transcript.from_item / as_item);
+- status: from_item without decoding the sentences, for callers that only need the status.
+Sizes are the json length of the encoded record, close to what dynamo bills for. Runs offline.
+
+Usage: python benchmarks/bench_models.py [--sentences 16 256 1024] [--occurrences 10] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'layers', 'common', 'python'))
+
+from models.sentence import Sentence, SentenceOccurrence  # noqa: E402
+from models.transcript import FileType, Transcript, TranscriptStatus  # noqa: E402
+
+
+def build_transcript(sentence_count: int, occurrence_count: int) -> Transcript:
+    sentences = []
+    for sentence_idx in range(sentence_count):
+        sentence = Sentence(plain_text=f'synthetic sentence number {sentence_idx}')
+        # Half of the sentences are found, the rest stay empty like in real requests.
+        for occurrence_idx in range(occurrence_count if sentence_idx % 2 else 0):
+            start = occurrence_idx * 40 + sentence_idx
+            sentence.add_occurrence(SentenceOccurrence(
+                start_word_index=start,
+                end_word_index=start + 4,
+                start_time=Decimal(f'{start * 0.4:.3f}'),
+                end_time=Decimal(f'{start * 0.4 + 1.6:.3f}')
+            ))
+        sentences.append(sentence)
+    return Transcript(
+        request_id=uuid.uuid4(),
+        audio_url='https://example.com/calls/synthetic.wav',
+        created=datetime.now(),
+        updated=datetime.now(),
+        file_type=FileType.WAV,
+        sentences=sentences,
+        status=TranscriptStatus.COMPLETED,
+        transcript_path='transcripts/synthetic/transcript.json'
+    )
+
+
+def median_us(function: Callable, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1e6
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sentences', type=int, nargs='+', default=[16, 256, 1024])
+    parser.add_argument('--occurrences', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'{"sentences":>9} {"format":>7} {"load us":>9} {"dump us":>9} {"size KB":>8}')
+    for sentence_count in args.sentences:
+        transcript = build_transcript(sentence_count, args.occurrences)
+        plain = transcript.as_dict()
+        item = transcript.as_item()
+        assert Transcript.from_item(item).as_dict() == plain, 'compact encoding does not round trip'
+
+        rows = [
+            ('dict', lambda: Transcript(**plain), transcript.as_dict, plain),
+            ('item', lambda: Transcript.from_item(item), transcript.as_item, item),
+            ('status', lambda: Transcript.from_item(item, load_sentences=False), None, item),
+        ]
+        for name, load, dump, encoded in rows:
+            load_us = median_us(load, args.repeat)
+            dump_us = median_us(dump, args.repeat) if dump else float('nan')
+            size_kb = len(json.dumps(encoded, default=str)) / 1024
+            print(f'{sentence_count:>9} {name:>7} {load_us:>9.0f} {dump_us:>9.0f} {size_kb:>8.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
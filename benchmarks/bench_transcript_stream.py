@@ -0,0 +1,51 @@
+"""Compares peak memory and time of loading the transcript items the old way (read the whole s3 body,
+decode it and json.loads it) and with the streaming reader used by analyse_transcript.
+
+Runs offline: the s3 body is replaced by a stream that generates the transcript json on the fly, so
+the only copies of the document that get counted are the ones the reader itself makes.
+
+Usage: python benchmarks/bench_transcript_stream.py [size_mb ...]
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'layers', 'common', 'python'))
+
+from services.json_stream import iter_json_array  # noqa: E402
+from synthetic import SyntheticTranscriptBody  # noqa: E402
+
+
+def load_items_full(body) -> int:
+    """The previous S3Service.read_json_file path."""
+    data = json.loads(body.read().decode('utf-8'))
+    return sum(1 for _ in data.get('results', {}).get('items', []))
+
+
+def load_items_streaming(body) -> int:
+    return sum(1 for _ in iter_json_array(body, ('results', 'items')))
+
+
+def measure(loader, size_bytes: int) -> tuple:
+    body = SyntheticTranscriptBody(size_bytes)
+    tracemalloc.start()
+    started = time.perf_counter()
+    items = loader(body)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return items, elapsed, peak
+
+
+def main(sizes_mb: list) -> None:
+    print(f'{"size":>8} {"reader":>10} {"items":>9} {"seconds":>8} {"peak MB":>8}')
+    for size_mb in sizes_mb:
+        for name, loader in (('full', load_items_full), ('streaming', load_items_streaming)):
+            items, elapsed, peak = measure(loader, int(size_mb * 1024 * 1024))
+            print(f'{size_mb:>6}MB {name:>10} {items:>9} {elapsed:>8.2f} {peak / 1024 / 1024:>8.1f}')
+
+
+if __name__ == '__main__':
+    main([float(arg) for arg in sys.argv[1:]] or [2, 8, 32])
@@ -0,0 +1,765 @@
+"""In-memory stand-ins for the AWS services (and the audio sources) the functions talk to, for local runs.
+
+They implement only the calls and response fields the common layer uses, with the same shapes boto3 returns
+(e.g. numbers come back from dynamo as Decimal and floats are refused), and are thread safe. Install them with
+ClientProvider.set_client/set_resource/set_http; nothing here needs AWS or network access.
+"""
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+
+class ClientError(Exception):
+    """Same shape as botocore's ClientError: the error code is in response['Error']['Code'].
+    """
+
+    def __init__(self, code: str, operation_name: str, message: str = ''):
+        super().__init__(f'An error occurred ({code}) when calling the {operation_name} operation: {message}')
+        self.response = {'Error': {'Code': code, 'Message': message}}
+        self.operation_name = operation_name
+
+
+class NoSuchKey(ClientError):
+    def __init__(self, operation_name: str, key: str):
+        super().__init__('NoSuchKey', operation_name, f'The specified key does not exist: {key}')
+
+
+class ConditionalCheckFailedException(ClientError):
+    def __init__(self, operation_name: str):
+        super().__init__('ConditionalCheckFailedException', operation_name, 'The conditional request failed')
+
+
+class ConflictException(ClientError):
+    def __init__(self, operation_name: str, message: str):
+        super().__init__('ConflictException', operation_name, message)
+
+
+class LimitExceededException(ClientError):
+    def __init__(self, operation_name: str, message: str):
+        super().__init__('LimitExceededException', operation_name, message)
+
+
+EXCEPTIONS = SimpleNamespace(
+    ClientError=ClientError,
+    NoSuchKey=NoSuchKey,
+    ConditionalCheckFailedException=ConditionalCheckFailedException,
+    ConflictException=ConflictException,
+    LimitExceededException=LimitExceededException
+)
+
+
+class _Paginator(object):
+
+    def __init__(self, method: Callable[..., dict]):
+        self._method = method
+
+    def paginate(self, **kwargs):
+        # Everything fits in one page locally.
+        yield self._method(**kwargs)
+
+
+def _etag(data: bytes) -> str:
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+class InMemoryS3(object):
+    """S3 client stand-in. on_object_created(bucket, key, size, etag) is called for every object written, like the
+    bucket notifications that trigger analyse_transcript.
+    """
+    exceptions = EXCEPTIONS
+
+    def __init__(self, on_object_created: Callable[[str, str, int, str], None] = None):
+        self.on_object_created = on_object_created
+        self._objects: Dict[tuple, dict] = {}
+        self._uploads: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _put(self, bucket: str, key: str, data: bytes, **metadata) -> dict:
+        obj = {
+            'Body': data,
+            'ETag': _etag(data),
+            'LastModified': datetime.now(timezone.utc),
+            **{name: value for name, value in metadata.items() if value is not None}
+        }
+        with self._lock:
+            self._objects[(bucket, key)] = obj
+        if self.on_object_created:
+            self.on_object_created(bucket, key, len(data), obj['ETag'])
+        return {'ETag': obj['ETag']}
+
+    def _get(self, bucket: str, key: str, operation_name: str) -> dict:
+        with self._lock:
+            obj = self._objects.get((bucket, key))
+        if obj is None:
+            raise NoSuchKey(operation_name, key)
+        return obj
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, ContentType: str = None, ContentEncoding: str = None,
+                   **_) -> dict:
+        data = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        return self._put(Bucket, Key, data, ContentType=ContentType, ContentEncoding=ContentEncoding)
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, **_) -> None:
+        self._put(Bucket, Key, Fileobj.read())
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None, **_) -> dict:
+        obj = self._get(Bucket, Key, 'GetObject')
+        response = {name: value for name, value in obj.items() if name != 'Body'}
+        data = obj['Body']
+        if Range:
+            start, end = (int(bound) for bound in Range[len('bytes='):].split('-'))
+            data = data[start:end + 1]
+            response['ContentRange'] = f'bytes {start}-{start + len(data) - 1}/{len(obj["Body"])}'
+        response['Body'] = io.BytesIO(data)
+        response['ContentLength'] = len(data)
+        return response
+
+    def head_object(self, Bucket: str, Key: str, **_) -> dict:
+        try:
+            obj = self._get(Bucket, Key, 'HeadObject')
+        except NoSuchKey:
+            # HEAD responses have no body, boto3 only gets the status code.
+            raise ClientError('404', 'HeadObject', 'Not Found')
+        response = {name: value for name, value in obj.items() if name != 'Body'}
+        response['ContentLength'] = len(obj['Body'])
+        return response
+
+    def copy_object(self, Bucket: str, Key: str, CopySource: dict, **_) -> dict:
+        obj = self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        metadata = {name: obj.get(name) for name in ('ContentType', 'ContentEncoding')}
+        return {'CopyObjectResult': self._put(Bucket, Key, obj['Body'], **metadata)}
+
+    def delete_objects(self, Bucket: str, Delete: dict, **_) -> dict:
+        with self._lock:
+            for obj in Delete['Objects']:
+                self._objects.pop((Bucket, obj['Key']), None)
+        return {'Errors': []}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', **_) -> dict:
+        with self._lock:
+            keys = sorted(
+                (key, len(obj['Body'])) for (bucket, key), obj in self._objects.items()
+                if bucket == Bucket and key.startswith(Prefix)
+            )
+        return {'Contents': [{'Key': key, 'Size': size} for key, size in keys], 'KeyCount': len(keys)}
+
+    def generate_presigned_url(self, ClientMethod: str, Params: dict, ExpiresIn: int = 3600) -> str:
+        return f'http://s3.local/{Params["Bucket"]}/{Params["Key"]}?X-Amz-Expires={ExpiresIn}'
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **_) -> dict:
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {
+                'Bucket': Bucket, 'Key': Key, 'Initiated': datetime.now(timezone.utc), 'Parts': {}
+            }
+        return {'UploadId': upload_id}
+
+    def _get_upload(self, upload_id: str, operation_name: str) -> dict:
+        upload = self._uploads.get(upload_id)
+        if upload is None:
+            raise ClientError('NoSuchUpload', operation_name, upload_id)
+        return upload
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes, **_) -> dict:
+        data = bytes(Body)
+        with self._lock:
+            self._get_upload(UploadId, 'UploadPart')['Parts'][PartNumber] = data
+        return {'ETag': _etag(data)}
+
+    def list_multipart_uploads(self, Bucket: str, Prefix: str = '', **_) -> dict:
+        with self._lock:
+            uploads = [
+                {'Key': upload['Key'], 'UploadId': upload_id, 'Initiated': upload['Initiated']}
+                for upload_id, upload in self._uploads.items()
+                if upload['Bucket'] == Bucket and upload['Key'].startswith(Prefix)
+            ]
+        return {'Uploads': uploads}
+
+    def list_parts(self, Bucket: str, Key: str, UploadId: str, **_) -> dict:
+        with self._lock:
+            parts = sorted(self._get_upload(UploadId, 'ListParts')['Parts'].items())
+        return {'Parts': [{'PartNumber': number, 'Size': len(data), 'ETag': _etag(data)} for number, data in parts]}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict, **_) -> dict:
+        with self._lock:
+            upload = self._get_upload(UploadId, 'CompleteMultipartUpload')
+            parts = [upload['Parts'][part['PartNumber']] for part in MultipartUpload['Parts']]
+            del self._uploads[UploadId]
+        return self._put(Bucket, Key, b''.join(parts))
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **_) -> dict:
+        with self._lock:
+            self._uploads.pop(UploadId, None)
+        return {}
+
+    def get_paginator(self, operation_name: str) -> _Paginator:
+        return _Paginator({'list_objects_v2': self.list_objects_v2, 'list_parts': self.list_parts}[operation_name])
+
+    def read_json(self, bucket: str, key: str) -> dict:
+        """Reads a json object back, for checks (not part of the boto3 api).
+        """
+        obj = self._get(bucket, key, 'GetObject')
+        data = gzip.decompress(obj['Body']) if obj.get('ContentEncoding') == 'gzip' else obj['Body']
+        return json.loads(data)
+
+
+class InMemorySQS(object):
+    """SQS client stand-in with visibility timeouts and receive counts, so an event source mapping can be
+    emulated on top of receive_message/delete_message. on_message_sent(queue_url, body) is called on every send.
+    """
+    exceptions = EXCEPTIONS
+
+    def __init__(self, visibility_timeout: float = 30.0, on_message_sent: Callable[[str, str], None] = None):
+        self.visibility_timeout = visibility_timeout
+        self.on_message_sent = on_message_sent
+        self._queues: Dict[str, Dict[str, dict]] = {}
+        self._condition = threading.Condition()
+
+    def _send(self, queue_url: str, body: str, delay: float = 0) -> str:
+        message_id = str(uuid.uuid4())
+        with self._condition:
+            self._queues.setdefault(queue_url, {})[message_id] = {
+                'MessageId': message_id,
+                'Body': body,
+                'SentTimestamp': time.time(),
+                'VisibleAt': time.monotonic() + delay,
+                'ReceiveCount': 0,
+                'ReceiptHandle': None
+            }
+            self._condition.notify_all()
+        if self.on_message_sent:
+            self.on_message_sent(queue_url, body)
+        return message_id
+
+    def send_message(self, QueueUrl: str, MessageBody: str, DelaySeconds: int = 0, **_) -> dict:
+        return {'MessageId': self._send(QueueUrl, MessageBody, DelaySeconds)}
+
+    def send_message_batch(self, QueueUrl: str, Entries: List[dict], **_) -> dict:
+        return {
+            'Successful': [
+                {
+                    'Id': entry['Id'],
+                    'MessageId': self._send(QueueUrl, entry['MessageBody'], entry.get('DelaySeconds', 0))
+                }
+                for entry in Entries
+            ],
+            'Failed': []
+        }
+
+    def receive_message(self, QueueUrl: str, MaxNumberOfMessages: int = 1, WaitTimeSeconds: float = 0,
+                        VisibilityTimeout: float = None, **_) -> dict:
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                visible = [
+                    message for message in self._queues.get(QueueUrl, {}).values() if message['VisibleAt'] <= now
+                ][:MaxNumberOfMessages]
+                if visible or now >= deadline:
+                    break
+                self._condition.wait(min(deadline - now, 0.05))
+            timeout = self.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+            messages = []
+            for message in visible:
+                message['VisibleAt'] = now + timeout
+                message['ReceiveCount'] += 1
+                message['ReceiptHandle'] = f'{message["MessageId"]}:{message["ReceiveCount"]}'
+                messages.append({
+                    'MessageId': message['MessageId'],
+                    'ReceiptHandle': message['ReceiptHandle'],
+                    'Body': message['Body'],
+                    'Attributes': {
+                        'ApproximateReceiveCount': str(message['ReceiveCount']),
+                        'SentTimestamp': str(int(message['SentTimestamp'] * 1000)),
+                        'ApproximateFirstReceiveTimestamp': str(int(time.time() * 1000))
+                    }
+                })
+        return {'Messages': messages} if messages else {}
+
+    def _find(self, queue_url: str, receipt_handle: str, operation_name: str) -> dict:
+        message_id = receipt_handle.split(':', 1)[0]
+        message = self._queues.get(queue_url, {}).get(message_id)
+        if message is None or message['ReceiptHandle'] != receipt_handle:
+            raise ClientError('ReceiptHandleIsInvalid', operation_name, receipt_handle)
+        return message
+
+    def delete_message(self, QueueUrl: str, ReceiptHandle: str, **_) -> dict:
+        with self._condition:
+            message = self._find(QueueUrl, ReceiptHandle, 'DeleteMessage')
+            del self._queues[QueueUrl][message['MessageId']]
+        return {}
+
+    def change_message_visibility(self, QueueUrl: str, ReceiptHandle: str, VisibilityTimeout: float, **_) -> dict:
+        with self._condition:
+            self._find(QueueUrl, ReceiptHandle, 'ChangeMessageVisibility')['VisibleAt'] = (
+                time.monotonic() + VisibilityTimeout
+            )
+            self._condition.notify_all()
+        return {}
+
+    def pending_count(self, queue_url: str) -> int:
+        """How many messages the queue holds, visible or not (not part of the boto3 api).
+        """
+        with self._condition:
+            return len(self._queues.get(queue_url, {}))
+
+
+def _to_dynamo(value):
+    """Converts a python value like boto3's TypeSerializer accepts it: ints become Decimal, floats are refused.
+    """
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, Decimal)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, dict):
+        return {key: _to_dynamo(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_dynamo(item) for item in value]
+    if isinstance(value, set):
+        return {_to_dynamo(item) for item in value}
+    raise TypeError(f'Unsupported type "{type(value)}" for value "{value}"')
+
+
+_EXPRESSION_TOKEN = re.compile(r'\s*(<>|<=|>=|[=<>(),+-]|[#:]?[A-Za-z_][A-Za-z0-9_]*)')
+
+
+class _Expression(object):
+    """Evaluates the subset of dynamo expressions the services use, on a single item.
+
+    Conditions: attribute_exists/attribute_not_exists, contains, comparisons, AND, OR, NOT and parentheses.
+    Updates: SET with if_not_exists and +/-, REMOVE and ADD (numbers and sets) clauses, top level attributes only.
+    """
+
+    def __init__(self, expression: str, names: dict = None, values: dict = None):
+        self.tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = _EXPRESSION_TOKEN.match(expression, position)
+            if not match:
+                raise ClientError('ValidationException', 'Expression', f'Invalid expression: {expression}')
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.position = 0
+        self.names = names or {}
+        self.values = {key: _to_dynamo(value) for key, value in (values or {}).items()}
+
+    def _peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self, expected: str = None) -> str:
+        token = self._peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise ClientError('ValidationException', 'Expression', f'Expected {expected}, got {token}')
+        self.position += 1
+        return token
+
+    def _name(self, token: str) -> str:
+        return self.names[token] if token.startswith('#') else token
+
+    def _operand(self, item: dict):
+        token = self._next()
+        if token.startswith(':'):
+            return self.values[token]
+        if token == 'if_not_exists':
+            self._next('(')
+            name = self._name(self._next())
+            self._next(',')
+            default = self._operand(item)
+            self._next(')')
+            return item.get(name, default)
+        return item.get(self._name(token))
+
+    def _value(self, item: dict):
+        value = self._operand(item)
+        while self._peek() in ('+', '-'):
+            operator = self._next()
+            other = self._operand(item)
+            value = value + other if operator == '+' else value - other
+        return value
+
+    def _term(self, item: dict) -> bool:
+        token = self._peek()
+        if token and token.upper() == 'NOT':
+            self._next()
+            return not self._term(item)
+        if token == '(':
+            self._next()
+            result = self._or(item)
+            self._next(')')
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            self._next()
+            self._next('(')
+            exists = self._name(self._next()) in item
+            self._next(')')
+            return exists if token == 'attribute_exists' else not exists
+        if token == 'contains':
+            self._next()
+            self._next('(')
+            container = self._operand(item)
+            self._next(',')
+            operand = self._operand(item)
+            self._next(')')
+            return container is not None and operand in container
+        left = self._value(item)
+        operator = self._next()
+        right = self._value(item)
+        if left is None or right is None:
+            return operator == '<>' and left != right
+        return {
+            '=': left == right, '<>': left != right, '<': left < right,
+            '<=': left <= right, '>': left > right, '>=': left >= right
+        }[operator]
+
+    def _and(self, item: dict) -> bool:
+        result = self._term(item)
+        while self._peek() and self._peek().upper() == 'AND':
+            self._next()
+            result = self._term(item) and result
+        return result
+
+    def _or(self, item: dict) -> bool:
+        result = self._and(item)
+        while self._peek() and self._peek().upper() == 'OR':
+            self._next()
+            result = self._and(item) or result
+        return result
+
+    def matches(self, item: dict) -> bool:
+        result = self._or(item)
+        if self._peek() is not None:
+            raise ClientError('ValidationException', 'Expression', f'Unexpected {self._peek()}')
+        return result
+
+    def apply(self, item: dict) -> List[str]:
+        """Applies the update to the item, returns the names of the updated attributes.
+        """
+        current = dict(item)
+        updated = []
+        while self._peek() is not None:
+            action = self._next().upper()
+            while True:
+                name = self._name(self._next())
+                if action == 'SET':
+                    self._next('=')
+                    item[name] = self._value(current)
+                elif action == 'ADD':
+                    operand = self._operand(current)
+                    if isinstance(operand, set):
+                        item[name] = current.get(name, set()) | operand
+                    else:
+                        item[name] = current.get(name, Decimal(0)) + operand
+                elif action == 'REMOVE':
+                    item.pop(name, None)
+                else:
+                    raise ClientError('ValidationException', 'UpdateItem', f'Unsupported action {action}')
+                updated.append(name)
+                if self._peek() != ',':
+                    break
+                self._next()
+        return updated
+
+
+class _Table(object):
+
+    def __init__(self, resource: 'InMemoryDynamoDB', name: str):
+        self.resource = resource
+        self.name = name
+        self.table_name = name
+        self.meta = SimpleNamespace(client=SimpleNamespace(exceptions=EXCEPTIONS))
+
+    def _check(self, item: dict, condition: str, names: dict, values: dict, operation_name: str) -> None:
+        if condition and not _Expression(condition, names, values).matches(item):
+            raise ConditionalCheckFailedException(operation_name)
+
+    def put_item(self, Item: dict, ConditionExpression: str = None, ExpressionAttributeNames: dict = None,
+                 ExpressionAttributeValues: dict = None, **_) -> dict:
+        item = _to_dynamo(Item)
+        key = self.resource.key_of(self.name, item)
+        with self.resource.lock:
+            items = self.resource.items(self.name)
+            self._check(items.get(key, {}), ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                        'PutItem')
+            items[key] = item
+        return {}
+
+    def get_item(self, Key: dict, ProjectionExpression: str = None, ExpressionAttributeNames: dict = None,
+                 **_) -> dict:
+        with self.resource.lock:
+            item = self.resource.items(self.name).get(self.resource.key_of(self.name, _to_dynamo(Key)))
+            item = deepcopy(item)
+        if item is None:
+            return {}
+        if ProjectionExpression:
+            names = ExpressionAttributeNames or {}
+            attributes = [names.get(name.strip(), name.strip()) for name in ProjectionExpression.split(',')]
+            item = {name: item[name] for name in attributes if name in item}
+        return {'Item': item}
+
+    def update_item(self, Key: dict, UpdateExpression: str, ConditionExpression: str = None,
+                    ExpressionAttributeNames: dict = None, ExpressionAttributeValues: dict = None,
+                    ReturnValues: str = 'NONE', **_) -> dict:
+        key_item = _to_dynamo(Key)
+        key = self.resource.key_of(self.name, key_item)
+        with self.resource.lock:
+            items = self.resource.items(self.name)
+            old = items.get(key)
+            self._check(old or {}, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                        'UpdateItem')
+            item = deepcopy(old) if old is not None else dict(key_item)
+            updated = _Expression(UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues).apply(item)
+            items[key] = item
+            if ReturnValues == 'ALL_NEW':
+                return {'Attributes': deepcopy(item)}
+            if ReturnValues == 'UPDATED_NEW':
+                return {'Attributes': {name: deepcopy(item[name]) for name in updated if name in item}}
+            if ReturnValues == 'ALL_OLD' and old is not None:
+                return {'Attributes': deepcopy(old)}
+        return {}
+
+    def delete_item(self, Key: dict, ConditionExpression: str = None, ExpressionAttributeNames: dict = None,
+                    ExpressionAttributeValues: dict = None, **_) -> dict:
+        key = self.resource.key_of(self.name, _to_dynamo(Key))
+        with self.resource.lock:
+            items = self.resource.items(self.name)
+            self._check(items.get(key, {}), ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                        'DeleteItem')
+            items.pop(key, None)
+        return {}
+
+
+class InMemoryDynamoDB(object):
+    """DynamoDB service resource stand-in, for tables with a single (partition) key.
+    """
+
+    def __init__(self, key_names: Dict[str, str]):
+        """
+        :param key_names: The partition key of every table, by table name.
+        :type key_names: Dict[str, str]
+        """
+        self.key_names = key_names
+        self.lock = threading.RLock()
+        self._tables: Dict[str, Dict] = {name: {} for name in key_names}
+
+    def items(self, table_name: str) -> Dict:
+        if table_name not in self._tables:
+            raise ClientError('ResourceNotFoundException', 'Table', f'Requested resource not found: {table_name}')
+        return self._tables[table_name]
+
+    def key_of(self, table_name: str, item: dict):
+        return item[self.key_names[table_name]]
+
+    def Table(self, name: str) -> _Table:
+        return _Table(self, name)
+
+    def batch_write_item(self, RequestItems: dict, **_) -> dict:
+        for table_name, requests in RequestItems.items():
+            table = self.Table(table_name)
+            for request in requests:
+                if 'PutRequest' in request:
+                    table.put_item(Item=request['PutRequest']['Item'])
+                else:
+                    table.delete_item(Key=request['DeleteRequest']['Key'])
+        return {'UnprocessedItems': {}}
+
+    def batch_get_item(self, RequestItems: dict, **_) -> dict:
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.Table(table_name)
+            responses[table_name] = [
+                item for item in (
+                    table.get_item(
+                        Key=key,
+                        ProjectionExpression=request.get('ProjectionExpression'),
+                        ExpressionAttributeNames=request.get('ExpressionAttributeNames')
+                    ).get('Item')
+                    for key in request['Keys']
+                )
+                if item is not None
+            ]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class FakeTranscribe(object):
+    """Transcribe client stand-in: a job writes the transcript produced by transcript_factory(job_name) (a dict, or
+    the already encoded json) to its output location job_duration(job_name) seconds after it was started. Jobs
+    finish on a pool of background threads, like real jobs they don't wait on each other. Like the account's quota,
+    max_jobs limits the jobs in progress: starting one more raises LimitExceededException.
+    """
+    exceptions = EXCEPTIONS
+
+    def __init__(
+            self,
+            s3: InMemoryS3,
+            transcript_factory: Callable[[str], dict],
+            job_duration: Callable[[str], float] = lambda job_name: 0.0,
+            workers: int = 8,
+            max_jobs: int = 0):
+        self.s3 = s3
+        self.max_jobs = max_jobs
+        self.in_progress = 0
+        self.peak_in_progress = 0
+        # Starts refused because of max_jobs
+        self.limit_exceeded = 0
+        self.transcript_factory = transcript_factory
+        self.job_duration = job_duration
+        self.jobs: Dict[str, dict] = {}
+        self._scheduled: List[tuple] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fake-transcribe-job')
+        self._worker = threading.Thread(target=self._run, name='fake-transcribe', daemon=True)
+        self._worker.start()
+
+    def start_transcription_job(self, TranscriptionJobName: str, Media: dict, OutputBucketName: str,
+                                OutputKey: str, **kwargs) -> dict:
+        bucket, key = Media['MediaFileUri'][len('s3://'):].split('/', 1)
+        self.s3.head_object(Bucket=bucket, Key=key)
+        with self._condition:
+            if TranscriptionJobName in self.jobs:
+                raise ConflictException('StartTranscriptionJob', 'The requested job name already exists')
+            if self.max_jobs and self.in_progress >= self.max_jobs:
+                self.limit_exceeded += 1
+                raise LimitExceededException('StartTranscriptionJob', 'You have exceeded your concurrent job limit')
+            self.in_progress += 1
+            self.peak_in_progress = max(self.peak_in_progress, self.in_progress)
+            job = {
+                'TranscriptionJobName': TranscriptionJobName,
+                'TranscriptionJobStatus': 'IN_PROGRESS',
+                'Media': Media,
+                'StartTime': time.time(),
+                'OutputBucketName': OutputBucketName,
+                'OutputKey': OutputKey,
+                **kwargs
+            }
+            self.jobs[TranscriptionJobName] = job
+            finish_at = time.monotonic() + self.job_duration(TranscriptionJobName)
+            heapq.heappush(self._scheduled, (finish_at, next(self._sequence), TranscriptionJobName))
+            self._condition.notify_all()
+        return {'TranscriptionJob': {name: value for name, value in job.items()}}
+
+    def get_transcription_job(self, TranscriptionJobName: str) -> dict:
+        with self._condition:
+            return {'TranscriptionJob': dict(self.jobs[TranscriptionJobName])}
+
+    def list_transcription_jobs(self, Status: str = None, MaxResults: int = 5, NextToken: str = None, **_) -> dict:
+        with self._condition:
+            names = sorted(
+                name for name, job in self.jobs.items() if Status is None or job['TranscriptionJobStatus'] == Status
+            )
+        start = int(NextToken or 0)
+        response = {
+            'TranscriptionJobSummaries': [
+                {'TranscriptionJobName': name, 'TranscriptionJobStatus': self.jobs[name]['TranscriptionJobStatus']}
+                for name in names[start:start + MaxResults]
+            ]
+        }
+        if start + MaxResults < len(names):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._scheduled or self._scheduled[0][0] > time.monotonic():
+                    self._condition.wait(self._scheduled[0][0] - time.monotonic() if self._scheduled else None)
+                _, _, job_name = heapq.heappop(self._scheduled)
+            self._executor.submit(self._finish, job_name)
+
+    def _finish(self, job_name: str) -> None:
+        job = self.jobs[job_name]
+        try:
+            transcript = self.transcript_factory(job_name)
+            body = transcript if isinstance(transcript, bytes) else json.dumps(transcript).encode('utf-8')
+            with self._condition:
+                job['CompletionTime'] = time.time()
+                job['TranscriptionJobStatus'] = 'COMPLETED'
+                self.in_progress -= 1
+            self.s3.put_object(Bucket=job['OutputBucketName'], Key=job['OutputKey'], Body=body)
+        except Exception as exc:
+            with self._condition:
+                if job['TranscriptionJobStatus'] == 'IN_PROGRESS':
+                    self.in_progress -= 1
+                job['TranscriptionJobStatus'] = 'FAILED'
+                job['FailureReason'] = str(exc)
+
+
+class _HttpResponse(object):
+    """Enough of urllib3's HTTPResponse for the s3 service: status, headers, data and a readable body.
+    """
+
+    def __init__(self, status: int, headers: dict = None, data: bytes = b''):
+        self.status = status
+        self.headers = headers or {}
+        self.data = data
+        self._body = io.BytesIO(data)
+
+    def read(self, amt: int = None, *_, **__) -> bytes:
+        return self._body.read(amt)
+
+    def drain_conn(self) -> None:
+        self._body.read()
+
+    def release_conn(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class FakeHttp(object):
+    """urllib3.PoolManager stand-in. GETs are served from the registered files (with Range/If-Range support and
+    an ETag), other requests (e.g. callbacks) are recorded in .requests and answered with a 204.
+    """
+
+    def __init__(self):
+        self.files: Dict[str, bytes] = {}
+        self.requests: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def add_file(self, url: str, data: bytes) -> None:
+        self.files[url] = data
+
+    def request(self, method: str, url: str, headers: dict = None, body: bytes = None, **_) -> _HttpResponse:
+        headers = headers or {}
+        if method != 'GET':
+            with self._lock:
+                self.requests.append((method, url, headers, body))
+            return _HttpResponse(204)
+
+        data = self.files.get(url)
+        if data is None:
+            return _HttpResponse(404)
+        etag = _etag(data)
+        range_header = headers.get('Range')
+        if range_header and headers.get('If-Range', etag) == etag:
+            start, end = (int(bound) for bound in range_header[len('bytes='):].split('-'))
+            if start >= len(data):
+                return _HttpResponse(416, {'Content-Range': f'bytes */{len(data)}'})
+            end = min(end, len(data) - 1)
+            return _HttpResponse(
+                206,
+                {
+                    'ETag': etag,
+                    'Content-Range': f'bytes {start}-{end}/{len(data)}',
+                    'Content-Length': str(end - start + 1)
+                },
+                data[start:end + 1]
+            )
+        return _HttpResponse(200, {'ETag': etag, 'Content-Length': str(len(data))}, data)
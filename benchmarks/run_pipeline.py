@@ -0,0 +1,500 @@
+"""End-to-end run of the whole pipeline on a laptop: transcripts_api -> process_audio -> Transcribe ->
+analyse_transcript, with the real handlers and in-memory stand-ins for S3, SQS, DynamoDB, Transcribe and the
+audio sources (see local_backends.py).
+
+N requests are submitted through the api handler (concurrently, or in bulk), the sqs event source mapping and
+the s3 trigger are emulated by worker threads (their count plays the part of the lambda concurrency), and every
+request is followed until its completion event reaches the notification queue. Reports the latency percentiles
+and throughput of every stage:
+- submit: the api call;
+- audio_queue: waiting in the audio queue, until a process_audio invocation picks the request up;
+- process_audio: the invocation handling the request (the whole batch);
+- transcribe: the fake Transcribe job (--transcribe-seconds, or --transcribe-realtime-factor times the length of its
+  audio), absent for requests reusing a transcript; with --segment-seconds, every segment of a split recording is a
+  job, whose transcript is the part of the synthetic one inside the segment;
+- transcript_queue: from the transcript being written to the analyse_transcript invocation picking it up;
+- analyse_transcript: the invocation;
+- end_to_end: from the submission to the completion event.
+--transcribe-max-jobs gives the fake Transcribe a concurrent jobs quota, --admission-max-jobs and --start-rate turn
+on the admission control of process_audio (deferred messages come back after --defer-seconds, doubling up to
+--defer-max-seconds).
+It then reports the stage_timings the functions stored on the completed requests (their own view of the same
+stages, down to the transfer, the transcript fetch and the matching). The embedded metric lines the functions
+print are discarded.
+
+Needs boto3 and aws_lambda_powertools installed (the handlers import them), no AWS account or network.
+
+Usage:
+    python benchmarks/run_pipeline.py [--requests 200] [--submit-concurrency 8] [--bulk-size 0]
+                                      [--process-workers 4] [--analyse-workers 4] [--batch-size 5]
+                                      [--items 10000] [--sentences 16] [--transcribe-seconds 0.5]
+                                      [--audio-seconds 5] [--distinct-audio 0] [--fixture transcript.json]
+                                      [--transcribe-realtime-factor 0] [--segment-seconds 0] [--segment-overlap 15]
+                                      [--transcribe-max-jobs 0] [--admission-max-jobs 0] [--start-rate 10]
+                                      [--defer-seconds 1] [--defer-max-seconds 4]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+import uuid
+import wave
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from importlib import util
+from typing import Callable, Dict, List
+from urllib.parse import quote_plus
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FUNCTIONS = ('transcripts_api', 'process_audio', 'analyse_transcript')
+sys.path.insert(0, os.path.join(ROOT, 'src', 'layers', 'common', 'python'))
+sys.path[1:1] = [os.path.join(ROOT, 'src', 'functions', function) for function in FUNCTIONS]
+
+from local_backends import FakeHttp, FakeTranscribe, InMemoryDynamoDB, InMemoryS3, InMemorySQS  # noqa: E402
+from synthetic import generate_sentences, generate_transcript  # noqa: E402
+
+REGION = 'us-east-1'
+ACCOUNT = '000000000000'
+BUCKET = 'local-audio-analysis'
+TABLE = 'local_analysis_requests'
+ADMISSION_TABLE = 'local_transcribe_admission'
+AUDIO_QUEUE_URL = f'https://sqs.{REGION}.amazonaws.com/{ACCOUNT}/audio_transcribe_queue'
+NOTIFICATION_QUEUE_URL = f'https://sqs.{REGION}.amazonaws.com/{ACCOUNT}/analysis_notifications_queue'
+STAGES = (
+    'submit', 'audio_queue', 'process_audio', 'transcribe', 'transcript_queue', 'analyse_transcript', 'end_to_end'
+)
+
+
+class LocalContext(object):
+    """The attributes of the lambda context the handlers (and powertools) read.
+    """
+
+    def __init__(self, function_name: str, timeout: int = 300):
+        self.function_name = function_name
+        self.function_version = '$LATEST'
+        self.invoked_function_arn = f'arn:aws:lambda:{REGION}:{ACCOUNT}:function:{function_name}'
+        self.memory_limit_in_mb = 1024
+        self.aws_request_id = str(uuid.uuid4())
+        self.log_group_name = f'/aws/lambda/{function_name}'
+        self.log_stream_name = 'local'
+        self._deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(int((self._deadline - time.monotonic()) * 1000), 0)
+
+
+def load_handler(function: str) -> Callable[[dict, LocalContext], dict]:
+    # Every function has its own lambda_handler module, loaded under a distinct name.
+    spec = util.spec_from_file_location(
+        f'{function}_lambda_handler',
+        os.path.join(ROOT, 'src', 'functions', function, 'lambda_handler.py')
+    )
+    module = util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.lambda_handler
+
+
+def make_wav(seconds: float, seed: int) -> bytes:
+    """A silent 8kHz mono wav, made distinct by the seed written in its first samples.
+    """
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        frames = bytearray(int(seconds * 8000) * 2)
+        marker = seed.to_bytes(8, 'little')
+        frames[:len(marker)] = marker
+        wav.writeframes(bytes(frames))
+    return output.getvalue()
+
+
+def percentile(samples: List[float], pct: int) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class LocalPipeline(object):
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.stop = threading.Event()
+        self._lock = threading.Lock()
+        # stage -> request_id -> (start, end), wall clock seconds
+        self.timings: Dict[str, Dict[str, tuple]] = defaultdict(dict)
+        self.submitted: Dict[str, float] = {}
+        self.completed: Dict[str, str] = {}
+        # Messages process_audio returned to the queue (deferred or failed)
+        self.returned = 0
+        self.all_done = threading.Event()
+        self.transcript_events: 'queue.Queue[tuple]' = queue.Queue()
+
+        self.s3 = InMemoryS3(on_object_created=self._on_object_created)
+        self.sqs = InMemorySQS(visibility_timeout=args.visibility_timeout, on_message_sent=self._on_message_sent)
+        self.dynamodb = InMemoryDynamoDB({TABLE: 'request_id', ADMISSION_TABLE: 'name'})
+        self.http = FakeHttp()
+        if args.fixture:
+            with open(args.fixture, 'rb') as fixture:
+                self.transcript = json.loads(fixture.read())
+        else:
+            self.transcript = generate_transcript(args.items)
+        self.transcript_json = json.dumps(self.transcript).encode('utf-8')
+        self.transcribe = FakeTranscribe(
+            self.s3,
+            transcript_factory=self._transcribe,
+            job_duration=self._transcribe_duration,
+            max_jobs=args.transcribe_max_jobs
+        )
+        self.sentences = generate_sentences(args.sentences, args.items)
+
+        os.environ.update({
+            'AWS_DEFAULT_REGION': REGION,
+            'TRANSCRIPTS_TABLE': TABLE,
+            'TRANSCRIPTS_BUCKET': BUCKET,
+            'AUDIO_TRANSCRIBE_QUEUE_URL': AUDIO_QUEUE_URL,
+            'NOTIFICATION_QUEUE_URL': NOTIFICATION_QUEUE_URL,
+            'POWERTOOLS_LOG_LEVEL': os.environ.get('POWERTOOLS_LOG_LEVEL', 'WARNING'),
+            'POWERTOOLS_METRICS_NAMESPACE': 'LocalPipeline',
+            'TRANSCRIBE_SEGMENT_SECONDS': str(args.segment_seconds),
+            'TRANSCRIBE_SEGMENT_OVERLAP_SECONDS': str(args.segment_overlap),
+            'TRANSCRIBE_SEGMENT_MIN_SECONDS': '0',
+            'TRANSCRIBE_MAX_CONCURRENT_JOBS': str(args.admission_max_jobs),
+            'TRANSCRIBE_START_RATE': str(args.start_rate),
+            'TRANSCRIBE_START_BURST': str(args.start_rate),
+            'TRANSCRIBE_DEFER_BASE_SECONDS': str(args.defer_seconds),
+            'TRANSCRIBE_DEFER_MAX_SECONDS': str(args.defer_max_seconds),
+            'SEARCH_INDEX_LOCK_TABLE': ADMISSION_TABLE,
+            'SEARCH_INDEX_COMPACT_SEGMENTS': str(args.compact_segments),
+        })
+        if args.admission_max_jobs:
+            os.environ['TRANSCRIBE_ADMISSION_TABLE'] = ADMISSION_TABLE
+        else:
+            os.environ.pop('TRANSCRIBE_ADMISSION_TABLE', None)
+        from services.providers.client_provider import ClientProvider
+        ClientProvider.reset()
+        ClientProvider.set_client('s3', self.s3)
+        ClientProvider.set_client('sqs', self.sqs)
+        ClientProvider.set_client('transcribe', self.transcribe)
+        ClientProvider.set_resource('dynamodb', self.dynamodb)
+        ClientProvider.set_http(self.http)
+        self.handlers = {function: load_handler(function) for function in FUNCTIONS}
+
+    def _segment_bounds(self, job_name: str) -> tuple:
+        # Segment jobs are named <request_id>-<segment>, their bounds were saved before they were started.
+        request_id, segment = job_name.split('-')
+        item = self.dynamodb.items(TABLE)[request_id]
+        start, end = item['transcribe_segments'][int(segment)]
+        return float(start), float(end), int(segment) == len(item['transcribe_segments']) - 1
+
+    def _transcribe(self, job_name: str):
+        if '-' not in job_name:
+            return self.transcript_json
+        start, end, last = self._segment_bounds(job_name)
+        # The words heard inside the segment (the last one gets the rest of the transcript), with the punctuation
+        # following them, timed from the start of the segment.
+        items = []
+        inside = False
+        for item in self.transcript['results']['items']:
+            if 'start_time' in item:
+                inside = float(item['start_time']) >= start and (last or float(item['end_time']) <= end)
+                if inside:
+                    item = dict(item, start_time=f'{float(item["start_time"]) - start:.3f}',
+                                end_time=f'{float(item["end_time"]) - start:.3f}')
+            if inside:
+                items.append(item)
+        return {'jobName': job_name, 'results': {'items': items}, 'status': 'COMPLETED'}
+
+    def _transcribe_duration(self, job_name: str) -> float:
+        if not self.args.transcribe_realtime_factor:
+            return self.args.transcribe_seconds
+        if '-' not in job_name:
+            return self.args.transcribe_realtime_factor * self.args.audio_seconds
+        start, end, _ = self._segment_bounds(job_name)
+        return self.args.transcribe_realtime_factor * (end - start)
+
+    def _record(self, stage: str, request_id: str, start: float, end: float) -> None:
+        with self._lock:
+            # Redeliveries keep the first timing of the request.
+            self.timings[stage].setdefault(request_id, (start, end))
+
+    def _on_object_created(self, bucket: str, key: str, size: int, etag: str) -> None:
+        # The s3 trigger of analyse_transcript (prefix transcripts/, suffix .json)
+        if key.startswith('transcripts/') and key.endswith('.json'):
+            self.transcript_events.put((time.time(), bucket, key, size, etag))
+
+    def _on_message_sent(self, queue_url: str, body: str) -> None:
+        if queue_url != NOTIFICATION_QUEUE_URL:
+            return
+        event = json.loads(body)
+        now = time.time()
+        with self._lock:
+            self.completed.setdefault(event['request_id'], event['status'])
+            started = self.submitted.get(event['request_id'])
+            if started is not None:
+                self.timings['end_to_end'].setdefault(event['request_id'], (started, now))
+            if len(self.completed) >= self.args.requests:
+                self.all_done.set()
+
+    def _api(self, method: str, path: str, body: dict) -> dict:
+        event = {
+            'resource': '/{proxy+}',
+            'path': path,
+            'httpMethod': method,
+            'headers': {'Content-Type': 'application/json'},
+            'multiValueHeaders': {'Content-Type': ['application/json']},
+            'queryStringParameters': None,
+            'multiValueQueryStringParameters': None,
+            'pathParameters': {'proxy': path.lstrip('/')},
+            'stageVariables': None,
+            'requestContext': {
+                'requestId': str(uuid.uuid4()),
+                'resourcePath': '/{proxy+}',
+                'httpMethod': method,
+                'path': f'/local{path}',
+                'stage': 'local',
+                'identity': {'sourceIp': '127.0.0.1'}
+            },
+            'body': json.dumps(body),
+            'isBase64Encoded': False
+        }
+        response = self.handlers['transcripts_api'](event, LocalContext('transcripts_api'))
+        if response['statusCode'] != 200:
+            raise Exception(f'{method} {path} answered {response["statusCode"]}: {response["body"]}')
+        # The POST routes answer with their payload under 'body'.
+        payload = json.loads(response['body'])
+        return payload.get('body', payload)
+
+    def _audio_url(self, idx: int) -> str:
+        distinct = self.args.distinct_audio or self.args.requests
+        url = f'https://audio.local/recordings/{idx % distinct}.wav'
+        if url not in self.http.files:
+            self.http.add_file(url, make_wav(self.args.audio_seconds, idx % distinct))
+        return url
+
+    def _submit(self, indices: List[int]) -> None:
+        started = time.time()
+        if self.args.bulk_size:
+            body = self._api('POST', '/submit_requests', {
+                'entries': [{'audio_url': self._audio_url(idx)} for idx in indices],
+                'sentences': self.sentences
+            })
+            request_ids = [result['request_id'] for result in body['results'] if 'request_id' in result]
+        else:
+            body = self._api('POST', '/submit_request', {
+                'audio_url': self._audio_url(indices[0]),
+                'sentences': self.sentences
+            })
+            request_ids = [body['request_id']]
+        ended = time.time()
+        with self._lock:
+            for request_id in request_ids:
+                self.submitted[request_id] = started
+                self.timings['submit'][request_id] = (started, ended)
+
+    def _process_audio_worker(self) -> None:
+        while not self.stop.is_set():
+            messages = self.sqs.receive_message(
+                QueueUrl=AUDIO_QUEUE_URL,
+                MaxNumberOfMessages=self.args.batch_size,
+                WaitTimeSeconds=0.1
+            ).get('Messages', [])
+            if not messages:
+                continue
+            records = [
+                {
+                    'messageId': message['MessageId'],
+                    'receiptHandle': message['ReceiptHandle'],
+                    'body': message['Body'],
+                    'attributes': message['Attributes'],
+                    'messageAttributes': {},
+                    'md5OfBody': '',
+                    'eventSource': 'aws:sqs',
+                    'eventSourceARN': f'arn:aws:sqs:{REGION}:{ACCOUNT}:audio_transcribe_queue',
+                    'awsRegion': REGION
+                }
+                for message in messages
+            ]
+            started = time.time()
+            try:
+                response = self.handlers['process_audio']({'Records': records}, LocalContext('process_audio'))
+                failed = {failure['itemIdentifier'] for failure in (response or {}).get('batchItemFailures', [])}
+            except Exception as exc:
+                print(f'process_audio invocation failed: {exc}', file=sys.stderr)
+                # The whole batch goes back to the queue once its visibility timeout expires.
+                continue
+            ended = time.time()
+            with self._lock:
+                self.returned += len(failed)
+            for message in messages:
+                request_id = json.loads(message['Body']).get('request_id')
+                with self._lock:
+                    submitted = self.submitted.get(request_id, started)
+                self._record('audio_queue', request_id, submitted, started)
+                self._record('process_audio', request_id, started, ended)
+                if message['MessageId'] not in failed:
+                    self.sqs.delete_message(QueueUrl=AUDIO_QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
+
+    def _analyse_transcript_worker(self) -> None:
+        while not self.stop.is_set():
+            try:
+                created, bucket, key, size, etag = self.transcript_events.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            event = {
+                'Records': [{
+                    'eventVersion': '2.1',
+                    'eventSource': 'aws:s3',
+                    'awsRegion': REGION,
+                    'eventTime': (
+                        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(created)) + f'.{int(created * 1000) % 1000:03d}Z'
+                    ),
+                    'eventName': 'ObjectCreated:Put',
+                    's3': {
+                        's3SchemaVersion': '1.0',
+                        'configurationId': 'transcript_pushed',
+                        'bucket': {'name': bucket, 'arn': f'arn:aws:s3:::{bucket}'},
+                        'object': {'key': quote_plus(key, safe='/'), 'size': size, 'eTag': etag.strip('"')}
+                    }
+                }]
+            }
+            request_id = key.split('/')[1]
+            started = time.time()
+            try:
+                self.handlers['analyse_transcript'](event, LocalContext('analyse_transcript'))
+            except Exception as exc:
+                # s3 retries asynchronous invocations, twice.
+                print(f'analyse_transcript invocation failed for {request_id}: {exc}', file=sys.stderr)
+                continue
+            item = self.dynamodb.items(TABLE).get(request_id, {})
+            if item.get('transcribe_segments') and ('/segments/' not in key or item.get('status') != 'completed'):
+                # Of a split recording, only the invocation that merged the segments analysed it.
+                continue
+            self._record('transcript_queue', request_id, created, started)
+            self._record('analyse_transcript', request_id, started, time.time())
+
+    def run(self) -> float:
+        """Submits the requests and waits for all of them to complete (or the timeout).
+
+        :return: The wall time of the run, in seconds.
+        :rtype: float
+        """
+        workers = [
+            threading.Thread(target=self._process_audio_worker, daemon=True)
+            for _ in range(self.args.process_workers)
+        ] + [
+            threading.Thread(target=self._analyse_transcript_worker, daemon=True)
+            for _ in range(self.args.analyse_workers)
+        ]
+        # The metrics are flushed to stdout as embedded metric format lines at the end of every invocation.
+        devnull = open(os.devnull, 'w')
+        with devnull, contextlib.redirect_stdout(devnull):
+            return self._run(workers)
+
+    def _run(self, workers: List[threading.Thread]) -> float:
+        for worker in workers:
+            worker.start()
+
+        started = time.time()
+        chunk = self.args.bulk_size or 1
+        with ThreadPoolExecutor(max_workers=self.args.submit_concurrency) as executor:
+            for future in [
+                executor.submit(self._submit, list(range(start, min(start + chunk, self.args.requests))))
+                for start in range(0, self.args.requests, chunk)
+            ]:
+                future.result()
+
+        if not self.all_done.wait(self.args.timeout):
+            print(f'Timed out, {len(self.completed)}/{self.args.requests} requests completed.', file=sys.stderr)
+        wall_time = time.time() - started
+        self.stop.set()
+        for worker in workers:
+            worker.join()
+
+        for job_name, job in list(self.transcribe.jobs.items()):
+            if 'CompletionTime' in job:
+                self._record('transcribe', job_name, job['StartTime'], job['CompletionTime'])
+        return wall_time
+
+    def report(self, wall_time: float) -> None:
+        statuses = defaultdict(int)
+        for status in self.completed.values():
+            statuses[status] += 1
+        print(f'{len(self.submitted)} submitted, ' + ', '.join(f'{count} {status}' for status, count in
+                                                                 sorted(statuses.items())) +
+              f' in {wall_time:.2f}s: {len(self.completed) / wall_time:.1f} requests/s')
+        print(f'{"stage":>18} {"count":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9} {"per s":>8}')
+        for stage in STAGES:
+            timings = list(self.timings[stage].values())
+            if not timings:
+                continue
+            latencies = [(end - start) * 1000 for start, end in timings]
+            span = max(end for _, end in timings) - min(start for start, _ in timings)
+            print(f'{stage:>18} {len(timings):>6} {percentile(latencies, 50):>9.1f} {percentile(latencies, 95):>9.1f} '
+                  f'{percentile(latencies, 99):>9.1f} {max(latencies):>9.1f} '
+                  f'{len(timings) / span if span else float("inf"):>8.1f}')
+        print(f'transcribe: {len(self.transcribe.jobs)} jobs, at most {self.transcribe.peak_in_progress} at once, '
+              f'{self.transcribe.limit_exceeded} starts refused over the quota; '
+              f'{self.returned} messages returned to the audio queue')
+        if self.timings['end_to_end']:
+            mean = statistics.mean(end - start for start, end in self.timings['end_to_end'].values())
+            print(f'mean end to end latency: {mean * 1000:.1f} ms')
+
+        stored = defaultdict(list)
+        for item in self.dynamodb.items(TABLE).values():
+            for stage, milliseconds in item.get('stage_timings', {}).items():
+                if not stage.endswith('_at'):
+                    stored[stage].append(float(milliseconds))
+        if stored:
+            print('stage timings stored on the requests:')
+            print(f'{"stage":>18} {"count":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+            for stage, latencies in stored.items():
+                print(f'{stage:>18} {len(latencies):>6} {percentile(latencies, 50):>9.1f} '
+                      f'{percentile(latencies, 95):>9.1f} {percentile(latencies, 99):>9.1f} {max(latencies):>9.1f}')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--submit-concurrency', type=int, default=8)
+    parser.add_argument('--bulk-size', type=int, default=0, help='Submit through /submit_requests, this many at once.')
+    parser.add_argument('--process-workers', type=int, default=4, help='Concurrent process_audio invocations.')
+    parser.add_argument('--analyse-workers', type=int, default=4, help='Concurrent analyse_transcript invocations.')
+    parser.add_argument('--batch-size', type=int, default=5, help='Batch size of the audio queue trigger.')
+    parser.add_argument('--items', type=int, default=10000, help='Items of the synthetic transcripts.')
+    parser.add_argument('--sentences', type=int, default=16)
+    parser.add_argument('--fixture', help='A Transcribe output json every job returns, instead of a synthetic one.')
+    parser.add_argument('--transcribe-seconds', type=float, default=0.5, help='How long every Transcribe job takes.')
+    parser.add_argument('--transcribe-realtime-factor', type=float, default=0,
+                        help='If set, Transcribe jobs take this fraction of the length of their audio instead.')
+    parser.add_argument('--segment-seconds', type=float, default=0,
+                        help='Split recordings longer than this for parallel transcription (0: off).')
+    parser.add_argument('--segment-overlap', type=float, default=15)
+    parser.add_argument('--audio-seconds', type=float, default=5)
+    parser.add_argument('--distinct-audio', type=int, default=0,
+                        help='Cycle the requests over this many recordings (0: all distinct), to exercise reuse.')
+    parser.add_argument('--transcribe-max-jobs', type=int, default=0,
+                        help='Concurrent jobs quota of the fake Transcribe (0: none).')
+    parser.add_argument('--admission-max-jobs', type=int, default=0,
+                        help='Concurrent jobs process_audio admits (0: no admission control).')
+    parser.add_argument('--start-rate', type=float, default=10, help='Transcribe jobs admitted per second.')
+    parser.add_argument('--defer-seconds', type=int, default=1)
+    parser.add_argument('--defer-max-seconds', type=int, default=4)
+    parser.add_argument('--visibility-timeout', type=float, default=2.0)
+    parser.add_argument('--compact-segments', type=int, default=500,
+                        help='Segments of a search index shard the analysis compacts it at.')
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    pipeline = LocalPipeline(args)
+    pipeline.report(pipeline.run())
+    return 0 if len(pipeline.completed) == args.requests else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
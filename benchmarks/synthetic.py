@@ -0,0 +1,135 @@
+"""Deterministic generator for synthetic Transcribe output and sentence sets.
+
+Everything is derived from a seed, so the same arguments always produce the same transcript and sentences
+(the golden results of bench_analysis.py rely on it).
+"""
+import json
+import random
+from typing import Iterator, List
+
+COMMON_WORDS = (
+    'yes i agree with the terms and conditions thank you for calling my name is how can help today '
+    'we do not know that it is ok please hold while check your account this call may be recorded '
+    'quality training purposes would like to cancel subscription refund order number confirm address '
+    'email phone credit card payment due date balance interest rate offer upgrade plan contract'
+).split()
+CONTRACTIONS = ["don't", "can't", "it's", "i'm", "we're", "won't", "that's"]
+PUNCTUATION = ['.', ',', '?']
+
+
+def _vocabulary(size: int) -> List[str]:
+    return list(COMMON_WORDS) + CONTRACTIONS + [f'word{i}' for i in range(max(size - len(COMMON_WORDS), 0))]
+
+
+def iter_transcript_items(
+        item_count: int,
+        seed: int = 0,
+        vocabulary_size: int = 2000,
+        punctuation_rate: float = 0.08,
+        alternatives_rate: float = 0.05) -> Iterator[dict]:
+    """Yields item_count Transcribe items.
+
+    Word frequencies are skewed (common words come up much more often) like in real calls, a share of the
+    items are punctuation and a share of the words carry lower ranked alternatives.
+    """
+    rng = random.Random(seed)
+    words = _vocabulary(vocabulary_size)
+    offset = 0.0
+    for _ in range(item_count):
+        if rng.random() < punctuation_rate:
+            yield {
+                'alternatives': [{'confidence': '0.0', 'content': rng.choice(PUNCTUATION)}],
+                'type': 'punctuation'
+            }
+            continue
+        # The power biases the pick towards the start of the vocabulary (the common words).
+        content = words[int(rng.random() ** 4 * len(words))]
+        alternatives = [{'confidence': f'{rng.uniform(0.6, 1.0):.4f}', 'content': content}]
+        if rng.random() < alternatives_rate:
+            alternatives.append({'confidence': f'{rng.uniform(0.1, 0.5):.4f}', 'content': rng.choice(words)})
+        duration = rng.uniform(0.15, 0.6)
+        yield {
+            'start_time': f'{offset:.3f}',
+            'end_time': f'{offset + duration:.3f}',
+            'alternatives': alternatives,
+            'type': 'pronunciation'
+        }
+        offset += duration + rng.uniform(0.0, 0.3)
+
+
+def generate_transcript(item_count: int, seed: int = 0, **kwargs) -> dict:
+    """Returns a whole Transcribe output document with item_count items.
+    """
+    items = list(iter_transcript_items(item_count, seed, **kwargs))
+    return {
+        'jobName': f'synthetic-{seed}',
+        'accountId': '0',
+        'results': {
+            'transcripts': [{'transcript': ' '.join(item['alternatives'][0]['content'] for item in items)}],
+            'items': items
+        },
+        'status': 'COMPLETED'
+    }
+
+
+def generate_sentences(count: int, item_count: int, seed: int = 0, **kwargs) -> List[str]:
+    """Returns count sentences for the transcript generated with the same arguments.
+
+    Roughly a third of them are cut out of the transcript (so they are present), a third are short phrases of
+    common words (so they come up many times) and the rest are random phrases of 2 to 8 words.
+    """
+    rng = random.Random(seed + 1)
+    words = [
+        item['alternatives'][0]['content']
+        for item in iter_transcript_items(min(item_count, 20000), seed, **kwargs)
+        if item.get('type') != 'punctuation'
+    ]
+    vocabulary = _vocabulary(kwargs.get('vocabulary_size', 2000))
+    sentences = []
+    for _ in range(count):
+        length = rng.randint(2, 8)
+        kind = rng.random()
+        if words and kind < 1 / 3:
+            start = rng.randrange(max(len(words) - length, 1))
+            sentences.append(' '.join(words[start:start + length]))
+        elif kind < 2 / 3:
+            sentences.append(' '.join(rng.choice(COMMON_WORDS[:12]) for _ in range(rng.randint(2, 3))))
+        else:
+            sentences.append(' '.join(rng.choice(vocabulary) for _ in range(length)))
+    return sentences
+
+
+class SyntheticTranscriptBody(object):
+    """File-like stand-in for the s3 StreamingBody that renders a Transcribe json of roughly size_bytes on the fly.
+    """
+
+    def __init__(self, size_bytes: int, seed: int = 0):
+        self._size_bytes = size_bytes
+        self._seed = seed
+        self._chunks = self._render()
+        self._pending = b''
+
+    def _render(self) -> Iterator[bytes]:
+        yield b'{"jobName": "synthetic", "accountId": "0", "results": {"transcripts": [{"transcript": "'
+        for _ in range(self._size_bytes // 100 // 4096):
+            yield b'lorem ipsum ' * 4096
+        yield b'"}], "items": ['
+        written = 0
+        for item in iter_transcript_items(2 ** 62, self._seed):
+            chunk = (b', ' if written else b'') + json.dumps(item).encode()
+            written += len(chunk)
+            yield chunk
+            if written >= self._size_bytes:
+                break
+        yield b']}, "status": "COMPLETED"}'
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            return self._pending + b''.join(self._chunks)
+        while len(self._pending) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._pending += chunk
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
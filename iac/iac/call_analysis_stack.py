@@ -54,9 +54,20 @@ class CallAnalysisStack(Stack):
     def _create_buckets(self, buckets: dict) -> Mapping[str, s3.Bucket]:
         buckets_created: Mapping[str, s3.Bucket] = {}
         for bucket_name, bucket_config in buckets.items():
+            lifecycle_rules = []
+            if bucket_config.get('abort_incomplete_uploads_after_days'):
+                # Multipart uploads are kept on failure so they can be resumed, this cleans up the abandoned ones
+                lifecycle_rules.append(s3.LifecycleRule(
+                    abort_incomplete_multipart_upload_after=Duration.days(
+                        bucket_config['abort_incomplete_uploads_after_days']
+                    )
+                ))
+            for prefix, days in bucket_config.get('expire_prefixes', {}).items():
+                lifecycle_rules.append(s3.LifecycleRule(prefix=prefix, expiration=Duration.days(days)))
             bucket =  s3.Bucket(
                 self, bucket_name,
                 bucket_name=bucket_name,
+                lifecycle_rules=lifecycle_rules,
             )
             buckets_created[bucket_name] = bucket
 
@@ -149,7 +160,10 @@ class CallAnalysisStack(Stack):
                         env_vars[env_var_name] = self.buckets.get(env_var_bucket_reference).bucket_name
                 elif obj_type == 'sqs':
                     for env_var_name, env_var_queue_reference in env_vars_config.items():
-                        env_vars[env_var_name] = self.queues.get(env_var_queue_reference).queue_name
+                        env_vars[env_var_name] = self.queues.get(env_var_queue_reference).queue_url
+                elif obj_type == 'values':
+                    for env_var_name, env_var_value in env_vars_config.items():
+                        env_vars[env_var_name] = str(env_var_value)
 
             # Create function
             new_function: aws_lambda.Function = aws_lambda.Function(
@@ -178,7 +192,8 @@ class CallAnalysisStack(Stack):
                     new_function.add_event_source(
                         aws_lambda_event_sources.SqsEventSource(
                             self.queues[trigger_construct],
-                            batch_size=5
+                            batch_size=trigger_config.get('batch_size', 5),
+                            report_batch_item_failures=True
                         )
                     )
                 elif trigger_type == 's3':
@@ -198,7 +213,8 @@ class CallAnalysisStack(Stack):
                     iam.PolicyStatement(
                         effect=iam.Effect(effect),
                         resources=['*'],  # ideally add a proper wildcard here at some point
-                        actions=['transcribe:StartTranscriptionJob']
+                        # listing to count the jobs in progress, see TranscribeAdmissionService
+                        actions=['transcribe:StartTranscriptionJob', 'transcribe:ListTranscriptionJobs']
                     )
                 )
 
@@ -1,9 +1,34 @@
+import json
+import math
 import os
+import time
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List
 
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+from analysis.inverted_index import DEFAULT_SHARD_COUNT, build_postings
+from analysis.segment_merger import TranscriptFileWriter, merge_segment_items
+from analysis.tokenizer import Tokenizer
+from analysis.transcript_analyzer import TranscriptAnalyzer
+from models.results_summary import ResultsSummary
 from models.transcript import Transcript, TranscriptStatus
+from services.notification_service import NotificationService
 from services.s3_service import S3Service
+from services.search_index_service import SearchIndexService
+from services.stage_timer import StageTimer
+from services.transcribe_admission_service import TranscribeAdmissionService
+from services.transcribe_service import TranscribeService
 from services.transcript_storage_service import TranscriptStorageService
 
+# Embedded metric format, flushed by the handler (namespace from POWERTOOLS_METRICS_NAMESPACE).
+metrics: Metrics = Metrics(service='analyse_transcript')
+
+
+def add_stage_metric(name: str, milliseconds: float) -> None:
+    metrics.add_metric(name=name, unit=MetricUnit.Milliseconds, value=milliseconds)
+
 
 class AnalyseTrascriptHelper(object):
 
@@ -13,16 +38,195 @@ class AnalyseTrascriptHelper(object):
             os.environ['TRANSCRIPTS_TABLE']
         )
         self.s3_service = S3Service()
+        self.notification_service = NotificationService(os.environ.get('NOTIFICATION_QUEUE_URL'))
+        # Deployment specific word equivalences (e.g. product names), on top of the default contractions.
+        self.tokenizer = Tokenizer(json.loads(os.environ.get('TOKEN_EQUIVALENCES', '{}')))
+        self.search_index_enabled = os.environ.get('SEARCH_INDEX_ENABLED', 'true').lower() == 'true'
+        self.search_index_service = SearchIndexService(
+            self.s3_bucket,
+            shard_count=int(os.environ.get('SEARCH_INDEX_SHARDS', DEFAULT_SHARD_COUNT)),
+            s3_service=self.s3_service,
+            # Shards are compacted as they fill up (see compact_search_index), leased in this table.
+            lock_table=os.environ.get('SEARCH_INDEX_LOCK_TABLE'),
+            compact_segments=int(os.environ.get('SEARCH_INDEX_COMPACT_SEGMENTS', '500'))
+        )
+        # The shards written by the analyses of this invocation
+        self.indexed_shards = set()
+        # The analysis of a transcribe job's transcript gives back its admission (see process_audio).
+        admission_table = os.environ.get('TRANSCRIBE_ADMISSION_TABLE')
+        self.admission_service = (
+            TranscribeAdmissionService(admission_table, TranscribeService()) if admission_table else None
+        )
 
-    def get_transcript_results(self, obj_key: str) -> dict:
-        """Gets the results from s3
+    def get_transcript_items(self, obj_key: str) -> Iterator[dict]:
+        """Streams the items (words and punctuation) of the transcribe results from s3.
 
         :param obj_key: The key of the transcribe results.
         :type obj_key: str
-        :return: Results as a dict
-        :rtype: dict
+        :return: The items, read from s3 as they are consumed.
+        :rtype: Iterator[dict]
+        """
+        return self.s3_service.iter_json_array(bucket=self.s3_bucket, s3_key=obj_key, path=('results', 'items'))
+
+    def written_by_transcribe_job(self, transcript_metadata: Transcript, transcript_path: str) -> bool:
+        """Whether the transcript at transcript_path was written by a transcribe job of a pending request, rather
+        than copied from another request or merged from the segments of a split recording.
+
+        :param transcript_metadata: The metadata of the transcript.
+        :type transcript_metadata: Transcript
+        :param transcript_path: The key of the transcript that triggered the analysis.
+        :type transcript_path: str
+        :rtype: bool
+        """
+        if transcript_metadata.status != TranscriptStatus.PENDING:
+            return False
+        if transcript_metadata.transcribe_segments:
+            return transcript_path.startswith(transcript_metadata.segment_transcripts_prefix)
+        return transcript_metadata.source_request_id is None
+
+    def claim_transcribe_job_release(self, transcript_metadata: Transcript, transcript_path: str) -> bool:
+        """Whether the admission of the transcribe job that wrote transcript_path is to be given back by this
+        invocation: it's recorded on the transcript, so it's given back once however often the event is analysed.
+
+        :param transcript_metadata: The metadata of the transcript.
+        :type transcript_metadata: Transcript
+        :param transcript_path: The key of the transcript that triggered the analysis.
+        :type transcript_path: str
+        :rtype: bool
+        """
+        return (
+            self.admission_service is not None
+            and self.written_by_transcribe_job(transcript_metadata, transcript_path)
+            and self.transcript_storage_service.mark_transcribe_job_released(
+                transcript_metadata.request_id.hex, transcript_path
+            )
+        )
+
+    def release_transcribe_jobs(self, jobs: int) -> None:
+        """Gives back the admission of transcribe jobs that finished.
+
+        :param jobs: How many jobs.
+        :type jobs: int
+        """
+        if self.admission_service and jobs > 0:
+            self.admission_service.release(jobs)
+
+    def segment_transcripts_ready(self, transcript_metadata: Transcript) -> bool:
+        """Whether the transcripts of all the segments of a split recording were written.
+
+        :param transcript_metadata: The metadata of a transcript with transcribe_segments.
+        :type transcript_metadata: Transcript
+        :rtype: bool
         """
-        return self.s3_service.read_json_file(bucket=self.s3_bucket, s3_key=obj_key)
+        keys = set(self.s3_service.list_keys(self.s3_bucket, transcript_metadata.segment_transcripts_prefix))
+        return all(
+            transcript_metadata.segment_transcript_file_path(idx) in keys
+            for idx in range(len(transcript_metadata.transcribe_segments))
+        )
+
+    def claim_segment_merge(self, transcript_metadata: Transcript, claimant: str, claim_seconds: float) -> bool:
+        """Claims the merge of the segment transcripts, for the invocation that saw them all written first.
+
+        :param transcript_metadata: The metadata of a transcript with transcribe_segments.
+        :type transcript_metadata: Transcript
+        :param claimant: The aws_request_id of the invocation.
+        :type claimant: str
+        :param claim_seconds: How long the claim holds (the invocation's remaining time), another invocation can
+            take it over afterwards.
+        :type claim_seconds: float
+        :return: False if another invocation merges them (or already did).
+        :rtype: bool
+        """
+        return self.transcript_storage_service.claim_segment_merge(
+            transcript_metadata.request_id.hex, claimant, math.ceil(time.time() + claim_seconds)
+        )
+
+    def release_segment_merge(self, transcript_metadata: Transcript, claimant: str) -> None:
+        """Gives back the merge claimed by the invocation, when it failed.
+
+        :param transcript_metadata: The metadata of a transcript with transcribe_segments.
+        :type transcript_metadata: Transcript
+        :param claimant: The aws_request_id of the invocation.
+        :type claimant: str
+        """
+        self.transcript_storage_service.release_segment_merge(transcript_metadata.request_id.hex, claimant)
+
+    def get_merged_transcript_items(
+            self,
+            transcript_metadata: Transcript,
+            merged: TranscriptFileWriter) -> Iterator[dict]:
+        """Streams the items of the segment transcripts merged into a single transcript (see merge_segment_items),
+        writing them as well so the merged transcript can be saved.
+
+        :param transcript_metadata: The metadata of a transcript with transcribe_segments.
+        :type transcript_metadata: Transcript
+        :param merged: Where the items are written, as they are yielded (see open_merged_transcript).
+        :type merged: TranscriptFileWriter
+        :return: The items of the whole recording.
+        :rtype: Iterator[dict]
+        """
+        segments = (
+            self.get_transcript_items(transcript_metadata.segment_transcript_file_path(idx))
+            for idx in range(len(transcript_metadata.transcribe_segments))
+        )
+        for item in merge_segment_items(segments, transcript_metadata.transcribe_segments):
+            merged.add(item)
+            yield item
+
+    @staticmethod
+    def open_merged_transcript(transcript_metadata: Transcript) -> TranscriptFileWriter:
+        """Starts the merged transcript of a split recording, in a temporary file the caller closes.
+
+        :param transcript_metadata: The metadata of a transcript with transcribe_segments.
+        :type transcript_metadata: Transcript
+        :rtype: TranscriptFileWriter
+        """
+        return TranscriptFileWriter(transcript_metadata.request_id.hex)
+
+    def save_merged_transcript(self, transcript_metadata: Transcript, merged: TranscriptFileWriter) -> str:
+        """Writes the merged transcript where a single transcribe job would have, in the same format, for
+        re-analyses, the transcript url and the reuse by later submissions of the same recording.
+
+        Its s3 event triggers this function again, the analysis of a transcript with transcribe_segments skips it.
+
+        :param transcript_metadata: The metadata of a transcript with transcribe_segments.
+        :type transcript_metadata: Transcript
+        :param merged: The merged items, all written (see get_merged_transcript_items).
+        :type merged: TranscriptFileWriter
+        :return: The key of the merged transcript.
+        :rtype: str
+        """
+        self.s3_service.upload_file(
+            self.s3_bucket, transcript_metadata.transcript_file_path, merged.finish(), 'application/json'
+        )
+        return transcript_metadata.transcript_file_path
+
+    def stage_timer(self, transcript_metadata: Transcript) -> StageTimer:
+        """Times the stages of the analysis into the transcript's stage_timings, emitting them as metrics.
+
+        :param transcript_metadata: The metadata of the analysed transcript.
+        :type transcript_metadata: Transcript
+        :rtype: StageTimer
+        """
+        return StageTimer(transcript_metadata.stage_timings, on_stage=add_stage_metric)
+
+    def add_transcript_waits(self, timer: StageTimer, transcript_metadata: Transcript, event_time: str) -> None:
+        """Adds the duration of the Transcribe job and the wait for this invocation, given the time the transcript
+        was created at (the s3 event time).
+
+        :param timer: The timer of the transcript's stages.
+        :type timer: StageTimer
+        :param transcript_metadata: The metadata of the analysed transcript.
+        :type transcript_metadata: Transcript
+        :param event_time: The time of the s3 event, e.g. 2024-01-01T00:00:00.000Z
+        :type event_time: str
+        """
+        created = datetime.fromisoformat(event_time.replace('Z', '+00:00')).timestamp() * 1000
+        # Recorded by process_audio, missing for reused transcripts.
+        transcribe_started = transcript_metadata.stage_timings.pop('transcribe_started_at', None)
+        if transcribe_started is not None:
+            timer.add('transcribe', created - transcribe_started)
+        timer.add('transcript_queue', time.time() * 1000 - created)
 
     def get_transcript_metadata(self, request_id: str) -> Transcript:
         """Loads transcript metadata model from dynamo db.
@@ -34,60 +238,110 @@ class AnalyseTrascriptHelper(object):
         """
         return self.transcript_storage_service.get_transcript(request_id)
 
-    def analyse_transcript(self, transcript_data: dict, transcript_metadata: Transcript) -> Transcript:
+    def get_transcripts_metadata(self, request_ids: Iterable[str]) -> Dict[str, Transcript]:
+        """Loads the metadata of many transcripts from dynamo db in batches.
+
+        :param request_ids: The request ids of the transcript analysis requests.
+        :type request_ids: Iterable[str]
+        :return: The metadata objects keyed by request_id.
+        :rtype: Dict[str, Transcript]
+        """
+        return self.transcript_storage_service.get_transcripts(request_ids)
+
+    def analyse_transcript(
+            self,
+            transcript_items: Iterable[dict],
+            transcript_metadata: Transcript,
+            timer: StageTimer = None) -> Transcript:
         """Performs the search on the transcript's items (words) for the requested sentences.
 
-        :param transcript_data: The transcript returned from Transcribe.
-        :type transcript_data: dict
+        :param transcript_items: The items of the transcript returned from Transcribe.
+        :type transcript_items: Iterable[dict]
         :param transcript_metadata: The metadata of the search request.
         :type transcript_metadata: Transcript
+        :param timer: Times the analysis and indexing stages, excluding the time spent producing the items
+            (e.g. when they're timed as transcript_fetch by the same timer).
+        :type timer: StageTimer
         :return: Transcript with matches updated.
         :rtype: Transcript
         """
-        transcript_items = transcript_data.get('results', {}).get('items', [])
-        words_found_counters = [0] * len(transcript_metadata.sentences)
-
-        # So we don't have to do this transformation on every iteration,
-        # let's generate lists of words for each sentence
-        sentence_words = [sentence.plain_text.split(' ') for sentence in transcript_metadata.sentences]
-
-        # This could be done more elegantly with something like elasticsearch/opensearch
-        # But this implementation should work fine for the demo, and not be very slow as it will only iterate
-        # over all the words of the transcript once and find all matching sentences while doing so.
-        for idx, item in enumerate(transcript_items):
-            # Only use the first alternative as it's highest confidence
-            word_in_transcript = item['alternatives'][0]['content']
-            for sentence_idx, _ in enumerate(transcript_metadata.sentences):
-                current_sentence_counter = words_found_counters[sentence_idx]
-                # Case insensitive match
-                if sentence_words[sentence_idx][current_sentence_counter].lower() == word_in_transcript.lower():
-                    # We found a correct word, increase counter to find the next
-                    words_found_counters[sentence_idx] += 1
-                else:
-                    # Reset counter as words are not matching
-                    words_found_counters[sentence_idx] = 0
-
-                if len(sentence_words[sentence_idx]) == words_found_counters[sentence_idx]:
-                    # We found all the words that are in the sentence, we need to set the sentence as found
-                    # Also add the indices
-                    transcript_metadata.sentences[sentence_idx].was_present = True
-                    transcript_metadata.sentences[sentence_idx].start_word_index = idx - len(sentence_words[sentence_idx])
-                    transcript_metadata.sentences[sentence_idx].end_word_index = idx
-
-                    # This is to reset the words found counter for the index.
-                    # This means it will only find the last occurrence
-                    words_found_counters[sentence_idx] = 0
+        timer = timer or StageTimer()
+        analyzer = TranscriptAnalyzer(
+            transcript_metadata.sentences,
+            transcript_metadata.analysis_options,
+            self.tokenizer
+        )
+        # Transcripts reused from another request are already indexed under that request.
+        index = self.search_index_enabled and not transcript_metadata.source_request_id
+        with timer.stage('analysis'):
+            stream = analyzer.analyse(transcript_items, grow_vocabulary=index)
+        metrics.add_metric(name='transcript_words', unit=MetricUnit.Count, value=len(stream))
+        metrics.add_metric(name='sentences', unit=MetricUnit.Count, value=len(transcript_metadata.sentences))
+        if index:
+            with timer.stage('search_index'):
+                self.indexed_shards.update(self.search_index_service.index_transcript(
+                    transcript_metadata.request_id.hex,
+                    build_postings(stream, analyzer.vocabulary)
+                ))
 
         return transcript_metadata
 
-    def save_analysis_results(self, transcript_metadata: Transcript, transcript_path: str) -> None:
-        """Saves the transcript, also saves the status and the transcripts result path.
+    def compact_search_index(self, holder: str) -> None:
+        """Compacts one of the search index shards the analyses wrote to, if it has enough segments.
 
-        :param transcript_metadata: _description_
+        :param holder: Who compacts, the aws_request_id of the invocation.
+        :type holder: str
+        """
+        merged = self.search_index_service.compact_due_shard(sorted(self.indexed_shards), holder)
+        if merged:
+            metrics.add_metric(name='search_index_compacted_segments', unit=MetricUnit.Count, value=merged)
+
+    def mark_analysis_completed(self, transcript_metadata: Transcript, transcript_path: str) -> None:
+        """Sets the status and the transcript's result path, once the sentences were searched.
+
+        :param transcript_metadata: The metadata of the analysed transcript.
         :type transcript_metadata: Transcript
-        :param transcript_path: _description_
+        :param transcript_path: The key of the transcribe results.
         :type transcript_path: str
         """
         transcript_metadata.status = TranscriptStatus.COMPLETED
         transcript_metadata.transcript_path = transcript_path
-        self.transcript_storage_service.put_transcript(transcript_metadata)
+
+    def save_results_document(self, transcript_metadata: Transcript) -> None:
+        """Writes the detailed sentence results to their (gzipped) s3 document, the dynamo item keeps a summary.
+
+        :param transcript_metadata: The analysed transcript.
+        :type transcript_metadata: Transcript
+        """
+        transcript_metadata.results_summary = ResultsSummary.from_sentences(transcript_metadata.sentences)
+        self.s3_service.write_json_file(
+            self.s3_bucket,
+            transcript_metadata.results_file_path,
+            transcript_metadata.as_results_document(),
+            compress=True
+        )
+        transcript_metadata.results_path = transcript_metadata.results_file_path
+
+    def save_analysis_results(self, transcripts_metadata: List[Transcript]) -> None:
+        """Saves the analysed transcripts: the results documents first, then the metadata in as few dynamo round
+        trips as possible (so a completed status always has its results).
+
+        :param transcripts_metadata: The transcripts marked as completed.
+        :type transcripts_metadata: List[Transcript]
+        """
+        for transcript_metadata in transcripts_metadata:
+            timer = self.stage_timer(transcript_metadata)
+            with timer.stage('results_save'):
+                self.save_results_document(transcript_metadata)
+            timer.add('end_to_end', (datetime.now() - transcript_metadata.created).total_seconds() * 1000)
+        self.transcript_storage_service.put_transcripts(transcripts_metadata)
+
+    def notify_analysis_completed(self, transcripts_metadata: List[Transcript]) -> Dict[str, str]:
+        """Publishes the completion events (notification queue and callbacks) of the saved transcripts.
+
+        :param transcripts_metadata: The transcripts that were saved as completed.
+        :type transcripts_metadata: List[Transcript]
+        :return: The notifications that could not be delivered, keyed by request_id.
+        :rtype: Dict[str, str]
+        """
+        return self.notification_service.notify(transcripts_metadata)
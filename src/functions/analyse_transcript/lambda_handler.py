@@ -2,30 +2,100 @@ from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.data_classes import S3Event
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
-from analyse_transcript_helper import AnalyseTrascriptHelper
+from analyse_transcript_helper import AnalyseTrascriptHelper, metrics
+from services.profiler import profiled
 
 logger: Logger = Logger(service='analyse_transcript')
 
 
+def event_request_ids(event: dict) -> list:
+    # transcripts/<request_id>/transcript.json
+    return [record['s3']['object']['key'].split('/')[1] for record in event.get('Records', [])]
+
+
+@metrics.log_metrics
 @logger.inject_lambda_context(log_event=True)
+@profiled('analyse_transcript', event_request_ids)
 def lambda_handler(event: dict, ctx: LambdaContext):
     event_obj = S3Event(event)
     helper = AnalyseTrascriptHelper()
-    for record in event_obj.records:
-        # Path of the transcript
-        transcript_path: str = record.s3.get_object.key
-        # Extract request_id from transcript path
-        request_id = transcript_path.split('/')[1]
-        print(request_id)
-        # Load transcript and metadata
-        logger.info(f'Loading transcript for request_id: {request_id}')
-        transcript = helper.get_transcript_results(transcript_path)
-        transcript_metadata = helper.get_transcript_metadata(request_id=request_id)
-
-        # Find sentences
-        logger.info(f'Processing for request_id: {request_id}')
-        solved_transcript_metadata = helper.analyse_transcript(transcript, transcript_metadata)
-
-        # Save results
-        logger.info(f'Saving results for request_id: {request_id}')
-        helper.save_analysis_results(solved_transcript_metadata, transcript_path)
+
+    # Record of every transcript, keyed by the request_id extracted from its path
+    records = {record.s3.get_object.key.split('/')[1]: record for record in event_obj.records}
+    # Load the metadata of all the records at once
+    logger.info(f'Loading metadata for request_ids: {list(records)}')
+    transcripts_metadata = helper.get_transcripts_metadata(records.keys())
+
+    # The transcribe jobs that wrote these transcripts are done, their admission is given back before the analysis.
+    # Once per job: a retried invocation finds them recorded as given back (a slot lost to a failure in between is
+    # given back by the admission's reconciliation).
+    helper.release_transcribe_jobs(sum(
+        helper.claim_transcribe_job_release(transcripts_metadata[request_id], record.s3.get_object.key)
+        for request_id, record in records.items()
+        if request_id in transcripts_metadata
+    ))
+
+    solved_transcripts_metadata = []
+    for request_id, record in records.items():
+        transcript_metadata = transcripts_metadata.get(request_id)
+        if not transcript_metadata:
+            logger.warning(f'No metadata found for request_id: {request_id}!')
+            continue
+        transcript_path = record.s3.get_object.key
+        merged_transcript = None
+        if transcript_metadata.transcribe_segments:
+            # Split recordings are analysed once all their segments are transcribed, by the invocation that claims
+            # the merge. The merged transcript it writes triggers this function again.
+            if transcript_path == transcript_metadata.transcript_file_path:
+                continue
+            if not helper.segment_transcripts_ready(transcript_metadata):
+                logger.info(f'Waiting for the other segments of request_id: {request_id}')
+                continue
+            # The claim expires with this invocation, so a later delivery can take over if it times out.
+            if not helper.claim_segment_merge(
+                    transcript_metadata, ctx.aws_request_id, ctx.get_remaining_time_in_millis() / 1000):
+                logger.info(f'Segments of request_id: {request_id} are merged by another invocation')
+                continue
+            merged_transcript = helper.open_merged_transcript(transcript_metadata)
+        timer = helper.stage_timer(transcript_metadata)
+        helper.add_transcript_waits(timer, transcript_metadata, record.event_time)
+
+        try:
+            # Load transcript, it's streamed while the sentences are searched
+            logger.info(f'Loading transcript for request_id: {request_id}')
+            if merged_transcript is None:
+                transcript_items = helper.get_transcript_items(transcript_path)
+            else:
+                transcript_items = helper.get_merged_transcript_items(transcript_metadata, merged_transcript)
+            transcript_items = timer.timed(transcript_items, 'transcript_fetch')
+
+            # Find sentences
+            logger.info(f'Processing for request_id: {request_id}')
+            solved_transcript_metadata = helper.analyse_transcript(transcript_items, transcript_metadata, timer)
+            if merged_transcript is not None:
+                with timer.stage('transcript_save'):
+                    transcript_path = helper.save_merged_transcript(transcript_metadata, merged_transcript)
+        except Exception:
+            if merged_transcript is not None:
+                # Any delivery (e.g. the retry of this invocation) can merge them again right away.
+                helper.release_segment_merge(transcript_metadata, ctx.aws_request_id)
+            raise
+        finally:
+            if merged_transcript is not None:
+                merged_transcript.close()
+        helper.mark_analysis_completed(solved_transcript_metadata, transcript_path)
+        solved_transcripts_metadata.append(solved_transcript_metadata)
+
+    # Save results
+    logger.info(f'Saving results for {len(solved_transcripts_metadata)} request(s)')
+    helper.save_analysis_results(solved_transcripts_metadata)
+
+    # Let the requesters know, instead of them polling for the results
+    for request_id, error in helper.notify_analysis_completed(solved_transcripts_metadata).items():
+        logger.warning(f'Failed to notify completion of request_id: {request_id}! Details: {error}')
+
+    # Once the requesters know, a failed compaction doesn't fail the analysis (a later one compacts the shard).
+    try:
+        helper.compact_search_index(ctx.aws_request_id)
+    except Exception as exc:
+        logger.warning(f'Failed to compact the search index! Details: {str(exc)}')
@@ -1,8 +1,36 @@
-from models.transcript import Transcript, TranscriptStatus
+import math
+import os
+import random
+import time
+import wave
+from decimal import Decimal
+from typing import Dict, Iterable, List
+from uuid import UUID
+
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+from models.transcript import FileType, Transcript, TranscriptStatus
+from services.audio_index_service import CONTENT_INDEX, URL_INDEX, AudioIndexService
+from services.audio_probe import probe_audio
+from services.audio_splitter import WavSplitter, segment_bounds
+from services.notification_service import NotificationService
 from services.s3_service import S3Service
+from services.sqs_service import SQSService
+from services.stage_timer import StageTimer
+from services.transcribe_admission_service import TranscribeAdmissionService, TranscribeDeferred
 from services.transcribe_service import TranscribeService
 from services.transcript_storage_service import TranscriptStorageService
 
+# Embedded metric format, flushed by the handler (namespace from POWERTOOLS_METRICS_NAMESPACE).
+metrics: Metrics = Metrics(service='process_audio')
+# How long an invocation waits for the start rate to admit its transcribe jobs before deferring them.
+ADMISSION_MAX_SLEEP_SECONDS = 2
+
+
+def add_stage_metric(name: str, milliseconds: float) -> None:
+    metrics.add_metric(name=name, unit=MetricUnit.Milliseconds, value=milliseconds)
+
 
 class AudioProcessingHelper(object):
 
@@ -10,8 +38,32 @@ class AudioProcessingHelper(object):
         self.transcripts_service = TranscriptStorageService(ddb_table=ddb_table)
         self.s3_service = S3Service()
         self.transcribe_service = TranscribeService()
+        self.audio_index_service = AudioIndexService(s3_bucket, self.s3_service)
+        self.notification_service = NotificationService(os.environ.get('NOTIFICATION_QUEUE_URL'))
         self.s3_bucket = s3_bucket
-
+        self.transfer_part_size = int(os.environ.get('AUDIO_TRANSFER_PART_SIZE_MB', '8')) * 1024 * 1024
+        self.transfer_concurrency = int(os.environ.get('AUDIO_TRANSFER_CONCURRENCY', '4'))
+        # WAV recordings longer than TRANSCRIBE_SEGMENT_MIN_SECONDS are transcribed in parallel, in segments of
+        # TRANSCRIBE_SEGMENT_SECONDS (0 turns it off) overlapping by TRANSCRIBE_SEGMENT_OVERLAP_SECONDS.
+        self.segment_seconds = float(os.environ.get('TRANSCRIBE_SEGMENT_SECONDS', '0'))
+        self.segment_overlap_seconds = float(os.environ.get('TRANSCRIBE_SEGMENT_OVERLAP_SECONDS', '15'))
+        self.segment_min_seconds = float(os.environ.get('TRANSCRIBE_SEGMENT_MIN_SECONDS', '1800'))
+        # With TRANSCRIBE_ADMISSION_TABLE set, transcribe jobs are only started within the account's quotas:
+        # TRANSCRIBE_MAX_CONCURRENT_JOBS running at once, TRANSCRIBE_START_RATE started per second (in bursts of
+        # TRANSCRIBE_START_BURST). Messages over them are deferred, TRANSCRIBE_DEFER_BASE_SECONDS the first time,
+        # doubling up to TRANSCRIBE_DEFER_MAX_SECONDS.
+        admission_table = os.environ.get('TRANSCRIBE_ADMISSION_TABLE')
+        self.admission_service = TranscribeAdmissionService(
+            admission_table,
+            self.transcribe_service,
+            max_jobs=int(os.environ.get('TRANSCRIBE_MAX_CONCURRENT_JOBS', '250')),
+            start_rate=float(os.environ.get('TRANSCRIBE_START_RATE', '10')),
+            start_burst=float(os.environ.get('TRANSCRIBE_START_BURST', '10'))
+        ) if admission_table else None
+        self.sqs_service = SQSService()
+        self.audio_queue_url = os.environ.get('AUDIO_TRANSCRIBE_QUEUE_URL')
+        self.defer_base_seconds = int(os.environ.get('TRANSCRIBE_DEFER_BASE_SECONDS', '5'))
+        self.defer_max_seconds = int(os.environ.get('TRANSCRIBE_DEFER_MAX_SECONDS', '120'))
 
     def get_transcript_metadata(self, request_id: str) -> Transcript:
         """Gets the transcript record from ddb.
@@ -23,38 +75,359 @@ class AudioProcessingHelper(object):
         """
         return self.transcripts_service.get_transcript(request_id)
 
-    def transfer_audio_file(self, transcript: Transcript) -> str:
+    def get_transcripts_metadata(self, request_ids: Iterable[str]) -> Dict[str, Transcript]:
+        """Gets the transcript records of many requests from ddb in batches.
+
+        :param request_ids: The ids of the requests.
+        :type request_ids: Iterable[str]
+        :return: The transcript objects keyed by request_id.
+        :rtype: Dict[str, Transcript]
+        """
+        return self.transcripts_service.get_transcripts(request_ids)
+
+    def stage_timer(self, transcript: Transcript) -> StageTimer:
+        """Times the stages of the processing into the transcript's stage_timings, emitting them as metrics.
+
+        :param transcript: The transcript object containing metadata about the request.
+        :type transcript: Transcript
+        :rtype: StageTimer
+        """
+        return StageTimer(transcript.stage_timings, on_stage=add_stage_metric)
+
+    def transfer_audio_file(self, transcript: Transcript, timer: StageTimer = None) -> str:
         """Copies the file from the given url into our bucket for processing with transcribe.
 
+        The first bytes are probed before anything is uploaded: the actual format, duration and sample rate are
+        set on the transcript, files that are not WAV/MP3 audio raise an AudioProbeError.
+
         :param transcript: The transcript object containing metadata about the request.
         :type transcript: Transcript
+        :param timer: Times the transfer as the audio_download stage.
+        :type timer: StageTimer
         :return: The path of the audio file
         :rtype: str
         """
-        self.s3_service.copy_audio_file_from_url(
+        def inspect(head: bytes, size: int, read_range) -> None:
+            info = probe_audio(head, size, read_range)
+            transcript.media_format = info.media_format
+            transcript.audio_duration = Decimal(f'{info.duration:.3f}') if info.duration is not None else None
+            transcript.audio_sample_rate = info.sample_rate
+
+        started = time.perf_counter()
+        size = self.s3_service.copy_audio_file_from_url(
             url=transcript.audio_url,
             bucket=self.s3_bucket,
-            s3_key=transcript.audio_file_path
+            s3_key=transcript.audio_file_path,
+            part_size=self.transfer_part_size,
+            concurrency=self.transfer_concurrency,
+            inspect=inspect
         )
+        elapsed = time.perf_counter() - started
 
+        if timer:
+            timer.add('audio_download', elapsed * 1000)
+        metrics.add_metric(name='audio_download_bytes', unit=MetricUnit.Bytes, value=size)
+        if elapsed > 0:
+            metrics.add_metric(name='audio_download_throughput', unit=MetricUnit.BytesPerSecond, value=size / elapsed)
+        if transcript.audio_duration is not None:
+            metrics.add_metric(name='audio_duration', unit=MetricUnit.Seconds, value=float(transcript.audio_duration))
         return transcript.audio_file_path
 
-    def start_transcribe_task(self, transcript: Transcript) -> str:
-        """Will perform an audio transcription using aws Transcribe.
+    def get_source_fingerprint(self, transcript: Transcript) -> str:
+        """Identifies the audio by its url and the version the server reports for it (None if it reports none).
 
-        :param transcript: The metadata object containing the transcription request.
+        :param transcript: The transcript object containing metadata about the request.
         :type transcript: Transcript
-        :return: The id used to determine the status of the transcribe job.
         :rtype: str
         """
-        # We're only using one bucket.
-        self.transcribe_service.start_transcribe_job(transcript, self.s3_bucket, self.s3_bucket)
+        version = self.s3_service.get_url_version(transcript.audio_url)
+        return f'{transcript.audio_url}\n{version}' if version else None
 
-    def set_transcript_request_failed(self, transcript: Transcript) -> None:
-        """Will mark the status of the transcript as failed and save to dynamodb.
+    def get_audio_fingerprint(self, transcript: Transcript) -> str:
+        """Identifies the audio by the content of our copy (must be called after transfer_audio_file).
 
-        :param transcript: The transcript that failed to process the audio file.
+        :param transcript: The transcript object containing metadata about the request.
         :type transcript: Transcript
+        :rtype: str
         """
-        transcript.status = TranscriptStatus.FAILED
+        return self.s3_service.get_object_fingerprint(self.s3_bucket, transcript.audio_file_path)
+
+    def find_transcript_by_source(self, source_fingerprint: str) -> dict:
+        """Finds an existing transcript of the same url and version.
+
+        :return: The index entry (request_id and transcript_path), None if there is none.
+        :rtype: dict
+        """
+        return self.audio_index_service.find_transcript(URL_INDEX, source_fingerprint)
+
+    def find_transcript_by_audio(self, audio_fingerprint: str) -> dict:
+        """Finds an existing transcript of the same audio content.
+
+        :return: The index entry (request_id and transcript_path), None if there is none.
+        :rtype: dict
+        """
+        return self.audio_index_service.find_transcript(CONTENT_INDEX, audio_fingerprint)
+
+    def register_transcript(
+            self,
+            source_fingerprint: str,
+            audio_fingerprint: str,
+            request_id: str,
+            transcript_path: str) -> None:
+        """Indexes the transcript under the fingerprints of its audio, so later submissions can reuse it.
+        """
+        self.audio_index_service.register(URL_INDEX, source_fingerprint, request_id, transcript_path)
+        self.audio_index_service.register(CONTENT_INDEX, audio_fingerprint, request_id, transcript_path)
+
+    def link_existing_transcript(self, transcript: Transcript, existing: dict) -> None:
+        """Reuses an existing transcript instead of running transcribe. The transcript is copied to the path of
+        this request, which triggers the analysis just like a finished transcribe job would.
+
+        :param transcript: The transcript object containing metadata about the request.
+        :type transcript: Transcript
+        :param existing: The index entry of the transcript to reuse.
+        :type existing: dict
+        """
+        transcript.source_request_id = UUID(existing['request_id'])
+        metrics.add_metric(name='transcripts_reused', unit=MetricUnit.Count, value=1)
+        # Saved before the copy, the analysis triggered by it must not be overwritten.
         self.transcripts_service.put_transcript(transcript)
+        self.s3_service.copy_object(self.s3_bucket, existing['transcript_path'], transcript.transcript_file_path)
+
+    def check_transcribe_capacity(self) -> None:
+        """Defers the request before its audio is downloaded when as many transcribe jobs as allowed are running.
+
+        :raises TranscribeDeferred: If they are.
+        """
+        if self.admission_service and self.admission_service.check() == math.inf:
+            raise TranscribeDeferred('As many transcribe jobs as allowed are running')
+
+    def planned_transcribe_jobs(self, transcript: Transcript) -> int:
+        """How many transcribe jobs the transcript needs, one per segment if its audio is split.
+
+        :param transcript: The transcript whose audio was transferred and probed.
+        :type transcript: Transcript
+        :rtype: int
+        """
+        if not self.should_split(transcript):
+            return 1
+        # In milliseconds, the splitter counts frames: it may find a segment less, never one more.
+        return len(segment_bounds(
+            int(transcript.audio_duration * 1000),
+            int(self.segment_seconds * 1000),
+            int(self.segment_overlap_seconds * 1000)
+        ))
+
+    def admit_transcribe_jobs(self, transcript: Transcript) -> int:
+        """Waits for the admission of the transcribe jobs of the transcript, for ADMISSION_MAX_SLEEP_SECONDS at most.
+
+        :param transcript: The transcript whose audio was transferred and probed.
+        :type transcript: Transcript
+        :return: How many jobs were admitted.
+        :rtype: int
+        :raises TranscribeDeferred: If they weren't admitted in time.
+        """
+        jobs = self.planned_transcribe_jobs(transcript)
+        if not self.admission_service:
+            return jobs
+        deadline = time.monotonic() + ADMISSION_MAX_SLEEP_SECONDS
+        while True:
+            wait = self.admission_service.acquire(jobs)
+            if not wait:
+                return jobs
+            if wait == math.inf:
+                raise TranscribeDeferred('As many transcribe jobs as allowed are running')
+            if time.monotonic() + wait > deadline:
+                raise TranscribeDeferred(f'Over the transcribe start rate for {wait:.1f}s', wait)
+            time.sleep(wait)
+
+    def release_transcribe_jobs(self, jobs: int) -> None:
+        """Gives back the admission of transcribe jobs that weren't started.
+
+        :param jobs: How many jobs.
+        :type jobs: int
+        """
+        if self.admission_service and jobs > 0:
+            self.admission_service.release(jobs)
+
+    def start_transcribe_task(self, transcript: Transcript, timer: StageTimer = None, admitted: int = 0) -> int:
+        """Will perform an audio transcription using aws Transcribe, split in segments transcribed in parallel for
+        long recordings (see split_transcribe_task).
+
+        :param transcript: The metadata object containing the transcription request.
+        :type transcript: Transcript
+        :param timer: Times the splitting of the audio as the audio_split stage.
+        :type timer: StageTimer
+        :param admitted: How many jobs were admitted for it (see admit_transcribe_jobs), the ones that aren't
+            started are given back.
+        :type admitted: int
+        :return: How many transcribe jobs were started.
+        :rtype: int
+        :raises TranscribeDeferred: If transcribe refused a job because of its limits.
+        """
+        try:
+            jobs = self.split_transcribe_task(transcript, timer or StageTimer()) if self.should_split(transcript) else 0
+            if not jobs:
+                try:
+                    # We're only using one bucket.
+                    self.transcribe_service.start_transcribe_job(transcript, self.s3_bucket, self.s3_bucket)
+                except self.transcribe_service.transcribe_client.exceptions.ConflictException:
+                    # Started by an earlier delivery of the message.
+                    pass
+                jobs = 1
+        except Exception as exc:
+            # All of them: the next delivery is admitted again for the jobs this one started.
+            self.release_transcribe_jobs(admitted)
+            if isinstance(exc, self.transcribe_service.transcribe_client.exceptions.LimitExceededException):
+                # Throttled despite the admission, e.g. by jobs of other workloads of the account.
+                raise TranscribeDeferred(f'Transcribe refused the job: {exc}') from exc
+            raise
+        self.release_transcribe_jobs(admitted - jobs)
+        # Epoch milliseconds, the analysis turns it into the duration of the job.
+        transcript.stage_timings['transcribe_started_at'] = int(time.time() * 1000)
+        return jobs
+
+    def should_split(self, transcript: Transcript) -> bool:
+        """Whether the recording is long enough to be transcribed in segments (only WAV files can be split).
+
+        :param transcript: The transcript whose audio was transferred and probed.
+        :type transcript: Transcript
+        :rtype: bool
+        """
+        return (
+            self.segment_seconds > 0
+            and transcript.media_format == FileType.WAV
+            and transcript.audio_duration is not None
+            and float(transcript.audio_duration) > max(self.segment_min_seconds, self.segment_seconds)
+        )
+
+    def split_transcribe_task(self, transcript: Transcript, timer: StageTimer) -> int:
+        """Splits the audio file into overlapping segments and starts a transcribe job per segment, as soon as the
+        segment is uploaded. The analysis merges their transcripts once they all finished.
+
+        The bounds of the segments are saved on the transcript before any job is started, the analysis of the
+        first finished segment needs them.
+
+        :param transcript: The transcript whose audio was transferred and probed.
+        :type transcript: Transcript
+        :param timer: Times reading, writing and uploading the segments as the audio_split stage.
+        :type timer: StageTimer
+        :return: How many jobs were started, 0 if the wave module can't read the file (it's transcribed whole).
+        :rtype: int
+        """
+        audio = self.s3_service.open_file(self.s3_bucket, transcript.audio_file_path)
+        try:
+            with timer.stage('audio_split'):
+                try:
+                    splitter = WavSplitter(
+                        audio,
+                        self.segment_seconds,
+                        self.segment_overlap_seconds,
+                        float(transcript.audio_duration)
+                    )
+                except (wave.Error, EOFError):
+                    # e.g. WAVE_FORMAT_EXTENSIBLE or compressed audio
+                    return 0
+                transcript.transcribe_segments = splitter.bounds_seconds()
+                self.transcripts_service.put_pending_attributes(transcript, ('transcribe_segments',))
+                for idx, segment_file in splitter.iter_segments():
+                    self.s3_service.upload_file(
+                        self.s3_bucket, transcript.segment_audio_file_path(idx), segment_file, 'audio/wav'
+                    )
+                    with timer.stage('transcribe_submit'):
+                        try:
+                            self.transcribe_service.start_transcribe_job(
+                                transcript, self.s3_bucket, self.s3_bucket, segment=idx
+                            )
+                        except self.transcribe_service.transcribe_client.exceptions.ConflictException:
+                            # Started by an earlier delivery of the message.
+                            pass
+        finally:
+            audio.close()
+        metrics.add_metric(name='transcribe_segments', unit=MetricUnit.Count, value=len(splitter.bounds))
+        return len(splitter.bounds)
+
+    def defer_message(self, receipt_handle: str, deferrals: int, retry_after: float = 0) -> int:
+        """Hides the message of a request whose transcribe jobs were deferred until it's worth retrying it:
+        exponential backoff with jitter, so the deferred messages don't all come back at once.
+
+        :param receipt_handle: The receipt handle of the message.
+        :type receipt_handle: str
+        :param deferrals: How many times the message was deferred before.
+        :type deferrals: int
+        :param retry_after: The least time before the jobs could be admitted, seconds.
+        :type retry_after: float
+        :return: The visibility timeout given to the message, seconds.
+        :rtype: int
+        """
+        backoff = min(self.defer_base_seconds * 2 ** min(deferrals, 16), self.defer_max_seconds)
+        # Full jitter, in the whole seconds of a visibility timeout: they come back spread over the backoff and the
+        # slots of the jobs that finish are taken soon.
+        delay = max(math.ceil(retry_after), random.randint(1, max(backoff, 1)))
+        self.sqs_service.change_message_visibility(self.audio_queue_url, receipt_handle, delay)
+        metrics.add_metric(name='transcribe_deferred', unit=MetricUnit.Count, value=1)
+        return delay
+
+    def save_audio_details(self, transcript: Transcript) -> None:
+        """Stores the probed audio details of a transcript whose jobs were deferred, once its audio was transferred:
+        the next delivery doesn't transfer it again.
+
+        :param transcript: The transcript whose transcribe jobs were deferred.
+        :type transcript: Transcript
+        """
+        self.transcripts_service.put_pending_attributes(
+            transcript, ('media_format', 'audio_duration', 'audio_sample_rate')
+        )
+
+    def count_failed_attempt(self, transcript: Transcript) -> int:
+        """Counts a failed attempt at processing the audio of the transcript.
+
+        :param transcript: The transcript whose processing failed.
+        :type transcript: Transcript
+        :return: How many attempts failed, this one included.
+        :rtype: int
+        """
+        return self.transcripts_service.add_failed_attempt(transcript.request_id.hex)
+
+    def save_processing_details(self, transcript: Transcript) -> None:
+        """Stores the stage timings and the probed audio details of a transcript whose Transcribe job was started
+        (the transcript is only saved again by the analysis).
+
+        :param transcript: The transcript whose transcribe job was started.
+        :type transcript: Transcript
+        """
+        self.transcripts_service.put_pending_attributes(
+            transcript, ('stage_timings', 'media_format', 'audio_duration', 'audio_sample_rate')
+        )
+
+    def set_transcript_requests_failed(self, transcripts: List[Transcript],
+                                       reasons: Dict[str, str] = None) -> List[Transcript]:
+        """Will mark the status of many transcripts as failed in dynamodb, unless they aren't pending anymore.
+
+        Only the status and the failure reason are written, a transcript the analysis completed in the meantime (its
+        job was started by an earlier delivery) keeps its results.
+
+        :param transcripts: The transcripts that failed to process their audio file.
+        :type transcripts: List[Transcript]
+        :param reasons: Why they failed, keyed by request_id.
+        :type reasons: Dict[str, str]
+        :return: The transcripts that were marked as failed.
+        :rtype: List[Transcript]
+        """
+        failed = []
+        for transcript in transcripts:
+            transcript.status = TranscriptStatus.FAILED
+            transcript.failure_reason = (reasons or {}).get(transcript.request_id.hex)
+            if self.transcripts_service.put_pending_attributes(transcript, ('status', 'failure_reason')):
+                failed.append(transcript)
+        return failed
+
+    def notify_requests_failed(self, transcripts: List[Transcript]) -> Dict[str, str]:
+        """Publishes the failure events (notification queue and callbacks) of the transcripts marked as failed.
+
+        :param transcripts: The transcripts that were saved as failed.
+        :type transcripts: List[Transcript]
+        :return: The notifications that could not be delivered, keyed by request_id.
+        :rtype: Dict[str, str]
+        """
+        return self.notification_service.notify(transcripts)
@@ -1,36 +1,175 @@
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.data_classes import SQSEvent
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from audio_processing_helper import AudioProcessingHelper
+from audio_processing_helper import AudioProcessingHelper, metrics
 
 from models.transcript import Transcript
-from services.transcript_storage_service import TranscriptStorageService
+from services.audio_probe import AudioProbeError
+from services.profiler import profiled
+from services.transcribe_admission_service import TranscribeDeferred
 
 logger: Logger = Logger(service='process_audio')
 
+# How many records of a batch are transferred/submitted to transcribe at the same time.
+CONCURRENCY = int(os.environ.get('PROCESS_AUDIO_CONCURRENCY', '5'))
+# After this many failed deliveries a message is given up on and its transcript marked as FAILED. Deliveries
+# deferred for the transcribe quota don't count.
+MAX_RECEIVE_COUNT = int(os.environ.get('PROCESS_AUDIO_MAX_RECEIVE_COUNT', '3'))
+# Requests still deferred this long after their message was sent fail, before the queue's retention drops them.
+MAX_DEFER_SECONDS = int(os.environ.get('PROCESS_AUDIO_MAX_DEFER_SECONDS', '86400'))
 
+
+def process_transcript(file_processing_helper: AudioProcessingHelper, transcript: Transcript, sent_at: int) -> None:
+    request_id = transcript.request_id.hex
+    timer = file_processing_helper.stage_timer(transcript)
+    # sent_at is the SentTimestamp (epoch milliseconds) of the message.
+    timer.add('audio_queue', time.time() * 1000 - sent_at)
+
+    # Repeat submissions of the same recording reuse its transcript and go straight to analysis.
+    with timer.stage('audio_lookup'):
+        source_fingerprint = file_processing_helper.get_source_fingerprint(transcript)
+        existing = file_processing_helper.find_transcript_by_source(source_fingerprint)
+    audio_fingerprint = None
+    if not existing:
+        # Otherwise the audio was transferred by a delivery deferred for the transcribe quota.
+        if transcript.media_format is None:
+            # Before the download, so messages over the quota aren't downloaded on every delivery.
+            file_processing_helper.check_transcribe_capacity()
+            logger.info(f'Transfering audio file for {request_id}!')
+            file_processing_helper.transfer_audio_file(transcript, timer)
+        with timer.stage('audio_lookup'):
+            audio_fingerprint = file_processing_helper.get_audio_fingerprint(transcript)
+            existing = file_processing_helper.find_transcript_by_audio(audio_fingerprint)
+
+    if existing:
+        logger.info(f'Reusing transcript of {existing["request_id"]} for {request_id}!')
+        file_processing_helper.link_existing_transcript(transcript, existing)
+        file_processing_helper.register_transcript(
+            source_fingerprint, None, existing['request_id'], existing['transcript_path']
+        )
+        return
+
+    logger.info(f'Audio file transfer complete for {request_id}! Starting transcribe job.')
+    with timer.stage('transcribe_admission'):
+        admitted = file_processing_helper.admit_transcribe_jobs(transcript)
+    with timer.stage('transcribe_submit'):
+        jobs = file_processing_helper.start_transcribe_task(transcript, timer, admitted)
+    if jobs > 1:
+        logger.info(f'Audio of {request_id} ({transcript.audio_duration}s) split into {jobs} segments!')
+    # A split recording's transcript is written there once its segments are merged.
+    file_processing_helper.register_transcript(
+        source_fingerprint, audio_fingerprint, request_id, transcript.transcript_file_path
+    )
+    file_processing_helper.save_processing_details(transcript)
+    logger.info(f'Successfully transcribe job for {request_id}')
+
+
+def defer_transcript(
+        file_processing_helper: AudioProcessingHelper,
+        transcript: Transcript,
+        record: SQSRecord,
+        exc: TranscribeDeferred) -> None:
+    request_id = transcript.request_id.hex
+    deferrals = int(record.attributes.approximate_receive_count) - 1
+    try:
+        # The audio is kept for the next delivery, if it was transferred.
+        file_processing_helper.save_audio_details(transcript)
+        delay = file_processing_helper.defer_message(record.receipt_handle, deferrals, exc.retry_after)
+        logger.info(f'Deferred request: {request_id} by {delay}s! Details: {str(exc)}')
+    except Exception as defer_exc:
+        # It's retried after the queue's visibility timeout instead.
+        logger.warning(f'Failed to defer request: {request_id}! Details: {str(defer_exc)}')
+
+
+def count_failed_attempt(
+        file_processing_helper: AudioProcessingHelper,
+        transcript: Transcript,
+        record: SQSRecord) -> int:
+    try:
+        return file_processing_helper.count_failed_attempt(transcript)
+    except Exception as exc:
+        logger.warning(f'Failed to count the failure of request: {transcript.request_id.hex}! Details: {str(exc)}')
+        return int(record.attributes.approximate_receive_count)
+
+
+def event_request_ids(event: dict) -> list:
+    return [json.loads(record['body']).get('request_id') for record in event.get('Records', [])]
+
+
+@metrics.log_metrics
 @logger.inject_lambda_context(log_event=True)
+@profiled('process_audio', event_request_ids)
 def lambda_handler(event: dict, context: LambdaContext):
     event_obj = SQSEvent(event)
     file_processing_helper = AudioProcessingHelper(os.environ.get('TRANSCRIPTS_TABLE'), os.environ.get('TRANSCRIPTS_BUCKET'))
+
+    # This lambda could process multiple files at once.
+    records: dict[str, SQSRecord] = {}
     for record in event_obj.records:
-        # This lambda could process multiple files at once.
         request_id = record.json_body.get('request_id')
-
         if not request_id:
             logger.warning('Received event without a request_id!')
             continue
+        records[request_id] = record
 
-        logger.info(f'Getting transcript info for {request_id}!')
-        transcript: Transcript = file_processing_helper.get_transcript_metadata(request_id=request_id)
+    logger.info(f'Getting transcript info for {list(records)}!')
+    transcripts = file_processing_helper.get_transcripts_metadata(records.keys())
+    for request_id in records.keys() - transcripts.keys():
+        logger.warning(f'No transcript found for request: {request_id}!')
+
+    batch_item_failures = []
+    failed_transcripts = []
+    failure_reasons = {}
+    with ThreadPoolExecutor(max_workers=max(min(CONCURRENCY, len(transcripts)), 1)) as executor:
+        futures = {
+            executor.submit(
+                process_transcript,
+                file_processing_helper,
+                transcript,
+                int(records[request_id].attributes.sent_timestamp)
+            ): request_id
+            for request_id, transcript in transcripts.items()
+        }
+        for future in as_completed(futures):
+            request_id = futures[future]
+            exc = future.exception()
+            if not exc:
+                continue
+
+            record = records[request_id]
+            transcript = transcripts[request_id]
+            expired = False
+            if isinstance(exc, TranscribeDeferred):
+                waited = time.time() - int(record.attributes.sent_timestamp) / 1000
+                expired = waited >= MAX_DEFER_SECONDS
+                if not expired:
+                    defer_transcript(file_processing_helper, transcript, record, exc)
+                    batch_item_failures.append({'itemIdentifier': record.message_id})
+                    continue
+                exc = Exception(f'Transcribe jobs deferred for {int(waited)}s, giving up! Details: {str(exc)}')
 
-        try:
-            logger.info('Transfering audio file!')
-            file_processing_helper.transfer_audio_file(transcript)
-            logger.info('Audio file transfer complete! Starting transcribe job.')
-            file_processing_helper.start_transcribe_task(transcript)
-            logger.info(f'Successfully transcribe job for {transcript.request_id}')
-        except Exception as exc:
             logger.error(f'Failed to process audio file for request: {request_id}! Details: {str(exc)}')
-            file_processing_helper.set_transcript_request_failed(transcript)
+            # Files that are not audio fail right away, retrying would only download them again. So do requests
+            # deferred for too long.
+            if (
+                isinstance(exc, AudioProbeError)
+                or expired
+                or count_failed_attempt(file_processing_helper, transcript, record) >= MAX_RECEIVE_COUNT
+            ):
+                failed_transcripts.append(transcript)
+                failure_reasons[request_id] = str(exc)
+            else:
+                # Only this message goes back to the queue, the rest of the batch is done.
+                batch_item_failures.append({'itemIdentifier': record.message_id})
+
+    if failed_transcripts:
+        failed_transcripts = file_processing_helper.set_transcript_requests_failed(failed_transcripts, failure_reasons)
+        for request_id, error in file_processing_helper.notify_requests_failed(failed_transcripts).items():
+            logger.warning(f'Failed to notify failure of request: {request_id}! Details: {error}')
+
+    return {'batchItemFailures': batch_item_failures}
@@ -1,47 +1,128 @@
 import datetime
+import json
 import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
 from uuid import uuid4
 
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+from analysis.inverted_index import DEFAULT_SHARD_COUNT
+from analysis.tokenizer import Tokenizer
+from analysis.transcript_analyzer import TranscriptAnalyzer
+from models.analysis_options import AnalysisOptions
+from models.results_summary import ResultsSummary
 from models.sentence import Sentence
-from models.transcript import Transcript, FileType
-from services.s3_service import S3Service
-from services.sqs_service import SQSService
+from models.transcript import Transcript, FileType, TranscriptStatus
+from services.s3_service import PRESIGNED_URL_EXPIRES_IN, S3Service
+from services.search_index_service import SearchIndexService
+from services.sqs_service import SEND_BATCH_MAX_MESSAGES, SQSService
+from services.stage_timer import StageTimer
 from services.transcript_storage_service import TranscriptStorageService
 
+# Embedded metric format, flushed by the handler (namespace from POWERTOOLS_METRICS_NAMESPACE).
+metrics: Metrics = Metrics(service='transcripts_api')
+
+
+def add_stage_metric(name: str, milliseconds: float) -> None:
+    metrics.add_metric(name=name, unit=MetricUnit.Milliseconds, value=milliseconds)
+
 
 class AnalysisHelper(object):
     """Helper class for storing analysis requests and registering transcribe tasks on the queue.
+
+    One instance is meant to live as long as the (warm) lambda container. Completed transcripts never change, so
+    they are kept in a bounded TTL cache, and presigned urls are reused until they get close to expiring.
     """
 
-    def __init__(self):
+    def __init__(
+            self,
+            results_cache_ttl: float = None,
+            results_cache_size: int = None,
+            presigned_url_min_validity: float = None):
+        """
+        :param results_cache_ttl: How many seconds a completed transcript is served from memory.
+        :type results_cache_ttl: float
+        :param results_cache_size: How many completed transcripts are kept in memory at most.
+        :type results_cache_size: int
+        :param presigned_url_min_validity: Cached presigned urls are replaced once they are valid for less seconds.
+        :type presigned_url_min_validity: float
+        """
         self.transcript_storage_service: TranscriptStorageService = TranscriptStorageService(os.environ['TRANSCRIPTS_TABLE'])
         self.sqs_service: SQSService = SQSService()
         self.audio_process_queue: str = os.environ.get('AUDIO_TRANSCRIBE_QUEUE_URL')
         self.s3_service: S3Service = S3Service()
+        self.results_cache_ttl = (
+            results_cache_ttl if results_cache_ttl is not None
+            else float(os.environ.get('RESULTS_CACHE_TTL_SECONDS', '300'))
+        )
+        self.results_cache_size = (
+            results_cache_size if results_cache_size is not None
+            else int(os.environ.get('RESULTS_CACHE_SIZE', '256'))
+        )
+        self.presigned_url_min_validity = (
+            presigned_url_min_validity if presigned_url_min_validity is not None
+            else float(os.environ.get('PRESIGNED_URL_MIN_VALIDITY_SECONDS', '300'))
+        )
+        self.search_index_service: SearchIndexService = SearchIndexService(
+            os.environ.get('TRANSCRIPTS_BUCKET'),
+            shard_count=int(os.environ.get('SEARCH_INDEX_SHARDS', DEFAULT_SHARD_COUNT)),
+            s3_service=self.s3_service
+        )
+        # Queries and re-analyses must normalize text exactly like analyse_transcript.
+        self.tokenizer = Tokenizer(json.loads(os.environ.get('TOKEN_EQUIVALENCES', '{}')))
+        # request_id -> (cached until, transcript), least recently used first
+        self._results_cache: 'OrderedDict[str, Tuple[float, Transcript]]' = OrderedDict()
+        # transcript path -> (expires at, url)
+        self._presigned_urls: Dict[str, Tuple[float, str]] = {}
 
     def get_transcript_metadata(self, request_id: str) -> Transcript:
-        """Fetches transcript metadata from dynamo.
+        """Fetches transcript metadata from dynamo, completed transcripts are served from the cache when possible.
 
         :param request_id: The request id for the metadata to fetch.
         :type request_id: str
         :return: The metadata.
         :rtype: Transcript
         """
-        return self.transcript_storage_service.get_transcript(request_id)
+        now = time.monotonic()
+        cached = self._results_cache.get(request_id)
+        if cached and cached[0] > now:
+            self._results_cache.move_to_end(request_id)
+            return cached[1]
 
-    def save_transcript_analysis_request(self, file_url: str, sentences: list[str], extension: str) -> str:
-        """Generates a new Transcript object and stores it.
+        transcript = self.transcript_storage_service.get_transcript(request_id)
+        if transcript and transcript.status == TranscriptStatus.COMPLETED and self.results_cache_size > 0:
+            self._results_cache[request_id] = (now + self.results_cache_ttl, transcript)
+            self._results_cache.move_to_end(request_id)
+            while len(self._results_cache) > self.results_cache_size:
+                self._results_cache.popitem(last=False)
+        else:
+            self._results_cache.pop(request_id, None)
+        return transcript
 
-        :param file_url: The URL path for the wav/mp3.
-        :type file_url: str
-        :param sentences: A list of sentences to be used for searching the transcript.
-        :type sentences: List
-        :param extension: The extension of the file.
-        :type extension: str
-        :return: The request_id used to get status and results.
-        :rtype: str
+    def get_transcript_attributes(self, request_id: str, attributes: Sequence[str]) -> dict:
+        """Fetches only some attributes of the transcript's dynamo item, without building the model.
+
+        :param request_id: The request id for the metadata to fetch.
+        :type request_id: str
+        :param attributes: The names of the attributes to read.
+        :type attributes: Sequence[str]
+        :return: The attributes, None if the request doesn't exist.
+        :rtype: dict
         """
-        transcript: Transcript = Transcript(
+        return self.transcript_storage_service.get_transcript_attributes(request_id, attributes)
+
+    @staticmethod
+    def _new_transcript(
+            file_url: str,
+            sentences: list[str],
+            extension: str,
+            analysis_options: AnalysisOptions,
+            callback_url: str = None) -> Transcript:
+        return Transcript(
             request_id=uuid4(),
             audio_url=file_url,
             sentences=[
@@ -50,11 +131,88 @@ class AnalysisHelper(object):
                 ) for text in sentences
             ],
             file_type=FileType(extension[1:]),
+            analysis_options=analysis_options or AnalysisOptions(),
             created=datetime.datetime.now(),
-            updated=datetime.datetime.now()
+            updated=datetime.datetime.now(),
+            callback_url=callback_url,
+            callback_secret=secrets.token_hex(32) if callback_url else None
         )
-        self.transcript_storage_service.put_transcript(transcript)
-        return transcript.request_id.hex
+
+    def save_transcript_analysis_request(
+            self,
+            file_url: str,
+            sentences: list[str],
+            extension: str,
+            analysis_options: AnalysisOptions = None,
+            callback_url: str = None) -> Transcript:
+        """Generates a new Transcript object and stores it.
+
+        :param file_url: The URL path for the wav/mp3.
+        :type file_url: str
+        :param sentences: A list of sentences to be used for searching the transcript.
+        :type sentences: List
+        :param extension: The extension of the file.
+        :type extension: str
+        :param analysis_options: How the transcript should be searched (occurrence cap, fuzzy matching).
+        :type analysis_options: AnalysisOptions
+        :param callback_url: Where to POST the completion event, a signing secret is generated for it.
+        :type callback_url: str
+        :return: The stored transcript, its request_id is used to get status and results.
+        :rtype: Transcript
+        """
+        transcript: Transcript = self._new_transcript(file_url, sentences, extension, analysis_options, callback_url)
+        with StageTimer(on_stage=add_stage_metric).stage('submit_metadata_write'):
+            self.transcript_storage_service.put_transcript(transcript)
+        metrics.add_metric(name='requests_submitted', unit=MetricUnit.Count, value=1)
+        return transcript
+
+    def save_transcript_analysis_requests(
+            self,
+            entries: List[Tuple[str, list[str], str, str]],
+            analysis_options: AnalysisOptions = None) -> Tuple[List[Transcript], Dict[str, str]]:
+        """Generates a new Transcript object for every entry and stores them with batch writes.
+
+        If the writes fail part way, every request is marked as failed (the ones already written would otherwise
+        stay pending forever) and must not be registered.
+
+        :param entries: The (file url, sentences, extension, callback url) of every request.
+        :type entries: List[Tuple[str, list[str], str, str]]
+        :param analysis_options: How the transcripts should be searched, shared by all of them.
+        :type analysis_options: AnalysisOptions
+        :return: The transcripts, in the order of the entries, and the error of every request that could not be
+            stored, keyed by request_id.
+        :rtype: Tuple[List[Transcript], Dict[str, str]]
+        """
+        transcripts = [
+            self._new_transcript(file_url, sentences, extension, analysis_options, callback_url)
+            for file_url, sentences, extension, callback_url in entries
+        ]
+        try:
+            with StageTimer(on_stage=add_stage_metric).stage('submit_metadata_write'):
+                self.transcript_storage_service.put_transcripts(transcripts)
+        except Exception as exc:
+            error = f'Failed to store the request: {exc}'
+            self._set_transcripts_failed(transcripts, error)
+            return transcripts, {transcript.request_id.hex: error for transcript in transcripts}
+        metrics.add_metric(name='requests_submitted', unit=MetricUnit.Count, value=len(transcripts))
+        return transcripts, {}
+
+    def _set_transcripts_failed(self, transcripts: List[Transcript], reason: str = None) -> None:
+        """Marks requests that can't be processed as failed, best effort: the caller reports them as errors anyway.
+
+        :param transcripts: The requests.
+        :type transcripts: List[Transcript]
+        :param reason: Their failure_reason, None if it is already set on every transcript.
+        :type reason: str
+        """
+        for transcript in transcripts:
+            transcript.status = TranscriptStatus.FAILED
+            if reason is not None:
+                transcript.failure_reason = reason
+        try:
+            self.transcript_storage_service.put_transcripts(transcripts)
+        except Exception:
+            pass
 
     def register_transcribe_task(self, req_id: str) -> None:
         """Will post a sqs message on the transcribe_audio_file queue.
@@ -62,19 +220,126 @@ class AnalysisHelper(object):
         :param req_id: The request id used to identify the request
         :type req_id: str
         """
-        self.sqs_service.send_message(
-            {
-                'request_id': req_id
-            },
-            self.audio_process_queue
-        )
+        with StageTimer(on_stage=add_stage_metric).stage('submit_queue_send'):
+            self.sqs_service.send_message(
+                {
+                    'request_id': req_id
+                },
+                self.audio_process_queue
+            )
+
+    def register_transcribe_tasks(self, transcripts: List[Transcript]) -> Dict[str, str]:
+        """Will post the sqs messages of many requests on the transcribe_audio_file queue, in batches.
+        Requests whose message could not be sent are marked as failed, so they don't stay pending forever.
+
+        :param transcripts: The stored transcripts to process.
+        :type transcripts: List[Transcript]
+        :return: The error of every request that could not be registered, keyed by request_id.
+        :rtype: Dict[str, str]
+        """
+        errors: Dict[int, str] = {}
+        with StageTimer(on_stage=add_stage_metric).stage('submit_queue_send'):
+            # One SendMessageBatch call at a time, so a call that raises only fails its own requests.
+            for start in range(0, len(transcripts), SEND_BATCH_MAX_MESSAGES):
+                chunk = transcripts[start:start + SEND_BATCH_MAX_MESSAGES]
+                try:
+                    chunk_errors = self.sqs_service.send_message_batch(
+                        [{'request_id': transcript.request_id.hex} for transcript in chunk],
+                        self.audio_process_queue
+                    )
+                except Exception as exc:
+                    chunk_errors = {idx: str(exc) for idx in range(len(chunk))}
+                errors.update({start + idx: error for idx, error in chunk_errors.items()})
+        for idx, error in errors.items():
+            transcripts[idx].failure_reason = f'Failed to schedule processing: {error}'
+        if errors:
+            self._set_transcripts_failed([transcripts[idx] for idx in errors])
+        return {transcripts[idx].request_id.hex: error for idx, error in errors.items()}
+
+    def reanalyse_transcript(
+            self,
+            parent: Transcript,
+            sentences: list[str],
+            analysis_options: AnalysisOptions = None) -> Transcript:
+        """Searches the stored transcript of a completed request for new sentences, right away: no audio download
+        and no Transcribe job. The results are stored as a new request, a new version of the parent's results.
+
+        :param parent: The completed request to re-analyse (a re-analysis counts as its own parent).
+        :type parent: Transcript
+        :param sentences: The sentences to search for.
+        :type sentences: list[str]
+        :param analysis_options: How the transcript should be searched.
+        :type analysis_options: AnalysisOptions
+        :return: The completed re-analysis.
+        :rtype: Transcript
+        """
+        root_request_id = parent.parent_request_id or parent.request_id
+        transcript = self._new_transcript(parent.audio_url, sentences, f'.{parent.file_type.value}', analysis_options)
+        transcript.transcript_path = parent.transcript_path
+        transcript.parent_request_id = root_request_id
+        transcript.analysis_version = self.transcript_storage_service.next_analysis_version(root_request_id.hex)
+
+        bucket = os.environ.get('TRANSCRIPTS_BUCKET')
+        timer = StageTimer(transcript.stage_timings, on_stage=add_stage_metric)
+        analyzer = TranscriptAnalyzer(transcript.sentences, transcript.analysis_options, self.tokenizer)
+        transcript_items = self.s3_service.iter_json_array(bucket, transcript.transcript_path, ('results', 'items'))
+        with timer.stage('analysis'):
+            analyzer.analyse(timer.timed(transcript_items, 'transcript_fetch'))
+
+        transcript.status = TranscriptStatus.COMPLETED
+        transcript.results_summary = ResultsSummary.from_sentences(transcript.sentences)
+        with timer.stage('results_save'):
+            self.s3_service.write_json_file(
+                bucket, transcript.results_file_path, transcript.as_results_document(), True
+            )
+        transcript.results_path = transcript.results_file_path
+        self.transcript_storage_service.put_transcript(transcript)
+        return transcript
+
+    def search_transcripts(self, query: str) -> Dict[str, list]:
+        """Searches the already analysed transcripts for a phrase, through the search index.
+
+        :param query: The phrase to search for.
+        :type query: str
+        :return: The occurrences ([start word index, end word index, start time, end time]) keyed by request_id.
+        :rtype: Dict[str, list]
+        """
+        with StageTimer(on_stage=add_stage_metric).stage('search'):
+            matches = self.search_index_service.search(self.tokenizer.normalize(query))
+        metrics.add_metric(name='search_matches', unit=MetricUnit.Count, value=sum(map(len, matches.values())))
+        return matches
+
+    def get_results_document(self, results_path: str) -> dict:
+        """Reads the detailed results document of a completed analysis from s3.
+
+        :param results_path: The path to the results on s3.
+        :type results_path: str
+        :return: The document, with the sentence results under 'sentences'.
+        :rtype: dict
+        """
+        return self.s3_service.read_json_file(os.environ.get('TRANSCRIPTS_BUCKET'), results_path)
 
     def generate_presigned_url(self, transcript_path: str) -> str:
-        """Generates a presigned url to access the transcript on s3.
+        """Generates a presigned url to access the transcript on s3, or reuses one that is still valid long enough.
 
         :param transcript_path: The path to the transcript on s3.
         :type transcript_path: str
         :return: The url that can be used to get the transcript results.
         :rtype: str
         """
-        return self.s3_service.create_presigned_url(os.environ.get('TRANSCRIPTS_BUCKET'), transcript_path)
+        now = time.time()
+        cached = self._presigned_urls.get(transcript_path)
+        if cached and cached[0] - now > self.presigned_url_min_validity:
+            return cached[1]
+
+        url = self.s3_service.create_presigned_url(os.environ.get('TRANSCRIPTS_BUCKET'), transcript_path)
+        if len(self._presigned_urls) >= self.results_cache_size:
+            # Keep the cache bounded, drop the urls that can't be reused anymore (all of them if that's not enough).
+            self._presigned_urls = {
+                path: entry for path, entry in self._presigned_urls.items()
+                if entry[0] - now > self.presigned_url_min_validity
+            }
+            if len(self._presigned_urls) >= self.results_cache_size:
+                self._presigned_urls.clear()
+        self._presigned_urls[transcript_path] = (now + PRESIGNED_URL_EXPIRES_IN, url)
+        return url
@@ -1,16 +1,120 @@
+import hashlib
+import json
 import os
+from typing import Sequence
 from urllib.parse import urlparse
 
 from aws_lambda_powertools import Logger
-from aws_lambda_powertools.event_handler import APIGatewayRestResolver
+from aws_lambda_powertools.event_handler import APIGatewayRestResolver, Response, content_types
 from aws_lambda_powertools.logging import correlation_paths
+from aws_lambda_powertools.utilities.parser import ValidationError
+from aws_lambda_powertools.shared.json_encoder import Encoder
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
-from analysis_helper import AnalysisHelper
-from validation.request_models import CheckSentencesRequest
+from analysis_helper import AnalysisHelper, metrics
+from models.analysis_options import AnalysisOptions
+from models.results_summary import ResultsSummary
+from models.transcript import Transcript, TranscriptStatus
+from services.profiler import profiled
+from validation.request_models import BulkCheckSentencesRequest, BulkSubmissionEntry, CheckSentencesRequest, \
+    ReanalyseRequest
 
 logger: Logger = Logger(service='transcripts_api')
 app: APIGatewayRestResolver = APIGatewayRestResolver()
+# Created on first use and kept for the life of the container, so clients and caches survive between invocations.
+_helper: AnalysisHelper = None
+
+# Fields the /get_results body can be limited to, with the dynamo attributes each one is built from.
+# Selections without sentences are served from those attributes alone (see get_fields_body).
+PROJECTED_FIELDS = {
+    'id': ('request_id',),
+    'request_id': ('request_id',),
+    'audio_url': ('audio_url',),
+    'status': ('status',),
+    'created': ('created',),
+    'updated': ('updated',),
+    'transcript_url': ('transcript_path',),
+    'results_url': ('results_path',),
+    'results_summary': ('results_summary',),
+    'parent_request_id': ('parent_request_id',),
+    'analysis_version': ('analysis_version',),
+    'stage_timings': ('stage_timings',),
+    'media_format': ('media_format',),
+    'audio_duration': ('audio_duration',),
+    'audio_sample_rate': ('audio_sample_rate',),
+    'failure_reason': ('failure_reason',),
+}
+STATUS_FIELDS = ('request_id', 'status', 'created', 'updated')
+SUPPORTED_EXTENSIONS = ['.wav', '.mp3']
+MAX_SEARCH_LIMIT = 1000
+
+
+def get_audio_extension(audio_url: str) -> str:
+    """Returns the extension of the audio file the url points to (e.g. '.wav'), None if it is not supported.
+    """
+    ext = os.path.splitext(urlparse(audio_url).path)[1]
+    return ext if ext in SUPPORTED_EXTENSIONS else None
+
+
+def get_helper() -> AnalysisHelper:
+    global _helper
+    if _helper is None:
+        _helper = AnalysisHelper()
+    return _helper
+
+
+def conditional_response(body: dict) -> Response:
+    """Builds a json response with an ETag of the body, or an empty 304 if the client already has this version.
+
+    :param body: The body of the response.
+    :type body: dict
+    :rtype: Response
+    """
+    payload = json.dumps(body, cls=Encoder, separators=(',', ':'), sort_keys=True)
+    etag = f'"{hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if_none_match = app.current_event.get_header_value('If-None-Match') or ''
+    if etag in (tag.strip() for tag in if_none_match.split(',')) or if_none_match.strip() == '*':
+        return Response(status_code=304, content_type=content_types.APPLICATION_JSON, body='', headers=headers)
+    return Response(status_code=200, content_type=content_types.APPLICATION_JSON, body=payload, headers=headers)
+
+
+def get_fields_body(helper: AnalysisHelper, request_id: str, fields: Sequence[str]) -> dict:
+    """Builds a body with only the given fields, from a projected read of the transcript's item (no model is
+    built, no sentence deserialized, and urls are only signed when asked for).
+
+    :param helper: The api helper.
+    :type helper: AnalysisHelper
+    :param request_id: The request to read.
+    :type request_id: str
+    :param fields: The fields of the body, keys of PROJECTED_FIELDS.
+    :type fields: Sequence[str]
+    :return: The body, None if the request doesn't exist.
+    :rtype: dict
+    """
+    attributes = [attribute for field in fields for attribute in PROJECTED_FIELDS[field]]
+    item = helper.get_transcript_attributes(request_id, attributes)
+    if not item:
+        return None
+
+    body = {}
+    for field in fields:
+        if field == 'transcript_url' or field == 'results_url':
+            path = item.get(PROJECTED_FIELDS[field][0])
+            body[field] = helper.generate_presigned_url(path) if path else None
+        elif field == 'stage_timings':
+            body[field] = {stage: int(value) for stage, value in item.get('stage_timings', {}).items()}
+        elif field == 'audio_duration':
+            body[field] = float(item['audio_duration']) if 'audio_duration' in item else None
+        elif field == 'audio_sample_rate':
+            body[field] = int(item['audio_sample_rate']) if 'audio_sample_rate' in item else None
+        elif field == 'analysis_version':
+            body[field] = int(item['analysis_version']) if 'analysis_version' in item else None
+        elif field == 'results_summary':
+            body[field] = ResultsSummary(**item['results_summary']).as_dict() if 'results_summary' in item else None
+        else:
+            body[field] = item.get(PROJECTED_FIELDS[field][0])
+    return body
 
 @app.post('/submit_request')
 def post_submit_request() -> dict[str, any]:
@@ -20,35 +124,197 @@ def post_submit_request() -> dict[str, any]:
     :rtype: dict
     """
     request_data: CheckSentencesRequest = CheckSentencesRequest(**app.current_event.json_body)
-    path = urlparse(request_data.audio_url).path
-    ext = os.path.splitext(path)[1]
-    if ext not in ['.wav', '.mp3']:
+    ext = get_audio_extension(request_data.audio_url)
+    if not ext:
         return {
             'message': 'Error! Only mp3 or wav files are supported.'
         }, 400
-    helper: AnalysisHelper = AnalysisHelper()
+    helper: AnalysisHelper = get_helper()
     logger.info('Creating new transcript analysis request.')
-    request_id: str = helper.save_transcript_analysis_request(request_data.audio_url, request_data.sentences, ext)
+    transcript: Transcript = helper.save_transcript_analysis_request(
+        request_data.audio_url,
+        request_data.sentences,
+        ext,
+        AnalysisOptions(
+            max_occurrences=request_data.max_occurrences,
+            max_errors=request_data.max_errors,
+            min_confidence=request_data.min_confidence
+        ),
+        request_data.callback_url
+    )
+    request_id: str = transcript.request_id.hex
     logger.info('Successfully created new analysis request, scheduling processing task.')
     helper.register_transcribe_task(request_id)
     logger.info('Successfully registered transcribe task.')
 
+    body = {
+        'request_id': request_id,
+        'message': 'Your request was accepted successfully'
+    }
+    if transcript.callback_secret:
+        # Only handed out here, the receiver verifies the callback's X-Signature with it.
+        body['callback_secret'] = transcript.callback_secret
+    return {
+        'body': body
+    }
+
+@app.post('/submit_requests')
+def post_submit_requests() -> dict[str, any]:
+    """Handler for submitting many audio files at once, each with its own sentences or the shared ones.
+
+    Metadata is stored with batch writes and the processing tasks are queued in batches of 10. Entries are
+    accepted or rejected individually.
+
+    :return: Response with a request_id or an error for every entry, in the order they were sent.
+    :rtype: dict
+    """
+    request_data: BulkCheckSentencesRequest = BulkCheckSentencesRequest(**app.current_event.json_body)
+    results: list[dict] = [{'index': idx} for idx in range(len(request_data.entries))]
+    accepted: list[tuple] = []
+    for idx, raw_entry in enumerate(request_data.entries):
+        try:
+            entry = BulkSubmissionEntry(**raw_entry)
+        except (ValidationError, TypeError) as exc:
+            results[idx]['error'] = f'Invalid entry: {exc}'
+            continue
+        ext = get_audio_extension(entry.audio_url)
+        sentences = entry.sentences or request_data.sentences
+        if not ext:
+            results[idx]['error'] = 'Only mp3 or wav files are supported.'
+        elif not sentences:
+            results[idx]['error'] = 'No sentences given for the entry, nor shared ones.'
+        else:
+            accepted.append((idx, (entry.audio_url, sentences, ext, entry.callback_url or request_data.callback_url)))
+
+    helper: AnalysisHelper = get_helper()
+    if accepted:
+        logger.info(f'Creating {len(accepted)} transcript analysis requests.')
+        transcripts, errors = helper.save_transcript_analysis_requests(
+            [entry for _, entry in accepted],
+            AnalysisOptions(
+                max_occurrences=request_data.max_occurrences,
+                max_errors=request_data.max_errors,
+                min_confidence=request_data.min_confidence
+            )
+        )
+        if errors:
+            logger.warning(f'Failed to store {len(errors)} transcript analysis requests.')
+        else:
+            errors = {
+                request_id: f'Failed to schedule processing: {error}'
+                for request_id, error in helper.register_transcribe_tasks(transcripts).items()
+            }
+            logger.info(f'Registered {len(transcripts) - len(errors)} transcribe tasks, {len(errors)} failed.')
+        for (idx, _), transcript in zip(accepted, transcripts):
+            results[idx]['request_id'] = transcript.request_id.hex
+            if transcript.callback_secret:
+                results[idx]['callback_secret'] = transcript.callback_secret
+            if transcript.request_id.hex in errors:
+                results[idx]['error'] = errors[transcript.request_id.hex]
+
+    rejected = sum(1 for result in results if 'error' in result)
     return {
         'body': {
-            'request_id': request_id,
-            'message': 'Your request was accepted successfully'
+            'results': results,
+            'accepted': len(results) - rejected,
+            'rejected': rejected,
+            'message': 'Your requests were processed, see the result of each entry'
         }
     }
 
+@app.post('/reanalyse')
+def post_reanalyse_request() -> dict[str, any]:
+    """Handler for searching the transcript of a completed request for new sentences.
+
+    The stored transcript is analysed right away, skipping the audio download and Transcribe. The results are
+    saved as a new request (a new version of the parent's results) and returned in the body.
+
+    :return: Response which contains the new request_id, its version and the sentence results.
+    :rtype: dict
+    """
+    request_data: ReanalyseRequest = ReanalyseRequest(**app.current_event.json_body)
+    helper: AnalysisHelper = get_helper()
+    parent = helper.get_transcript_metadata(request_data.request_id)
+    if not parent:
+        return {
+            'message': 'not found'
+        }, 404
+    if parent.status != TranscriptStatus.COMPLETED or not parent.transcript_path:
+        return {
+            'message': 'Error! Only completed requests can be re-analysed.'
+        }, 409
+
+    logger.info(f'Re-analysing the transcript of request_id: {parent.request_id.hex}')
+    transcript: Transcript = helper.reanalyse_transcript(
+        parent,
+        request_data.sentences,
+        AnalysisOptions(
+            max_occurrences=request_data.max_occurrences,
+            max_errors=request_data.max_errors,
+            min_confidence=request_data.min_confidence
+        )
+    )
+    return {
+        'body': {
+            'request_id': transcript.request_id.hex,
+            'parent_request_id': transcript.parent_request_id.hex,
+            'analysis_version': transcript.analysis_version,
+            'status': transcript.status.value,
+            'results_summary': transcript.results_summary.as_dict(),
+            'sentences': [sentence.as_dict() for sentence in transcript.sentences]
+        }
+    }
+
+@app.get('/get_status')
+def get_status_request() -> Response:
+    """Gets only the status and timestamps of a request, the cheapest way to poll for completion.
+
+    :return: Response which contains the request_id, status, created and updated.
+    :rtype: Response
+    """
+    request_id: str = app.current_event.query_string_parameters.get('request_id')
+    body = get_fields_body(get_helper(), request_id, STATUS_FIELDS)
+    if not body:
+        return {
+            'message': 'not found'
+        }, 404
+
+    return conditional_response(body)
+
 @app.get('/get_results')
-def get_results_request() -> dict[str, any]:
+def get_results_request() -> Response:
     """Gets the transcript status and results, if they exist.
 
+    Detailed results are returned as a presigned url to the results document (results_url), or in the body with
+    ?results=inline. ?fields=status,updated,... limits the body to the given fields. Responses carry an ETag,
+    polling with If-None-Match gets an empty 304 while nothing changed.
+
     :return: Response which contains a transcript status and results, if any.
-    :rtype: dict
+    :rtype: Response
     """
     request_id: str = app.current_event.query_string_parameters.get('request_id')
-    helper: AnalysisHelper = AnalysisHelper()
+    results_mode: str = app.current_event.get_query_string_value('results', 'url')
+    if results_mode not in ('url', 'inline'):
+        return {
+            'message': 'Error! results must be url or inline.'
+        }, 400
+    fields_param: str = app.current_event.get_query_string_value('fields', '')
+    fields = [field.strip() for field in fields_param.split(',') if field.strip()]
+    unknown_fields = set(fields) - PROJECTED_FIELDS.keys() - {'sentences'}
+    if unknown_fields:
+        return {
+            'message': f'Error! Unknown fields: {", ".join(sorted(unknown_fields))}.'
+        }, 400
+    helper: AnalysisHelper = get_helper()
+
+    if fields and 'sentences' not in fields:
+        body = get_fields_body(helper, request_id, fields)
+        if not body:
+            return {
+                'message': 'not found'
+            }, 404
+        return conditional_response(body)
+
     transcript = helper.get_transcript_metadata(request_id)
 
     if not transcript:
@@ -56,7 +322,7 @@ def get_results_request() -> dict[str, any]:
             'message': 'not found'
         }, 404
 
-    return {
+    body = {
         "id": transcript.request_id.hex,
         "request_id": transcript.request_id.hex,
         "audio_url": transcript.audio_url,
@@ -66,11 +332,93 @@ def get_results_request() -> dict[str, any]:
             else None
         ),
         "status": transcript.status.value,
-        "sentences": [
-            sentence.as_dict() for sentence in transcript.sentences
-        ]
+        "created": transcript.created.isoformat(),
+        "updated": transcript.updated.isoformat(),
+        "stage_timings": transcript.stage_timings,
+        "media_format": transcript.media_format.value if transcript.media_format else None,
+        "audio_duration": float(transcript.audio_duration) if transcript.audio_duration is not None else None,
+        "audio_sample_rate": transcript.audio_sample_rate
+    }
+    if transcript.failure_reason:
+        body["failure_reason"] = transcript.failure_reason
+    if transcript.parent_request_id:
+        body["parent_request_id"] = transcript.parent_request_id.hex
+        body["analysis_version"] = transcript.analysis_version
+    if not transcript.results_path:
+        # Pending requests, and the ones completed before results were moved to s3.
+        body["sentences"] = [sentence.as_dict() for sentence in transcript.sentences]
+    else:
+        body["results_summary"] = transcript.results_summary.as_dict()
+        if results_mode == 'inline' or 'sentences' in fields:
+            body["sentences"] = helper.get_results_document(transcript.results_path)['sentences']
+        else:
+            body["results_url"] = helper.generate_presigned_url(transcript.results_path)
+
+    if fields:
+        body = {field: body.get(field) for field in fields}
+    return conditional_response(body)
+
+@app.get('/search')
+def get_search_request() -> dict[str, any]:
+    """Searches every analysed transcript for a phrase, without running a new analysis.
+
+    ?q=<phrase> is matched exactly (after the same normalization as the sentences) against the search index,
+    ?limit= caps how many requests (most occurrences first) and occurrences per request are returned.
+
+    :return: Response with the matching request_ids, their occurrence count and occurrences.
+    :rtype: dict
+    """
+    query: str = app.current_event.get_query_string_value('q', '').strip()
+    limit_param: str = app.current_event.get_query_string_value('limit', '100')
+    if not query:
+        return {
+            'message': 'Error! A query (q) is required.'
+        }, 400
+    if not limit_param.isdigit() or not 0 < int(limit_param) <= MAX_SEARCH_LIMIT:
+        return {
+            'message': f'Error! limit must be between 1 and {MAX_SEARCH_LIMIT}.'
+        }, 400
+    limit = int(limit_param)
+
+    matches = get_helper().search_transcripts(query)
+    ranked = sorted(matches.items(), key=lambda match: (-len(match[1]), match[0]))[:limit]
+    return {
+        'body': {
+            'query': query,
+            'total_matches': len(matches),
+            'results': [
+                {
+                    'request_id': request_id,
+                    'occurrence_count': len(occurrences),
+                    'occurrences': [
+                        {
+                            'start_word_index': start_word_index,
+                            'end_word_index': end_word_index,
+                            'start_time': start_time,
+                            'end_time': end_time
+                        }
+                        for start_word_index, end_word_index, start_time, end_time in occurrences[:limit]
+                    ]
+                }
+                for request_id, occurrences in ranked
+            ]
+        }
     }
 
+def event_request_ids(event: dict) -> list:
+    """The request an api call is about (new submissions don't have one yet, their profile goes under the call's
+    aws_request_id).
+    """
+    request_id = (event.get('queryStringParameters') or {}).get('request_id')
+    if not request_id and event.get('body'):
+        try:
+            request_id = json.loads(event['body']).get('request_id')
+        except (ValueError, AttributeError):
+            pass
+    return [request_id]
+
+@metrics.log_metrics
 @logger.inject_lambda_context(correlation_id_path=correlation_paths.API_GATEWAY_REST)
+@profiled('transcripts_api', event_request_ids)
 def lambda_handler(event: dict[str, any], context: LambdaContext) -> dict[str, any]:
     return app.resolve(event, context)
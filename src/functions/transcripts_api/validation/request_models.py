@@ -1,3 +1,5 @@
+from typing import Optional
+
 from aws_lambda_powertools.utilities.parser import Field, BaseModel
 
 
@@ -6,3 +8,38 @@ class CheckSentencesRequest(BaseModel):
     """
     audio_url: str = Field(..., min_length=10, max_length=128),
     sentences: list[str] = Field(..., min_length=1, max_length=256)
+    max_occurrences: Optional[int] = Field(None, ge=1)
+    max_errors: int = Field(0, ge=0, le=3)
+    min_confidence: Optional[float] = Field(None, ge=0, le=1)
+    callback_url: Optional[str] = Field(None, min_length=10, max_length=2048, pattern=r'^https?://')
+
+
+class BulkSubmissionEntry(BaseModel):
+    """The schema of one entry of a bulk submission, sentences default to the ones shared by the submission.
+    """
+    audio_url: str = Field(..., min_length=10, max_length=128)
+    sentences: Optional[list[str]] = Field(None, min_length=1, max_length=256)
+    callback_url: Optional[str] = Field(None, min_length=10, max_length=2048, pattern=r'^https?://')
+
+
+class BulkCheckSentencesRequest(BaseModel):
+    """The schema of the bulk submission event body.
+
+    Entries are validated one by one (see BulkSubmissionEntry), so an invalid entry only rejects itself.
+    """
+    entries: list[dict] = Field(..., min_length=1, max_length=1000)
+    sentences: Optional[list[str]] = Field(None, min_length=1, max_length=256)
+    max_occurrences: Optional[int] = Field(None, ge=1)
+    max_errors: int = Field(0, ge=0, le=3)
+    min_confidence: Optional[float] = Field(None, ge=0, le=1)
+    callback_url: Optional[str] = Field(None, min_length=10, max_length=2048, pattern=r'^https?://')
+
+
+class ReanalyseRequest(BaseModel):
+    """The schema of the re-analysis event body: new sentences to search in the transcript of a completed request.
+    """
+    request_id: str = Field(..., min_length=32, max_length=36)
+    sentences: list[str] = Field(..., min_length=1, max_length=256)
+    max_occurrences: Optional[int] = Field(None, ge=1)
+    max_errors: int = Field(0, ge=0, le=3)
+    min_confidence: Optional[float] = Field(None, ge=0, le=1)
@@ -0,0 +1,140 @@
+from typing import Dict, Iterator, List, Mapping, Sequence, Tuple
+
+NO_ALTERNATIVES: Tuple[int, ...] = ()
+
+
+class FuzzyPhraseMatcher(object):
+    """Approximate multi-phrase matcher over token ids (bit-parallel Wu-Manber shift-and).
+
+    All the phrases are packed next to each other into one (arbitrarily long) integer, so every transcript token
+    costs a handful of integer operations per allowed error no matter how many phrases there are. An occurrence
+    may differ from its phrase by word substitutions and by extra words inserted between the phrase words.
+    Short phrases get fewer errors so they can't match arbitrary text: at most (length - 1) // 2.
+    """
+
+    def __init__(self, phrases: Sequence[Sequence[int]], max_errors: int):
+        """Compiles the phrases.
+
+        :param phrases: The phrases to search for, as token ids. Empty phrases never match.
+        :type phrases: Sequence[Sequence[int]]
+        :param max_errors: The maximum number of substitutions and insertions per occurrence.
+        :type max_errors: int
+        """
+        self.phrases = phrases
+        self.max_errors = max_errors
+        self.allowed_errors: List[int] = [min(max_errors, (len(phrase) - 1) // 2) for phrase in phrases]
+        self._token_masks: Dict[int, int] = {}
+        self._start_mask = 0
+        self._end_masks = [0] * (max_errors + 1)
+        self._phrase_by_end_bit: Dict[int, int] = {}
+
+        offset = 0
+        for phrase_idx, phrase in enumerate(phrases):
+            if not phrase:
+                continue
+            for position, token_id in enumerate(phrase):
+                self._token_masks[token_id] = self._token_masks.get(token_id, 0) | 1 << (offset + position)
+            end_bit = offset + len(phrase) - 1
+            self._start_mask |= 1 << offset
+            for errors in range(self.allowed_errors[phrase_idx] + 1):
+                self._end_masks[errors] |= 1 << end_bit
+            self._phrase_by_end_bit[end_bit] = phrase_idx
+            offset += len(phrase)
+
+    def iter_matches(
+            self,
+            token_ids: Sequence[int],
+            alternatives: Mapping[int, Tuple[int, ...]] = None) -> Iterator[Tuple[int, int, int, int]]:
+        """Scans the tokens and yields the occurrences of every phrase.
+
+        Exact occurrences are all reported, even when they overlap. An approximate occurrence is only reported
+        when it doesn't overlap the previous occurrence of the same phrase.
+
+        :param token_ids: The token ids of the transcript.
+        :type token_ids: Sequence[int]
+        :param alternatives: Extra token ids accepted at some positions (lower ranked Transcribe alternatives).
+        :type alternatives: Mapping[int, Tuple[int, ...]]
+        :return: Tuples of (phrase index, first position, last position, number of errors).
+        :rtype: Iterator[Tuple[int, int, int, int]]
+        """
+        alternatives = alternatives or {}
+        token_masks, start_mask, end_masks = self._token_masks, self._start_mask, self._end_masks
+        not_start_mask = ~start_mask
+        not_end_mask = ~end_masks[0]
+        levels = range(1, self.max_errors + 1)
+        # states[j] has bit i set when the phrase prefix ending at bit i matches the text with j errors.
+        states = [0] * (self.max_errors + 1)
+        last_end: Dict[int, int] = {}
+
+        for position, token_id in enumerate(token_ids):
+            mask = token_masks.get(token_id, 0)
+            for alternative_id in alternatives.get(position, NO_ALTERNATIVES):
+                mask |= token_masks.get(alternative_id, 0)
+
+            previous = states[0]
+            states[0] = ((previous << 1) | start_mask) & mask
+            for errors in levels:
+                current = states[errors]
+                states[errors] = (
+                    (((current << 1) | start_mask) & mask)
+                    # Substitution, never of the first word so an occurrence can't start with a wrong word.
+                    | ((previous << 1) & not_start_mask)
+                    # Insertion of an extra word, never after the last word of the phrase.
+                    | (previous & not_end_mask)
+                )
+                previous = current
+
+            found = 0
+            for errors, state in enumerate(states):
+                hits = state & end_masks[errors] & ~found
+                found |= hits
+                while hits:
+                    bit = hits & -hits
+                    hits ^= bit
+                    phrase_idx = self._phrase_by_end_bit[bit.bit_length() - 1]
+                    if errors == 0:
+                        start = position - len(self.phrases[phrase_idx]) + 1
+                    else:
+                        start = self._align_start(phrase_idx, token_ids, alternatives, position, errors)
+                        if start <= last_end.get(phrase_idx, -1):
+                            continue
+                    last_end[phrase_idx] = position
+                    yield phrase_idx, start, position, errors
+
+    def _align_start(
+            self,
+            phrase_idx: int,
+            token_ids: Sequence[int],
+            alternatives: Mapping[int, Tuple[int, ...]],
+            end: int,
+            errors: int) -> int:
+        """Finds where the shortest occurrence with the given number of errors ending at end starts.
+
+        Aligns the phrase backwards from end (only runs for approximate hits, and costs length x (length + errors)).
+        """
+        phrase = self.phrases[phrase_idx]
+        length = len(phrase)
+        window = min(length + errors, end + 1)
+        infinity = errors + 1
+        # costs[i][t]: errors to align the last i phrase words with the last t text tokens.
+        costs = [[infinity] * (window + 1) for _ in range(length + 1)]
+        costs[0][0] = 0
+        for i in range(length + 1):
+            for t in range(window + 1):
+                cost = costs[i][t]
+                if cost >= infinity or t == window:
+                    continue
+                position = end - t
+                if i < length:
+                    accepted = phrase[length - 1 - i]
+                    match = token_ids[position] == accepted or accepted in alternatives.get(position, NO_ALTERNATIVES)
+                    step = cost + (0 if match else 1)
+                    # The first word of the phrase is never substituted.
+                    if (match or i < length - 1) and step < costs[i + 1][t + 1]:
+                        costs[i + 1][t + 1] = step
+                if 0 < i < length and cost + 1 < costs[i][t + 1]:
+                    costs[i][t + 1] = cost + 1
+        for t in range(length, window + 1):
+            if costs[length][t] <= errors:
+                return end - t + 1
+        return end - length + 1
@@ -0,0 +1,178 @@
+import base64
+import hashlib
+import math
+import zlib
+from typing import Dict, Iterable, List, Mapping, Sequence
+
+from analysis.tokenizer import UNKNOWN_TOKEN, TokenStream, TokenVocabulary
+
+DEFAULT_SHARD_COUNT = 64
+
+# A posting is [token position, item index, start time, end time] (times in seconds, None where Transcribe gave none).
+# The token position is what phrase queries check adjacency on, the item index is the word index of the results.
+Posting = List
+
+# The token filters (see token_filter) use FILTER_BITS_PER_TOKEN bits per token and FILTER_HASHES hashes, about 1%
+# of false positives, between FILTER_MIN_BITS and FILTER_MAX_BITS (encoded, they have to fit in an s3 key).
+FILTER_BITS_PER_TOKEN = 10
+FILTER_HASHES = 4
+FILTER_MIN_BITS = 64
+FILTER_MAX_BITS = 3072
+
+
+def shard_of(token: str, shard_count: int = DEFAULT_SHARD_COUNT) -> int:
+    """Returns the shard holding the postings of the token (stable across processes, unlike hash()).
+
+    :param token: A normalized token.
+    :type token: str
+    :param shard_count: The number of shards of the index.
+    :type shard_count: int
+    :rtype: int
+    """
+    return zlib.crc32(token.encode('utf-8')) % shard_count
+
+
+def _seconds(offset: float) -> float:
+    return None if math.isnan(offset) else round(offset, 3)
+
+
+def _filter_bits(token: str, size: int) -> Iterable[int]:
+    digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+    first, second = int.from_bytes(digest[:4], 'big'), int.from_bytes(digest[4:], 'big') | 1
+    return ((first + i * second) % size for i in range(FILTER_HASHES))
+
+
+def token_filter(tokens: Iterable[str]) -> str:
+    """Encodes a set of tokens as a bloom filter: tells which tokens a segment of the index may hold without
+    reading it. The encoding is url safe and has no dots.
+
+    :param tokens: The tokens in the set.
+    :type tokens: Iterable[str]
+    :return: The filter, base64url encoded.
+    :rtype: str
+    """
+    tokens = list(tokens)
+    size = min(max(len(tokens) * FILTER_BITS_PER_TOKEN, FILTER_MIN_BITS), FILTER_MAX_BITS)
+    size += -size % 8
+    bits = bytearray(size // 8)
+    for token in tokens:
+        for bit in _filter_bits(token, size):
+            bits[bit // 8] |= 1 << (bit % 8)
+    return base64.urlsafe_b64encode(bytes(bits)).decode('ascii').rstrip('=')
+
+
+def filter_may_contain(encoded_filter: str, token: str) -> bool:
+    """Whether a set encoded by token_filter may contain the token (never False for a token it contains).
+
+    :param encoded_filter: The filter.
+    :type encoded_filter: str
+    :param token: A normalized token.
+    :type token: str
+    :rtype: bool
+    """
+    bits = base64.urlsafe_b64decode(encoded_filter + '=' * (-len(encoded_filter) % 4))
+    return all(bits[bit // 8] & (1 << (bit % 8)) for bit in _filter_bits(token, len(bits) * 8))
+
+
+def build_postings(stream: TokenStream, vocabulary: TokenVocabulary) -> Dict[str, List[Posting]]:
+    """Builds the positional postings of a tokenized transcript.
+
+    The stream must have been tokenized with a growing vocabulary, tokens that are still UNKNOWN_TOKEN (e.g. below
+    the request's min_confidence) are left out of the index.
+
+    :param stream: The token stream of the transcript.
+    :type stream: TokenStream
+    :param vocabulary: The vocabulary the stream was tokenized with.
+    :type vocabulary: TokenVocabulary
+    :return: The postings of every token, in position order.
+    :rtype: Dict[str, List[Posting]]
+    """
+    postings: Dict[str, List[Posting]] = {}
+    tokens = vocabulary.tokens
+    for position, token_id in enumerate(stream.token_ids):
+        if token_id == UNKNOWN_TOKEN:
+            continue
+        posting = [
+            position,
+            stream.item_indices[position],
+            _seconds(stream.start_times[position]),
+            _seconds(stream.end_times[position])
+        ]
+        token_postings = postings.get(tokens[token_id])
+        if token_postings is None:
+            postings[tokens[token_id]] = [posting]
+        else:
+            token_postings.append(posting)
+    return postings
+
+
+def split_by_shard(
+        postings: Mapping[str, List[Posting]],
+        shard_count: int = DEFAULT_SHARD_COUNT) -> Dict[int, Dict[str, List[Posting]]]:
+    """Groups the postings of a transcript by the shard of their token.
+
+    :rtype: Dict[int, Dict[str, List[Posting]]]
+    """
+    shards: Dict[int, Dict[str, List[Posting]]] = {}
+    for token, token_postings in postings.items():
+        shards.setdefault(shard_of(token, shard_count), {})[token] = token_postings
+    return shards
+
+
+def find_phrase(
+        phrase: Sequence[str],
+        postings: Mapping[str, Mapping[str, List[Posting]]]) -> Dict[str, List[Posting]]:
+    """Finds the occurrences of a phrase in every transcript of the index.
+
+    :param phrase: The normalized tokens of the phrase.
+    :type phrase: Sequence[str]
+    :param postings: For every token of the phrase, its postings keyed by request_id.
+    :type postings: Mapping[str, Mapping[str, List[Posting]]]
+    :return: For every request containing the phrase, its occurrences as
+        [start item index, end item index, start time, end time], in transcript order.
+    :rtype: Dict[str, List[Posting]]
+    """
+    if not phrase or any(token not in postings for token in phrase):
+        return {}
+
+    # Start from the rarest token, so the candidate set shrinks as early as possible.
+    by_frequency = sorted(set(phrase), key=lambda token: len(postings[token]))
+    candidates = set(postings[by_frequency[0]])
+    for token in by_frequency[1:]:
+        candidates &= postings[token].keys()
+
+    matches: Dict[str, List[Posting]] = {}
+    last = len(phrase) - 1
+    for request_id in candidates:
+        positions = [
+            {posting[0]: posting for posting in postings[token][request_id]}
+            for token in phrase
+        ]
+        occurrences = []
+        for start, first in sorted(positions[0].items()):
+            if all(start + offset in positions[offset] for offset in range(1, last + 1)):
+                end = positions[last][start + last]
+                occurrences.append([first[1], end[1], first[2], end[3]])
+        if occurrences:
+            matches[request_id] = occurrences
+    return matches
+
+
+def merge_postings(
+        target: Dict[str, Dict[str, List[Posting]]],
+        request_id: str,
+        postings: Mapping[str, List[Posting]],
+        tokens: Iterable[str] = None) -> None:
+    """Adds the postings of one transcript to a token major index ({token: {request_id: postings}}).
+
+    :param target: The index to add to.
+    :type target: Dict[str, Dict[str, List[Posting]]]
+    :param request_id: The request of the transcript.
+    :type request_id: str
+    :param postings: The postings of the transcript, by token.
+    :type postings: Mapping[str, List[Posting]]
+    :param tokens: Only add these tokens, None for all of them.
+    :type tokens: Iterable[str]
+    """
+    for token in (postings if tokens is None else (t for t in tokens if t in postings)):
+        target.setdefault(token, {})[request_id] = postings[token]
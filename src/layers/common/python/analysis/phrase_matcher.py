@@ -0,0 +1,72 @@
+from collections import deque
+from typing import Hashable, Iterable, Iterator, List, Sequence, Tuple
+
+
+class PhraseMatcher(object):
+    """Aho-Corasick automaton over word tokens.
+
+    The automaton is built once per list of phrases and then finds every occurrence of every phrase
+    (including overlapping and repeated ones) in a single pass over the transcript, so the cost of matching
+    only grows with the length of the transcript and not with the number of phrases.
+    """
+
+    def __init__(self, phrases: Sequence[Sequence[Hashable]]):
+        """Builds the automaton for the given phrases.
+
+        :param phrases: The phrases to search for, each one a sequence of tokens. Empty phrases never match.
+        :type phrases: Sequence[Sequence[Hashable]]
+        """
+        self.phrase_lengths: List[int] = [len(phrase) for phrase in phrases]
+        self._goto: List[dict] = [{}]
+        self._fail: List[int] = [0]
+        self._outputs: List[Tuple[int, ...]] = [()]
+
+        for phrase_idx, phrase in enumerate(phrases):
+            if phrase:
+                self._add_phrase(phrase_idx, phrase)
+        self._build_failure_links()
+
+    def _add_phrase(self, phrase_idx: int, phrase: Sequence[Hashable]) -> None:
+        state = 0
+        for token in phrase:
+            next_state = self._goto[state].get(token)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][token] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append(())
+            state = next_state
+        self._outputs[state] += (phrase_idx,)
+
+    def _build_failure_links(self) -> None:
+        # Breadth first, so the failure state of every node is final before its children are visited.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self._goto[state].items():
+                fail_state = self._fail[state]
+                while fail_state and token not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                fail_state = self._goto[fail_state].get(token, 0)
+                self._fail[next_state] = fail_state
+                # Phrases ending at the failure state are suffixes of this one, so they also end here.
+                self._outputs[next_state] += self._outputs[fail_state]
+                queue.append(next_state)
+
+    def iter_matches(self, tokens: Iterable[Hashable]) -> Iterator[Tuple[int, int]]:
+        """Scans the tokens and yields every phrase occurrence as soon as its last token is seen.
+
+        :param tokens: The tokens of the transcript, in order.
+        :type tokens: Iterable[Hashable]
+        :return: Tuples of (phrase index, position of the last token of the occurrence).
+        :rtype: Iterator[Tuple[int, int]]
+        """
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        state = 0
+        for position, token in enumerate(tokens):
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for phrase_idx in outputs[state]:
+                yield phrase_idx, position
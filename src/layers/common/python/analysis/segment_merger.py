@@ -0,0 +1,110 @@
+import json
+import shutil
+import tempfile
+from typing import IO, Iterable, Iterator, List, Sequence
+
+
+def merge_segment_items(
+        segments: Iterable[Iterable[dict]],
+        bounds: Sequence[Sequence[float]]) -> Iterator[dict]:
+    """Merges the items of the transcripts of overlapping audio segments into the items of a single transcript.
+
+    Offsets are moved from the segment's time to the recording's and the ids of the items (when Transcribe gives
+    them) renumbered. Every word spoken in an overlap is transcribed twice, it's kept from the segment that heard it
+    further from its edge: words whose middle is before the middle of the overlap come from the earlier segment.
+    The later segment resumes with the first word starting after the middle of the last word kept from the earlier
+    one (and that isn't the same word, timed later), so a word timed a little differently by the two segments is
+    neither dropped nor repeated. Punctuation goes with the word before it.
+
+    :param segments: The items of every segment's transcript, in the order of the segments (each is consumed
+        before the next one is started, so they can be streamed).
+    :type segments: Iterable[Iterable[dict]]
+    :param bounds: The [start, end] seconds of every segment in the recording.
+    :type bounds: Sequence[Sequence[float]]
+    :return: The items (updated in place), with offsets in seconds from the start of the recording.
+    :rtype: Iterator[dict]
+    """
+    # The middle, end and content of the last word merged.
+    merged_middle = float('-inf')
+    merged_end = float('-inf')
+    merged_content = None
+    item_id = 0
+    for idx, items in enumerate(segments):
+        offset = float(bounds[idx][0])
+        cut = (float(bounds[idx + 1][0]) + float(bounds[idx][1])) / 2 if idx + 1 < len(bounds) else float('inf')
+        # Whether the last word of this segment was kept, for the punctuation that follows it.
+        keep = False
+        resumed = False
+        for item in items:
+            if item.get('type') != 'punctuation' and 'start_time' in item:
+                start = offset + float(item['start_time'])
+                end = offset + float(item['end_time'])
+                middle = (start + end) / 2
+                if middle >= cut:
+                    # The rest of the segment is in the next one.
+                    break
+                content = item['alternatives'][0]['content']
+                keep = resumed or (
+                    start > merged_middle and not (content == merged_content and start < merged_end)
+                )
+                if not keep:
+                    continue
+                resumed = True
+                item['start_time'] = f'{start:.3f}'
+                item['end_time'] = f'{end:.3f}'
+                merged_middle, merged_end, merged_content = middle, end, content
+            elif not keep:
+                continue
+            if 'id' in item:
+                item['id'] = item_id
+            item_id += 1
+            yield item
+
+
+class TranscriptFileWriter(object):
+    """Writes a transcript in the format of Transcribe's, item by item, to a temporary file: neither the items nor
+    the text are kept in memory. The text is written after the items, the way Transcribe writes it: punctuation is
+    attached to the word before it.
+    """
+
+    def __init__(self, job_name: str):
+        """
+        :param job_name: The jobName of the transcript.
+        :type job_name: str
+        """
+        self._file = tempfile.TemporaryFile()
+        self._text = tempfile.TemporaryFile()
+        self._file.write(f'{{"jobName":{json.dumps(job_name)},"results":{{"items":['.encode('utf-8'))
+        self._count = 0
+
+    def add(self, item: dict) -> None:
+        """Appends an item to the transcript.
+
+        :param item: The item, in Transcribe's format.
+        :type item: dict
+        """
+        if self._count:
+            self._file.write(b',')
+            if item.get('type') != 'punctuation':
+                self._text.write(b' ')
+        self._file.write(json.dumps(item, separators=(',', ':')).encode('utf-8'))
+        # The content json encoded, without its quotes.
+        self._text.write(json.dumps(item['alternatives'][0]['content'])[1:-1].encode('utf-8'))
+        self._count += 1
+
+    def finish(self) -> IO[bytes]:
+        """Completes the transcript.
+
+        :return: The file of the transcript, positioned at its start (closed with the writer).
+        :rtype: IO[bytes]
+        """
+        self._file.write(b'],"transcripts":[{"transcript":"')
+        self._text.seek(0)
+        shutil.copyfileobj(self._text, self._file)
+        self._file.write(b'"}]},"status":"COMPLETED"}')
+        self._file.seek(0)
+        return self._file
+
+    def close(self) -> None:
+        self._text.close()
+        self._file.close()
@@ -0,0 +1,207 @@
+import re
+from array import array
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Mapping, Tuple
+
+# Contractions are expanded on both sides, so "don't" in the transcript matches "do not" in a sentence
+# and the other way around.
+DEFAULT_EQUIVALENCES: Dict[str, str] = {
+    "don't": 'do not',
+    "doesn't": 'does not',
+    "didn't": 'did not',
+    "can't": 'can not',
+    "cannot": 'can not',
+    "won't": 'will not',
+    "wouldn't": 'would not',
+    "shouldn't": 'should not',
+    "couldn't": 'could not',
+    "isn't": 'is not',
+    "aren't": 'are not',
+    "wasn't": 'was not',
+    "weren't": 'were not',
+    "haven't": 'have not',
+    "hasn't": 'has not',
+    "i'm": 'i am',
+    "you're": 'you are',
+    "we're": 'we are',
+    "they're": 'they are',
+    "it's": 'it is',
+    "that's": 'that is',
+    "i've": 'i have',
+    "we've": 'we have',
+    "i'll": 'i will',
+    "we'll": 'we will',
+    "i'd": 'i would',
+    "let's": 'let us',
+    'okay': 'ok',
+}
+
+_WORD = re.compile(r"[\w']+")
+_APOSTROPHES = str.maketrans({'’': "'", '‘': "'", '`': "'"})
+
+UNKNOWN_TOKEN = 0
+
+
+class TokenVocabulary(object):
+    """Interns normalized tokens into small integer ids, so matching compares ints instead of strings.
+
+    Id 0 is reserved for tokens that are not in the vocabulary.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self.tokens: List[str] = ['']
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def intern(self, token: str) -> int:
+        token_id = self._ids.get(token)
+        if token_id is None:
+            token_id = self._ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def lookup(self, token: str) -> int:
+        return self._ids.get(token, UNKNOWN_TOKEN)
+
+
+@dataclass
+class TokenStream:
+    """Compact, array backed view of a tokenized transcript.
+
+    Token i comes from the transcript item item_indices[i]. An item may produce several tokens (e.g. an expanded
+    contraction) and punctuation items produce none. Offsets are in seconds, NaN where Transcribe gave none.
+    Lower ranked alternatives of single token items, when requested, are kept sparsely by token position.
+    """
+    token_ids: array = field(default_factory=lambda: array('i'))
+    item_indices: array = field(default_factory=lambda: array('i'))
+    start_times: array = field(default_factory=lambda: array('d'))
+    end_times: array = field(default_factory=lambda: array('d'))
+    alternatives: Dict[int, Tuple[int, ...]] = field(default_factory=dict)
+    item_count: int = 0
+
+    def __len__(self) -> int:
+        return len(self.token_ids)
+
+
+class Tokenizer(object):
+    """Normalizes sentences and transcript items into the same token space.
+
+    Normalization folds case, unifies apostrophes, drops punctuation and extra whitespace and applies the
+    equivalence table, whose values are written in normalized form.
+    """
+
+    def __init__(self, equivalences: Mapping[str, str] = None):
+        """
+        :param equivalences: Extra (or overriding) equivalences on top of DEFAULT_EQUIVALENCES, from a single word
+            to the words it stands for.
+        :type equivalences: Mapping[str, str]
+        """
+        table = dict(DEFAULT_EQUIVALENCES)
+        table.update(equivalences or {})
+        self.equivalences: Dict[str, Tuple[str, ...]] = {
+            self._fold(word).strip("'"): tuple(self._words(self._fold(replacement)))
+            for word, replacement in table.items()
+        }
+
+    @staticmethod
+    def _fold(text: str) -> str:
+        return text.translate(_APOSTROPHES).casefold()
+
+    @staticmethod
+    def _words(folded_text: str) -> List[str]:
+        return [word for word in (w.strip("'") for w in _WORD.findall(folded_text)) if word]
+
+    def normalize(self, text: str) -> List[str]:
+        """Splits text into normalized tokens.
+
+        :param text: A sentence or the content of a transcript item.
+        :type text: str
+        :return: The tokens, with equivalences applied.
+        :rtype: List[str]
+        """
+        tokens: List[str] = []
+        for word in self._words(self._fold(text)):
+            tokens.extend(self.equivalences.get(word, (word,)))
+        return tokens
+
+    def tokenize_sentences(self, texts: Iterable[str], vocabulary: TokenVocabulary) -> List[array]:
+        """Tokenizes every sentence once, adding its tokens to the vocabulary.
+
+        :param texts: The plain text of the sentences.
+        :type texts: Iterable[str]
+        :param vocabulary: The vocabulary to intern the tokens into.
+        :type vocabulary: TokenVocabulary
+        :return: An array of token ids per sentence.
+        :rtype: List[array]
+        """
+        return [array('i', (vocabulary.intern(token) for token in self.normalize(text))) for text in texts]
+
+    def tokenize_items(
+            self,
+            items: Iterable[dict],
+            vocabulary: TokenVocabulary,
+            grow: bool = False,
+            min_confidence: float = None,
+            with_alternatives: bool = False) -> TokenStream:
+        """Tokenizes the Transcribe items of a transcript in a single pass.
+
+        :param items: The transcript items, as returned by Transcribe.
+        :type items: Iterable[dict]
+        :param vocabulary: The vocabulary to map the tokens with.
+        :type vocabulary: TokenVocabulary
+        :param grow: Whether unseen tokens are added to the vocabulary, otherwise they become UNKNOWN_TOKEN.
+        :type grow: bool
+        :param min_confidence: Alternatives below this confidence are ignored, an item without any acceptable
+            alternative still takes up its positions but as UNKNOWN_TOKEN.
+        :type min_confidence: float
+        :param with_alternatives: Whether lower ranked alternatives are kept in TokenStream.alternatives.
+        :type with_alternatives: bool
+        :return: The token stream of the transcript.
+        :rtype: TokenStream
+        """
+        stream = TokenStream()
+        to_id = vocabulary.intern if grow else vocabulary.lookup
+        # Transcripts repeat the same few thousand words, so each distinct spelling is only normalized once.
+        cache: Dict[str, Tuple[int, ...]] = {}
+
+        def token_ids_of(content: str) -> Tuple[int, ...]:
+            token_ids = cache.get(content)
+            if token_ids is None:
+                token_ids = cache[content] = tuple(to_id(token) for token in self.normalize(content))
+            return token_ids
+
+        item_idx = -1
+        for item_idx, item in enumerate(items):
+            if item.get('type') == 'punctuation':
+                continue
+            alternatives = item['alternatives']
+            if min_confidence is not None:
+                accepted = [alt for alt in alternatives if float(alt.get('confidence', 1)) >= min_confidence]
+            else:
+                accepted = alternatives
+            # The first alternative is the one with the highest confidence
+            token_ids = token_ids_of(alternatives[0]['content'])
+            if not token_ids:
+                continue
+            if not accepted:
+                token_ids = (UNKNOWN_TOKEN,) * len(token_ids)
+            elif accepted[0] is not alternatives[0]:
+                token_ids = token_ids_of(accepted[0]['content']) or token_ids
+            if with_alternatives and len(accepted) > 1 and len(token_ids) == 1:
+                extra = tuple(
+                    alt_ids[0] for alt_ids in (token_ids_of(alt['content']) for alt in accepted[1:])
+                    if len(alt_ids) == 1 and alt_ids[0] != UNKNOWN_TOKEN
+                )
+                if extra:
+                    stream.alternatives[len(stream.token_ids)] = extra
+            start_time = float(item.get('start_time', 'nan'))
+            end_time = float(item.get('end_time', 'nan'))
+            for token_id in token_ids:
+                stream.token_ids.append(token_id)
+                stream.item_indices.append(item_idx)
+                stream.start_times.append(start_time)
+                stream.end_times.append(end_time)
+        stream.item_count = item_idx + 1
+        return stream
@@ -0,0 +1,94 @@
+import math
+from decimal import Decimal
+from typing import Iterable, List
+
+from analysis.fuzzy_matcher import FuzzyPhraseMatcher
+from analysis.phrase_matcher import PhraseMatcher
+from analysis.tokenizer import TokenStream, TokenVocabulary, Tokenizer
+from models.analysis_options import AnalysisOptions
+from models.sentence import Sentence, SentenceOccurrence
+
+_SCORE_PRECISION = Decimal('0.001')
+
+
+def _seconds(offset: float) -> Decimal:
+    """Converts an item offset to the decimal dynamo can store, None for items without one.
+    """
+    return None if math.isnan(offset) else Decimal(f'{offset:.3f}')
+
+
+class TranscriptAnalyzer(object):
+    """Finds the requested sentences in a transcript.
+
+    Sentences are tokenized and compiled into a matcher once, then every transcript is tokenized once into
+    interned token ids and scanned in a single pass. Exact matching uses a PhraseMatcher, fuzzy matching
+    (options.max_errors > 0) a FuzzyPhraseMatcher that also accepts lower ranked Transcribe alternatives.
+    """
+
+    def __init__(self, sentences: List[Sentence], options: AnalysisOptions = None, tokenizer: Tokenizer = None):
+        """
+        :param sentences: The sentences to search for, their results are updated in place.
+        :type sentences: List[Sentence]
+        :param options: The options of the analysis request.
+        :type options: AnalysisOptions
+        :param tokenizer: The tokenizer to normalize sentences and transcript with.
+        :type tokenizer: Tokenizer
+        """
+        self.sentences = sentences
+        self.options = options or AnalysisOptions()
+        self.tokenizer = tokenizer or Tokenizer()
+        self.vocabulary = TokenVocabulary()
+        self.sentence_tokens = self.tokenizer.tokenize_sentences(
+            (sentence.plain_text for sentence in sentences),
+            self.vocabulary
+        )
+        if self.options.fuzzy:
+            self.matcher = FuzzyPhraseMatcher(self.sentence_tokens, self.options.max_errors)
+        else:
+            self.matcher = PhraseMatcher(self.sentence_tokens)
+
+    def analyse(self, transcript_items: Iterable[dict], grow_vocabulary: bool = False) -> TokenStream:
+        """Searches the transcript for all the sentences and records every occurrence on them.
+
+        :param transcript_items: The items of the transcript returned from Transcribe.
+        :type transcript_items: Iterable[dict]
+        :param grow_vocabulary: Whether every word of the transcript gets its own token id (e.g. to index the
+            stream), otherwise words that are not in any sentence are UNKNOWN_TOKEN. Matches are the same either way.
+        :type grow_vocabulary: bool
+        :return: The token stream of the transcript.
+        :rtype: TokenStream
+        """
+        min_confidence = self.options.min_confidence
+        stream = self.tokenizer.tokenize_items(
+            transcript_items,
+            self.vocabulary,
+            grow=grow_vocabulary,
+            min_confidence=float(min_confidence) if min_confidence is not None else None,
+            with_alternatives=self.options.fuzzy
+        )
+        max_occurrences = self.options.max_occurrences
+
+        if self.options.fuzzy:
+            matches = self.matcher.iter_matches(stream.token_ids, stream.alternatives)
+        else:
+            matches = (
+                (sentence_idx, end - len(self.sentence_tokens[sentence_idx]) + 1, end, 0)
+                for sentence_idx, end in self.matcher.iter_matches(stream.token_ids)
+            )
+
+        for sentence_idx, start, end, errors in matches:
+            # Fuzzy matchers never allow as many errors as the sentence has words.
+            length = len(self.sentence_tokens[sentence_idx])
+            self.sentences[sentence_idx].add_occurrence(
+                SentenceOccurrence(
+                    start_word_index=stream.item_indices[start],
+                    end_word_index=stream.item_indices[end],
+                    start_time=_seconds(stream.start_times[start]),
+                    end_time=_seconds(stream.end_times[end]),
+                    errors=errors
+                ),
+                max_occurrences,
+                score=(Decimal(length - errors) / length).quantize(_SCORE_PRECISION) if errors else Decimal(1)
+            )
+
+        return stream
@@ -0,0 +1,38 @@
+from dataclasses import dataclass
+from decimal import Decimal
+
+
+@dataclass(slots=True)
+class AnalysisOptions:
+    """Dataclass representing the options the requester chose for searching the transcript.
+    """
+    # Cap on the occurrences stored per sentence, so a very common phrase can't blow up the record.
+    max_occurrences: int = None
+    # Word substitutions/insertions tolerated per occurrence, 0 means only exact matches.
+    max_errors: int = 0
+    # Transcribe alternatives below this confidence are ignored.
+    min_confidence: Decimal = None
+
+    def __post_init__(self) -> None:
+        """Deserializes dynamo numbers into python data types.
+        """
+        self.max_occurrences = int(self.max_occurrences) if self.max_occurrences is not None else None
+        self.max_errors = int(self.max_errors or 0)
+        self.min_confidence = (
+            Decimal(str(self.min_confidence)) if isinstance(self.min_confidence, (str, float)) else self.min_confidence
+        )
+
+    @property
+    def fuzzy(self) -> bool:
+        return self.max_errors > 0
+
+    def as_dict(self) -> dict:
+        """Returns the options encoded as a standard python dictionary
+
+        :rtype: dict
+        """
+        return {
+            "max_occurrences": self.max_occurrences,
+            "max_errors": self.max_errors,
+            "min_confidence": self.min_confidence
+        }
@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+from typing import List
+
+from models.sentence import Sentence
+
+
+@dataclass(slots=True)
+class ResultsSummary:
+    """Dataclass representing the counts kept in dynamo once the detailed results are offloaded to s3.
+    """
+    sentence_count: int = 0
+    sentences_found: int = 0
+    # Uncapped total of the occurrences of all the sentences.
+    occurrence_count: int = 0
+
+    def __post_init__(self) -> None:
+        """Deserializes dynamo numbers into python data types.
+        """
+        self.sentence_count = int(self.sentence_count)
+        self.sentences_found = int(self.sentences_found)
+        self.occurrence_count = int(self.occurrence_count)
+
+    @classmethod
+    def from_sentences(cls, sentences: List[Sentence]) -> 'ResultsSummary':
+        """Summarizes the results of the analysed sentences.
+
+        :param sentences: The analysed sentences.
+        :type sentences: List[Sentence]
+        :rtype: ResultsSummary
+        """
+        return cls(
+            sentence_count=len(sentences),
+            sentences_found=sum(1 for sentence in sentences if sentence.was_present),
+            occurrence_count=sum(sentence.occurrence_count for sentence in sentences)
+        )
+
+    def as_dict(self) -> dict:
+        """Returns the summary encoded as a standard python dictionary
+
+        :rtype: dict
+        """
+        return {
+            "sentence_count": self.sentence_count,
+            "sentences_found": self.sentences_found,
+            "occurrence_count": self.occurrence_count
+        }
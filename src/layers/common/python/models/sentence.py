@@ -1,13 +1,117 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import List
 
-@dataclass
+
+@dataclass(slots=True)
+class SentenceOccurrence:
+    """Dataclass representing one place in the transcript where a sentence was found.
+
+    Stored in dynamo as a bare list of its fields (see ``as_item``), a sentence can hold hundreds of them.
+    """
+    start_word_index: int
+    end_word_index: int
+    start_time: Decimal = None
+    end_time: Decimal = None
+    # Substituted or inserted words, only non zero for fuzzy matches.
+    errors: int = 0
+
+    def __post_init__(self) -> None:
+        """Deserializes the audio offsets (in seconds) into decimals, which is what dynamo expects.
+        """
+        self.start_time = Decimal(str(self.start_time)) if isinstance(self.start_time, (str, float)) else self.start_time
+        self.end_time = Decimal(str(self.end_time)) if isinstance(self.end_time, (str, float)) else self.end_time
+
+    def as_dict(self) -> dict:
+        """Returns the occurrence encoded as a standard python dictionary
+
+        :rtype: dict
+        """
+        return {
+            "start_word_index": self.start_word_index,
+            "end_word_index": self.end_word_index,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "errors": self.errors
+        }
+
+    def as_item(self) -> list:
+        """Returns the compact encoding stored in dynamo: the fields as a list, in declaration order.
+
+        :rtype: list
+        """
+        return [self.start_word_index, self.end_word_index, self.start_time, self.end_time, self.errors]
+
+    @classmethod
+    def from_item(cls, item: list) -> 'SentenceOccurrence':
+        """Builds the occurrence from its dynamo encoding (as_item, or as_dict for records stored before it).
+
+        :param item: The encoded occurrence.
+        :type item: list
+        :rtype: SentenceOccurrence
+        """
+        if isinstance(item, dict):
+            return cls(**item)
+        # Dynamo hands back Decimals already, so the conversions of __post_init__ are skipped.
+        occurrence = cls.__new__(cls)
+        (
+            occurrence.start_word_index,
+            occurrence.end_word_index,
+            occurrence.start_time,
+            occurrence.end_time,
+            occurrence.errors
+        ) = item
+        return occurrence
+
+
+@dataclass(slots=True)
 class Sentence:
     """Dataclass representing a sentence which was searched for in the transcript.
+
+    ``start_word_index`` and ``end_word_index`` point at the first occurrence, all the occurrences
+    (up to the requested cap) are in ``occurrences`` and ``occurrence_count`` holds the uncapped total.
+    ``match_score`` is the best occurrence's share of words that matched exactly (1 for exact matches).
     """
     plain_text: str
     was_present: bool = False
     start_word_index: int = None
     end_word_index: int = None
+    occurrence_count: int = 0
+    occurrences: List[SentenceOccurrence] = field(default_factory=list)
+    match_score: Decimal = None
+
+    def __post_init__(self) -> None:
+        """Deserializes the occurrences into python objects.
+        """
+        self.match_score = Decimal(str(self.match_score)) if isinstance(self.match_score, float) else self.match_score
+        self.occurrences = [
+            SentenceOccurrence.from_item(o) if not isinstance(o, SentenceOccurrence) else o
+            for o in self.occurrences
+        ]
+
+    def add_occurrence(
+            self,
+            occurrence: SentenceOccurrence,
+            max_occurrences: int = None,
+            score: Decimal = Decimal(1)) -> None:
+        """Records an occurrence of the sentence, keeping at most max_occurrences of them.
+
+        :param occurrence: The occurrence found in the transcript.
+        :type occurrence: SentenceOccurrence
+        :param max_occurrences: The maximum number of occurrences to keep, None for no limit.
+        :type max_occurrences: int
+        :param score: How well the occurrence matches the sentence, between 0 and 1.
+        :type score: Decimal
+        """
+        if self.match_score is None or score > self.match_score:
+            self.match_score = score
+        if not self.was_present:
+            self.was_present = True
+            self.start_word_index = occurrence.start_word_index
+            self.end_word_index = occurrence.end_word_index
+        self.occurrence_count += 1
+        if max_occurrences is None or len(self.occurrences) < max_occurrences:
+            self.occurrences.append(occurrence)
 
     def as_dict(self) -> dict:
         """Returns the sentence encoded as a standard python dictionary
@@ -18,5 +122,44 @@ class Sentence:
             "plain_text": self.plain_text,
             "was_present": self.was_present,
             "start_word_index": self.start_word_index,
-            "end_word_index": self.end_word_index
+            "end_word_index": self.end_word_index,
+            "occurrence_count": self.occurrence_count,
+            "occurrences": [o.as_dict() for o in self.occurrences],
+            "match_score": self.match_score
+        }
+
+    def as_item(self) -> dict:
+        """Returns the compact encoding stored in dynamo, occurrences as lists and unset fields left out.
+
+        :rtype: dict
+        """
+        item = {
+            "plain_text": self.plain_text,
+            "was_present": self.was_present,
+            "occurrence_count": self.occurrence_count
         }
+        if self.was_present:
+            item["start_word_index"] = self.start_word_index
+            item["end_word_index"] = self.end_word_index
+            item["occurrences"] = [o.as_item() for o in self.occurrences]
+        if self.match_score is not None:
+            item["match_score"] = self.match_score
+        return item
+
+    @classmethod
+    def from_item(cls, item: dict) -> 'Sentence':
+        """Builds the sentence from its dynamo encoding (as_item, or as_dict for records stored before it).
+
+        :param item: The encoded sentence.
+        :type item: dict
+        :rtype: Sentence
+        """
+        sentence = cls.__new__(cls)
+        sentence.plain_text = item["plain_text"]
+        sentence.was_present = item.get("was_present", False)
+        sentence.start_word_index = item.get("start_word_index")
+        sentence.end_word_index = item.get("end_word_index")
+        sentence.occurrence_count = int(item.get("occurrence_count", 0))
+        sentence.occurrences = [SentenceOccurrence.from_item(o) for o in item.get("occurrences", ())]
+        sentence.match_score = item.get("match_score")
+        return sentence
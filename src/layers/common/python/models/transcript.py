@@ -1,9 +1,12 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
+from decimal import Decimal
 from enum import Enum
-from typing import List
+from typing import Dict, List
 from uuid import UUID, uuid4
 
+from models.analysis_options import AnalysisOptions
+from models.results_summary import ResultsSummary
 from models.sentence import Sentence
 
 
@@ -21,9 +24,13 @@ class FileType(Enum):
     MP3 = 'mp3'
 
 
-@dataclass
+@dataclass(slots=True)
 class Transcript:
     """Dataclass representing all metadata associated with a transcript process request.
+
+    ``as_item``/``from_item`` are the (compact) dynamo encoding, ``as_dict`` the plain one returned by the api.
+    Once ``results_path`` is set, the detailed sentence results live in that s3 document and the dynamo item
+    only keeps the sentences' text and the ``results_summary``.
     """
     request_id: uuid4
     audio_url: str
@@ -33,6 +40,35 @@ class Transcript:
     sentences: List[Sentence]
     transcript_path: str = None
     status: str = TranscriptStatus.PENDING
+    analysis_options: AnalysisOptions = field(default_factory=AnalysisOptions)
+    # Request whose transcript was reused because it was made from the same audio.
+    source_request_id: UUID = None
+    results_path: str = None
+    results_summary: ResultsSummary = None
+    # Where to POST the completion event, signed with callback_secret (handed to the requester at submit time).
+    callback_url: str = None
+    callback_secret: str = None
+    # Set on re-analyses: the request whose transcript was searched again, and the version of this result set
+    # among the ones of that request (its own results being version 1).
+    parent_request_id: UUID = None
+    analysis_version: int = None
+    # On the parent request, the version given to its latest re-analysis.
+    latest_analysis_version: int = None
+    # Milliseconds spent in every stage of the pipeline (see StageTimer), keys ending in _at are the epoch
+    # milliseconds a stage still running started at.
+    stage_timings: Dict[str, int] = field(default_factory=dict)
+    # What probing the audio found: its actual format (the url's extension may be wrong), duration in seconds
+    # and sample rate.
+    media_format: FileType = None
+    audio_duration: Decimal = None
+    audio_sample_rate: int = None
+    # Why the request failed, when it did.
+    failure_reason: str = None
+    # Set when the audio was split to be transcribed in parallel: the [start, end] seconds of every segment, each
+    # transcribed by its own job and merged back into transcript_file_path by the analysis.
+    transcribe_segments: List[List[Decimal]] = None
+    # How many times processing the audio failed (deliveries deferred for the transcribe quota don't count).
+    failed_attempts: int = None
 
     def __post_init__(self) -> None:
         """Deserializes into transcript object with Python data types.
@@ -42,10 +78,41 @@ class Transcript:
         self.request_id = UUID(self.request_id) if isinstance(self.request_id, str) else self.request_id
         self.file_type = FileType(self.file_type) if isinstance(self.file_type, str) else self.file_type
         self.status = TranscriptStatus(self.status) if isinstance(self.status, str) else self.status
+        self.source_request_id = (
+            UUID(self.source_request_id) if isinstance(self.source_request_id, str) else self.source_request_id
+        )
+        self.parent_request_id = (
+            UUID(self.parent_request_id) if isinstance(self.parent_request_id, str) else self.parent_request_id
+        )
+        self.analysis_version = int(self.analysis_version) if self.analysis_version is not None else None
+        self.latest_analysis_version = (
+            int(self.latest_analysis_version) if self.latest_analysis_version is not None else None
+        )
+        self.stage_timings = {k: int(v) for k, v in (self.stage_timings or {}).items()}
+        self.media_format = FileType(self.media_format) if isinstance(self.media_format, str) else self.media_format
+        self.audio_duration = (
+            Decimal(str(self.audio_duration)) if isinstance(self.audio_duration, (str, float)) else self.audio_duration
+        )
+        self.audio_sample_rate = int(self.audio_sample_rate) if self.audio_sample_rate is not None else None
+        self.transcribe_segments = (
+            [[Decimal(str(bound)) for bound in segment] for segment in self.transcribe_segments]
+            if self.transcribe_segments is not None else None
+        )
+        self.failed_attempts = int(self.failed_attempts) if self.failed_attempts is not None else None
         self.sentences = [
             Sentence(**s) if not isinstance(s, Sentence) else s
             for s in self.sentences
         ]
+        self.analysis_options = (
+            AnalysisOptions(**self.analysis_options)
+            if isinstance(self.analysis_options, dict)
+            else self.analysis_options or AnalysisOptions()
+        )
+        self.results_summary = (
+            ResultsSummary(**self.results_summary)
+            if isinstance(self.results_summary, dict)
+            else self.results_summary
+        )
 
     def as_dict(self) -> dict:
         """Encodes the transcript to a python dictionary so it can be sent as json to dynamo.
@@ -61,7 +128,138 @@ class Transcript:
             "file_type": self.file_type.value,
             "status": self.status.value,
             "sentences": [s.as_dict() for s in self.sentences],
-            "transcript_path": self.transcript_path
+            "transcript_path": self.transcript_path,
+            "analysis_options": self.analysis_options.as_dict(),
+            "source_request_id": self.source_request_id.hex if self.source_request_id else None,
+            "results_path": self.results_path,
+            "results_summary": self.results_summary.as_dict() if self.results_summary else None,
+            "callback_url": self.callback_url,
+            "callback_secret": self.callback_secret,
+            "parent_request_id": self.parent_request_id.hex if self.parent_request_id else None,
+            "analysis_version": self.analysis_version,
+            "latest_analysis_version": self.latest_analysis_version,
+            "stage_timings": self.stage_timings,
+            "media_format": self.media_format.value if self.media_format else None,
+            "audio_duration": self.audio_duration,
+            "audio_sample_rate": self.audio_sample_rate,
+            "failure_reason": self.failure_reason,
+            "transcribe_segments": self.transcribe_segments,
+            "failed_attempts": self.failed_attempts
+        }
+
+    def as_item(self) -> dict:
+        """Encodes the transcript for dynamo: sentences in their compact form, unset fields left out.
+
+        :return: The dynamo item.
+        :rtype: dict
+        """
+        if self.sentences is None:
+            raise Exception(f'Transcript {self.request_id.hex} was loaded without its sentences, it can\'t be saved!')
+        item = {
+            "request_id": self.request_id.hex,
+            "audio_url": self.audio_url,
+            "created": self.created.isoformat(),
+            "updated": self.updated.isoformat(),
+            "file_type": self.file_type.value,
+            "status": self.status.value,
+            "sentences": [
+                {"plain_text": s.plain_text} if self.results_path else s.as_item()
+                for s in self.sentences
+            ],
+            "analysis_options": {k: v for k, v in self.analysis_options.as_dict().items() if v is not None}
+        }
+        if self.transcript_path is not None:
+            item["transcript_path"] = self.transcript_path
+        if self.source_request_id is not None:
+            item["source_request_id"] = self.source_request_id.hex
+        if self.results_path is not None:
+            item["results_path"] = self.results_path
+            item["results_summary"] = self.results_summary.as_dict()
+        if self.callback_url is not None:
+            item["callback_url"] = self.callback_url
+            item["callback_secret"] = self.callback_secret
+        if self.parent_request_id is not None:
+            item["parent_request_id"] = self.parent_request_id.hex
+            item["analysis_version"] = self.analysis_version
+        if self.latest_analysis_version is not None:
+            item["latest_analysis_version"] = self.latest_analysis_version
+        if self.stage_timings:
+            item["stage_timings"] = self.stage_timings
+        if self.media_format is not None:
+            item["media_format"] = self.media_format.value
+        if self.audio_duration is not None:
+            item["audio_duration"] = self.audio_duration
+        if self.audio_sample_rate is not None:
+            item["audio_sample_rate"] = self.audio_sample_rate
+        if self.failure_reason is not None:
+            item["failure_reason"] = self.failure_reason
+        if self.transcribe_segments is not None:
+            item["transcribe_segments"] = self.transcribe_segments
+        if self.failed_attempts is not None:
+            item["failed_attempts"] = self.failed_attempts
+        return item
+
+    @classmethod
+    def from_item(cls, item: dict, load_sentences: bool = True) -> 'Transcript':
+        """Decodes a dynamo item (as_item, or as_dict for records stored before it).
+
+        :param item: The dynamo item.
+        :type item: dict
+        :param load_sentences: False leaves the sentences undecoded (None), e.g. when only the status is needed.
+            Such a transcript can't be saved back.
+        :type load_sentences: bool
+        :rtype: Transcript
+        """
+        transcript = cls.__new__(cls)
+        transcript.request_id = UUID(item["request_id"])
+        transcript.audio_url = item.get("audio_url")
+        transcript.created = datetime.fromisoformat(item["created"])
+        transcript.updated = datetime.fromisoformat(item["updated"])
+        transcript.file_type = FileType(item["file_type"])
+        transcript.status = TranscriptStatus(item.get("status", TranscriptStatus.PENDING.value))
+        transcript.sentences = (
+            [Sentence.from_item(s) for s in item.get("sentences", ())] if load_sentences else None
+        )
+        transcript.transcript_path = item.get("transcript_path")
+        transcript.analysis_options = AnalysisOptions(**item.get("analysis_options", {}))
+        source_request_id = item.get("source_request_id")
+        transcript.source_request_id = UUID(source_request_id) if source_request_id else None
+        transcript.results_path = item.get("results_path")
+        results_summary = item.get("results_summary")
+        transcript.results_summary = ResultsSummary(**results_summary) if results_summary else None
+        transcript.callback_url = item.get("callback_url")
+        transcript.callback_secret = item.get("callback_secret")
+        parent_request_id = item.get("parent_request_id")
+        transcript.parent_request_id = UUID(parent_request_id) if parent_request_id else None
+        analysis_version = item.get("analysis_version")
+        transcript.analysis_version = int(analysis_version) if analysis_version is not None else None
+        latest_analysis_version = item.get("latest_analysis_version")
+        transcript.latest_analysis_version = (
+            int(latest_analysis_version) if latest_analysis_version is not None else None
+        )
+        transcript.stage_timings = {k: int(v) for k, v in item.get("stage_timings", {}).items()}
+        media_format = item.get("media_format")
+        transcript.media_format = FileType(media_format) if media_format else None
+        transcript.audio_duration = item.get("audio_duration")
+        audio_sample_rate = item.get("audio_sample_rate")
+        transcript.audio_sample_rate = int(audio_sample_rate) if audio_sample_rate is not None else None
+        transcript.failure_reason = item.get("failure_reason")
+        transcript.transcribe_segments = item.get("transcribe_segments")
+        failed_attempts = item.get("failed_attempts")
+        transcript.failed_attempts = int(failed_attempts) if failed_attempts is not None else None
+        return transcript
+
+    def as_results_document(self) -> dict:
+        """Returns the detailed results document stored at results_path.
+
+        :rtype: dict
+        """
+        return {
+            "request_id": self.request_id.hex,
+            "parent_request_id": self.parent_request_id.hex if self.parent_request_id else None,
+            "analysis_version": self.analysis_version or 1,
+            "results_summary": self.results_summary.as_dict(),
+            "sentences": [sentence.as_dict() for sentence in self.sentences]
         }
 
     @property
@@ -72,6 +270,19 @@ class Transcript:
     def transcript_file_path(self):
         return f'transcripts/{self.request_id.hex}/transcript.json'
 
+    @property
+    def segment_transcripts_prefix(self):
+        return f'transcripts/{self.request_id.hex}/segments/'
+
+    def segment_audio_file_path(self, segment: int) -> str:
+        return f'audio_segments/{self.request_id.hex}/{segment:04d}.wav'
+
+    def segment_transcript_file_path(self, segment: int) -> str:
+        return f'{self.segment_transcripts_prefix}{segment:04d}.json'
+
     @property
     def results_file_path(self):
+        if self.parent_request_id:
+            # Re-analyses are kept next to the results of the request they were made from.
+            return f'results/{self.parent_request_id.hex}/v{self.analysis_version}/results.json'
         return f'results/{self.request_id.hex}/results.json'
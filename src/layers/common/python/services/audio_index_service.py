@@ -0,0 +1,72 @@
+import hashlib
+from typing import Optional
+
+from services.s3_service import S3Service
+
+INDEX_PREFIX = 'audio_index'
+# Index entries keyed by the source url and its version (ETag/Last-Modified) reported by the server.
+URL_INDEX = 'url'
+# Index entries keyed by the fingerprint of our copy of the audio file, for sources that don't report a version
+# or the same recording served from different urls.
+CONTENT_INDEX = 'content'
+
+
+class AudioIndexService(object):
+    """Content-addressed index of the audio files we already transcribed.
+
+    Every entry is a small json object under audio_index/<kind>/<sha256 of the fingerprint>.json pointing to the
+    request whose transcript was produced from that audio, so a repeat submission can reuse the transcript instead
+    of starting another Transcribe job.
+    """
+
+    def __init__(self, bucket: str, s3_service: S3Service = None):
+        """
+        :param bucket: The bucket holding the index and the transcripts.
+        :type bucket: str
+        :param s3_service: The service used to access s3.
+        :type s3_service: S3Service
+        """
+        self.bucket = bucket
+        self.s3_service = s3_service or S3Service()
+
+    @staticmethod
+    def _index_key(kind: str, fingerprint: str) -> str:
+        return f'{INDEX_PREFIX}/{kind}/{hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()}.json'
+
+    def find_transcript(self, kind: str, fingerprint: str) -> Optional[dict]:
+        """Looks up the transcript produced from the audio with the given fingerprint.
+
+        :param kind: The index to look in (URL_INDEX or CONTENT_INDEX).
+        :type kind: str
+        :param fingerprint: The fingerprint of the audio.
+        :type fingerprint: str
+        :return: The index entry (request_id and transcript_path), None if there is no finished transcript.
+        :rtype: dict
+        """
+        if not fingerprint:
+            return None
+        entry = self.s3_service.read_json_file_if_exists(self.bucket, self._index_key(kind, fingerprint))
+        # The indexed request may still be transcribing, or its job may have failed.
+        if not entry or not self.s3_service.object_exists(self.bucket, entry['transcript_path']):
+            return None
+        return entry
+
+    def register(self, kind: str, fingerprint: str, request_id: str, transcript_path: str) -> None:
+        """Points the fingerprint to the transcript of the given request (replacing any previous entry).
+
+        :param kind: The index to write to (URL_INDEX or CONTENT_INDEX).
+        :type kind: str
+        :param fingerprint: The fingerprint of the audio.
+        :type fingerprint: str
+        :param request_id: The request the transcript belongs to.
+        :type request_id: str
+        :param transcript_path: The key of the transcript (it may not exist yet).
+        :type transcript_path: str
+        """
+        if not fingerprint:
+            return
+        self.s3_service.write_json_file(
+            self.bucket,
+            self._index_key(kind, fingerprint),
+            {'request_id': request_id, 'transcript_path': transcript_path}
+        )
@@ -0,0 +1,213 @@
+import struct
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from models.transcript import FileType
+
+# How many bytes of the file are read to probe it (more are requested for headers past them, when possible).
+PROBE_BYTES = 64 * 1024
+# How far after the ID3 tag the first MPEG frame is looked for (some encoders pad it).
+MP3_SYNC_SEARCH_BYTES = 8 * 1024
+
+# Kbps by bitrate index (1-14), per (MPEG1?, layer)
+_MP3_BITRATES = {
+    (True, 1): (32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Hz by sample rate index, per version bits (3: MPEG1, 2: MPEG2, 0: MPEG2.5)
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+class AudioProbeError(Exception):
+    """The file is not audio we can transcribe (or is damaged), retrying won't help.
+    """
+
+
+@dataclass(slots=True)
+class AudioInfo:
+    """What the header of an audio file tells about it. duration (seconds) and sample_rate are None when the
+    header doesn't say and the size of the file is unknown.
+    """
+    media_format: FileType
+    duration: float = None
+    sample_rate: int = None
+    channels: int = None
+
+
+class _Header(object):
+    """The probed bytes of a file, and the way to read further ones (a range request) if the source allows it.
+    """
+
+    def __init__(self, data: bytes, size: Optional[int], read_range: Callable[[int, int], bytes] = None):
+        self.data = data
+        self.size = size
+        self.read_range = read_range
+
+    def bytes_at(self, offset: int, length: int) -> bytes:
+        if offset + length <= len(self.data) or self.read_range is None:
+            return self.data[offset:offset + length]
+        if self.size is not None:
+            length = min(length, self.size - offset)
+        return self.read_range(offset, length) if length > 0 else b''
+
+
+def probe_audio(data: bytes, size: Optional[int], read_range: Callable[[int, int], bytes] = None) -> AudioInfo:
+    """Detects the format of an audio file from its first bytes (WAV: RIFF/fmt/data chunks, MP3: ID3 tag and MPEG
+    frame headers) and estimates its duration and sample rate.
+
+    :param data: The first bytes of the file (PROBE_BYTES, or the whole file if it's shorter).
+    :type data: bytes
+    :param size: The size of the file in bytes, None if the source doesn't report it.
+    :type size: Optional[int]
+    :param read_range: Reads length bytes at an offset of the file, for headers past data (e.g. a large ID3 tag).
+    :type read_range: Callable[[int, int], bytes]
+    :raises AudioProbeError: If the file is empty, not WAV nor MP3, or its header is invalid.
+    :rtype: AudioInfo
+    """
+    if not data:
+        raise AudioProbeError('The audio file is empty!')
+    header = _Header(data, size, read_range)
+    if data[:4] == b'RIFF':
+        return _probe_wav(header)
+    if data[:3] == b'ID3' or _mp3_frame(data, 0) is not None:
+        return _probe_mp3(header)
+    raise AudioProbeError(f'Not a WAV or MP3 file (starts with {data[:8].hex(" ")})!')
+
+
+def _probe_wav(header: _Header) -> AudioInfo:
+    if header.bytes_at(8, 4) != b'WAVE':
+        raise AudioProbeError('RIFF file that is not WAVE audio!')
+
+    offset = 12
+    fmt = None
+    while True:
+        chunk = header.bytes_at(offset, 8)
+        if len(chunk) < 8:
+            break
+        chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            fields = header.bytes_at(body, 16)
+            if chunk_size < 16 or len(fields) < 16:
+                raise AudioProbeError('Truncated WAV fmt chunk!')
+            _, channels, sample_rate, byte_rate, _, _ = struct.unpack('<HHIIHH', fields)
+            if not channels or not sample_rate or not byte_rate:
+                raise AudioProbeError(
+                    f'Invalid WAV fmt chunk ({channels} channels, {sample_rate}Hz, {byte_rate} bytes/s)!'
+                )
+            fmt = (channels, sample_rate, byte_rate)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise AudioProbeError('WAV data chunk before its fmt chunk!')
+            channels, sample_rate, byte_rate = fmt
+            available = header.size - body if header.size is not None else None
+            # Writers that stream the file leave the size unset.
+            data_size = chunk_size if chunk_size not in (0, 0xFFFFFFFF) else available
+            if available is not None and data_size is not None:
+                data_size = min(data_size, available)
+            if data_size is not None and data_size <= 0:
+                raise AudioProbeError('The WAV file has no audio data!')
+            return AudioInfo(
+                FileType.WAV,
+                data_size / byte_rate if data_size is not None else None,
+                sample_rate,
+                channels
+            )
+        offset = body + chunk_size + (chunk_size & 1)
+
+    if fmt is None:
+        raise AudioProbeError('No fmt chunk in the WAV header!')
+    # The data chunk is past what could be read, the rest of the file is about its size.
+    channels, sample_rate, byte_rate = fmt
+    duration = (header.size - offset) / byte_rate if header.size is not None and header.size > offset else None
+    return AudioInfo(FileType.WAV, duration, sample_rate, channels)
+
+
+def _mp3_frame(data: bytes, offset: int) -> Optional[tuple]:
+    """Parses the MPEG audio frame header at offset.
+
+    :return: (mpeg1, layer, bitrate (bps), sample rate, channels, frame length, samples per frame), None if
+        there is no valid frame header there.
+    :rtype: Optional[tuple]
+    """
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    version = (b1 >> 3) & 3
+    layer = 4 - ((b1 >> 1) & 3)
+    bitrate_idx = b2 >> 4
+    sample_rate_idx = (b2 >> 2) & 3
+    # Reserved values, and free format bitrates (not supported by Transcribe either).
+    if version == 1 or layer == 4 or bitrate_idx in (0, 15) or sample_rate_idx == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_idx - 1] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_idx]
+    padding = (b2 >> 1) & 1
+    channels = 1 if b3 >> 6 == 3 else 2
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if mpeg1 or layer == 2 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    return mpeg1, layer, bitrate, sample_rate, channels, length, samples
+
+
+def _probe_mp3(header: _Header) -> AudioInfo:
+    start = 0
+    if header.data[:3] == b'ID3':
+        tag = header.bytes_at(0, 10)
+        if len(tag) < 10:
+            raise AudioProbeError('Truncated ID3 tag!')
+        # Syncsafe integer: 7 bits per byte
+        tag_size = (tag[6] & 0x7F) << 21 | (tag[7] & 0x7F) << 14 | (tag[8] & 0x7F) << 7 | (tag[9] & 0x7F)
+        start = 10 + tag_size + (10 if tag[5] & 0x10 else 0)
+
+    window = header.bytes_at(start, MP3_SYNC_SEARCH_BYTES)
+    if not window and header.read_range is None and start >= len(header.data):
+        # The tag is longer than the probed bytes and the source can't be read further, trust the tag.
+        return AudioInfo(FileType.MP3)
+
+    for idx in range(max(len(window) - 3, 0)):
+        frame = _mp3_frame(window, idx)
+        if frame is None:
+            continue
+        mpeg1, layer, bitrate, sample_rate, channels, length, samples = frame
+        following = _mp3_frame(window, idx + length)
+        if idx + length + 4 <= len(window) and (following is None or following[3] != sample_rate):
+            # A false sync: no consistent frame right after this one.
+            continue
+
+        frame_start = start + idx
+        frames = _vbr_frame_count(window, idx, mpeg1, channels)
+        if frames:
+            duration = frames * samples / sample_rate
+        elif header.size is not None:
+            # Constant bitrate
+            duration = (header.size - frame_start) * 8 / bitrate
+        else:
+            duration = None
+        return AudioInfo(FileType.MP3, duration, sample_rate, channels)
+
+    raise AudioProbeError('No MPEG audio frame found in the MP3 file!')
+
+
+def _vbr_frame_count(data: bytes, offset: int, mpeg1: bool, channels: int) -> Optional[int]:
+    """Reads the frame count of the Xing/Info or VBRI header variable bitrate encoders put in the first frame.
+    """
+    # The Xing header follows the side information of the frame.
+    xing = offset + 4 + ((32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9))
+    if data[xing:xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12:
+        flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+        if flags & 1:
+            return struct.unpack('>I', data[xing + 8:xing + 12])[0]
+    vbri = offset + 4 + 32
+    if data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+        return struct.unpack('>I', data[vbri + 14:vbri + 18])[0]
+    return None
@@ -0,0 +1,116 @@
+import math
+import tempfile
+import wave
+from decimal import Decimal
+from typing import IO, Iterator, List, Tuple
+
+# How many frames are copied at a time.
+COPY_FRAMES = 64 * 1024
+
+
+def segment_bounds(total: int, segment: int, overlap: int) -> List[Tuple[int, int]]:
+    """Splits total frames into the fewest segments of at most segment frames, every one overlapping the previous
+    one by overlap frames. Segments are as long as each other (give or take one step), so none is a short tail.
+
+    :param total: The frames of the audio.
+    :type total: int
+    :param segment: The maximum frames of a segment, more than overlap.
+    :type segment: int
+    :param overlap: The frames every segment shares with the previous one.
+    :type overlap: int
+    :return: The [start, end) frames of every segment.
+    :rtype: List[Tuple[int, int]]
+    """
+    if total <= segment:
+        return [(0, total)]
+    count = math.ceil((total - overlap) / (segment - overlap))
+    step = math.ceil((total - overlap) / count)
+    return [(idx * step, min(idx * step + step + overlap, total)) for idx in range(count)]
+
+
+class _Unseekable(object):
+    """Only exposes read, so wave reads the stream sequentially (it would try to seek a stream that has a tell).
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        return self._stream.read(size)
+
+
+class WavSplitter(object):
+    """Splits a WAV stream into overlapping segments, on frame boundaries and in a single sequential pass.
+
+    The bounds are known as soon as the header is read, before any segment is written. Only the overlap is kept in
+    memory, segments are written to temporary files.
+    """
+
+    def __init__(self, stream, segment_seconds: float, overlap_seconds: float, duration: float = None):
+        """Reads the header of the WAV file.
+
+        :param stream: The WAV file, read from its start (e.g. the body of an s3 object).
+        :param segment_seconds: The maximum length of a segment.
+        :type segment_seconds: float
+        :param overlap_seconds: How long every segment overlaps the previous one, less than segment_seconds.
+        :type overlap_seconds: float
+        :param duration: The duration of the audio if it's known to be shorter than the header says (e.g. the file
+            was truncated), seconds.
+        :type duration: float
+        :raises wave.Error: If the wave module can't read the file (e.g. compressed audio).
+        """
+        self._wav = wave.open(_Unseekable(stream), 'rb')
+        self.params = self._wav.getparams()
+        self.frame_size = self.params.sampwidth * self.params.nchannels
+        total = self.params.nframes
+        if duration is not None:
+            total = min(total, int(duration * self.params.framerate))
+        self.bounds = segment_bounds(
+            total,
+            int(segment_seconds * self.params.framerate),
+            int(overlap_seconds * self.params.framerate)
+        )
+
+    def bounds_seconds(self) -> List[List[Decimal]]:
+        """The [start, end] of every segment in seconds (millisecond precision), as stored on the transcript.
+
+        :rtype: List[List[Decimal]]
+        """
+        rate = self.params.framerate
+        return [[Decimal(f'{start / rate:.3f}'), Decimal(f'{end / rate:.3f}')] for start, end in self.bounds]
+
+    def iter_segments(self) -> Iterator[Tuple[int, IO[bytes]]]:
+        """Writes the segments one after the other, each is only valid until the next one is requested.
+
+        :return: The index and the WAV file (positioned at its start) of every segment.
+        :rtype: Iterator[Tuple[int, IO[bytes]]]
+        """
+        # The frames read so far past the start of the current segment, from carried_at on.
+        carried_at, carried = 0, b''
+        position = 0
+        for idx, (start, end) in enumerate(self.bounds):
+            next_start = self.bounds[idx + 1][0] if idx + 1 < len(self.bounds) else end
+            written = 0
+            overlap = []
+            with tempfile.TemporaryFile() as file:
+                with wave.open(file, 'wb') as segment:
+                    segment.setparams(self.params._replace(nframes=end - start))
+                    frames, frames_at = carried[(start - carried_at) * self.frame_size:], start
+                    while True:
+                        if frames:
+                            segment.writeframes(frames)
+                            written += len(frames)
+                            if frames_at + len(frames) // self.frame_size > next_start:
+                                overlap.append(frames[max(next_start - frames_at, 0) * self.frame_size:])
+                        if position >= end:
+                            break
+                        frames, frames_at = self._wav.readframes(min(COPY_FRAMES, end - position)), position
+                        if not frames:
+                            # Fewer frames than the header says, the segment ends with the file.
+                            break
+                        position += len(frames) // self.frame_size
+                if not written:
+                    raise Exception(f'The WAV file ends before its segment {idx} (frames {start}-{end})!')
+                carried_at, carried = next_start, b''.join(overlap)
+                file.seek(0)
+                yield idx, file
@@ -0,0 +1,194 @@
+import codecs
+import json
+import re
+from typing import Any, BinaryIO, Iterator, Sequence
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRUCTURAL = re.compile(r'["{}\[\]]')
+_SCALAR = re.compile(r'[^,:\]}\s]+')
+
+
+class _JsonStreamScanner(object):
+    """Minimal incremental JSON scanner over a binary stream.
+
+    Only a window of the document is kept in memory: values outside the requested path are skipped
+    without being decoded, and consumed input is dropped every time the window is refilled.
+    """
+
+    def __init__(self, stream: BinaryIO, chunk_size: int):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._eof = False
+        self.buffer = ''
+        self.pos = 0
+
+    def _fill(self) -> bool:
+        """Appends the next chunk of the stream to the window, returns False once the stream is exhausted.
+        """
+        if self._eof:
+            return False
+        chunk = self._stream.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            self.buffer += self._decoder.decode(b'', final=True)
+            return False
+        self.buffer = self.buffer[self.pos:] + self._decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def _error(self, message: str) -> ValueError:
+        return ValueError(f'{message} (near: {self.buffer[self.pos:self.pos + 32]!r})')
+
+    def peek(self) -> str:
+        """Skips whitespace and returns the next character without consuming it ('' at the end of the stream).
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise self._error(f'Expected {char!r}')
+        self.pos += 1
+
+    def _match(self, pattern: re.Pattern) -> re.Match:
+        while True:
+            match = pattern.match(self.buffer, self.pos)
+            # A match touching the end of the window may continue in the next chunk.
+            if match and (match.end() < len(self.buffer) or self._eof):
+                return match
+            if not self._fill():
+                if match:
+                    return match
+                raise self._error('Unexpected end of JSON stream')
+
+    def _skip_string(self, keep: bool = False) -> int:
+        """Moves past the string starting at the current position and returns where it started in the window.
+
+        Unless keep is set, the part of the string already scanned is dropped on every refill, so long strings
+        (like the full transcript text) are skipped in constant memory.
+        """
+        scan_from = self.pos + 1
+        while True:
+            end = self.buffer.find('"', scan_from)
+            if end < 0:
+                scan_from = len(self.buffer)
+                if not keep:
+                    # Keep the last character that is not a backslash, so escapes still resolve after the refill.
+                    while self.buffer[scan_from - 1] == '\\':
+                        scan_from -= 1
+                    self.pos = scan_from - 1
+                # The window is compacted up to self.pos on refill.
+                scan_from -= self.pos
+                if not self._fill():
+                    raise self._error('Unexpected end of JSON stream')
+                continue
+            backslash = end - 1
+            while self.buffer[backslash] == '\\':
+                backslash -= 1
+            if (end - backslash) % 2:
+                start, self.pos = self.pos, end + 1
+                return start
+            scan_from = end + 1
+
+    def read_string(self) -> str:
+        if self.peek() != '"':
+            raise self._error('Expected a string')
+        start = self._skip_string(keep=True)
+        return json.loads(self.buffer[start:self.pos])
+
+    def read_value(self) -> Any:
+        if self.peek() not in ('"', '{', '[', 't', 'f', 'n'):
+            # Numbers have no terminator, so read the whole token before decoding it.
+            match = self._match(_SCALAR)
+            self.pos = match.end()
+            return json.loads(match.group())
+        while True:
+            try:
+                value, self.pos = self._json_decoder.raw_decode(self.buffer, self.pos)
+                return value
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+
+    def skip_value(self) -> None:
+        char = self.peek()
+        if char == '"':
+            self._skip_string()
+        elif char in ('{', '['):
+            depth = 0
+            while True:
+                match = _STRUCTURAL.search(self.buffer, self.pos)
+                if not match:
+                    self.pos = len(self.buffer)
+                    if not self._fill():
+                        raise self._error('Unexpected end of JSON stream')
+                    continue
+                char = match.group()
+                if char == '"':
+                    self.pos = match.start()
+                    self._skip_string()
+                    continue
+                self.pos = match.end()
+                depth += 1 if char in ('{', '[') else -1
+                if depth == 0:
+                    return
+        elif char:
+            self.pos = self._match(_SCALAR).end()
+        else:
+            raise self._error('Unexpected end of JSON stream')
+
+    def iter_array(self, path: Sequence[str]) -> Iterator[Any]:
+        """Walks down the object keys in path and yields the elements of the array found there.
+        """
+        if path:
+            if self.peek() != '{':
+                return
+            self.pos += 1
+            while self.peek() != '}':
+                key = self.read_string()
+                self.expect(':')
+                if key == path[0]:
+                    # Nothing after the array is needed, so the rest of the document is never read.
+                    yield from self.iter_array(path[1:])
+                    return
+                self.skip_value()
+                if self.peek() == ',':
+                    self.pos += 1
+            return
+
+        if self.peek() != '[':
+            return
+        self.pos += 1
+        if self.peek() == ']':
+            return
+        while True:
+            yield self.read_value()
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise self._error('Expected \',\' or \']\'')
+
+
+def iter_json_array(stream: BinaryIO, path: Sequence[str], chunk_size: int = 64 * 1024) -> Iterator[Any]:
+    """Lazily yields the elements of the array found under path in a JSON document read from a binary stream.
+
+    Memory use only depends on chunk_size and the size of a single element, not on the size of the document.
+
+    :param stream: A binary file-like object holding a JSON document.
+    :type stream: BinaryIO
+    :param path: The keys leading to the array, e.g. ('results', 'items').
+    :type path: Sequence[str]
+    :param chunk_size: How many bytes to read from the stream at once.
+    :type chunk_size: int
+    :return: The elements of the array, nothing if the path doesn't exist.
+    :rtype: Iterator[Any]
+    """
+    return _JsonStreamScanner(stream, chunk_size).iter_array(path)
@@ -0,0 +1,143 @@
+import hashlib
+import hmac
+import json
+import random
+import time
+from typing import Dict, List
+
+import urllib3
+
+from models.transcript import Transcript
+from services.providers.client_provider import ClientProvider
+from services.s3_service import json_default
+from services.sqs_service import SQSService
+
+SIGNATURE_HEADER = 'X-Signature'
+TIMESTAMP_HEADER = 'X-Signature-Timestamp'
+
+
+def sign_callback(secret: str, timestamp: str, body: bytes) -> str:
+    """Returns the signature of a callback: the hex HMAC-SHA256 of '<timestamp>.<body>' with the request's secret.
+
+    :param secret: The callback secret of the request.
+    :type secret: str
+    :param timestamp: The unix timestamp sent in the X-Signature-Timestamp header.
+    :type timestamp: str
+    :param body: The raw body of the callback.
+    :type body: bytes
+    :rtype: str
+    """
+    return hmac.new(secret.encode('utf-8'), timestamp.encode('utf-8') + b'.' + body, hashlib.sha256).hexdigest()
+
+
+class NotificationService(object):
+    """Publishes an event when a request reaches a final status (completed or failed).
+
+    Events go to the notification queue, if one is configured, and to the callback url of the request, if it
+    gave one. Callbacks are POSTed as json, signed with the request's callback secret (see sign_callback) and
+    retried with backoff. Notifications are best effort: failures are returned for logging, never raised.
+    """
+
+    def __init__(
+            self,
+            queue_url: str = None,
+            callback_attempts: int = 3,
+            callback_timeout: float = 5.0,
+            retry_base_delay: float = 0.5):
+        """
+        :param queue_url: The sqs queue to publish events to, None to only call the callbacks.
+        :type queue_url: str
+        :param callback_attempts: How many times a callback is tried.
+        :type callback_attempts: int
+        :param callback_timeout: Timeout (seconds) of every callback attempt.
+        :type callback_timeout: float
+        :param retry_base_delay: The base delay (seconds) of the exponential backoff between attempts.
+        :type retry_base_delay: float
+        """
+        self.queue_url = queue_url
+        self.sqs_service = SQSService()
+        self.callback_attempts = callback_attempts
+        self.callback_timeout = callback_timeout
+        self.retry_base_delay = retry_base_delay
+
+    @staticmethod
+    def build_event(transcript: Transcript) -> dict:
+        """Returns the event published for the transcript's current status.
+
+        :param transcript: The transcript that reached a final status.
+        :type transcript: Transcript
+        :rtype: dict
+        """
+        return {
+            'event': f'analysis.{transcript.status.value}',
+            'request_id': transcript.request_id.hex,
+            'status': transcript.status.value,
+            'updated': transcript.updated.isoformat(),
+            'results_path': transcript.results_path,
+            'results_summary': transcript.results_summary.as_dict() if transcript.results_summary else None,
+            'failure_reason': transcript.failure_reason
+        }
+
+    def notify(self, transcripts: List[Transcript]) -> Dict[str, str]:
+        """Publishes the events of the given transcripts.
+
+        :param transcripts: The transcripts that reached a final status (and were saved).
+        :type transcripts: List[Transcript]
+        :return: What went wrong for every request whose event could not be delivered, keyed by request_id.
+        :rtype: Dict[str, str]
+        """
+        events = {transcript.request_id.hex: self.build_event(transcript) for transcript in transcripts}
+        failures: Dict[str, str] = {}
+        if self.queue_url and events:
+            request_ids = list(events)
+            try:
+                errors = self.sqs_service.send_message_batch(list(events.values()), self.queue_url)
+            except Exception as exc:
+                # e.g. a client error for the whole batch, it's reported for every request.
+                errors = {idx: str(exc) for idx in range(len(request_ids))}
+            for idx, error in errors.items():
+                failures[request_ids[idx]] = f'Failed to publish the event: {error}'
+
+        for transcript in transcripts:
+            if transcript.callback_url:
+                error = self.send_callback(transcript, events[transcript.request_id.hex])
+                if error:
+                    failures[transcript.request_id.hex] = f'Callback to {transcript.callback_url} failed: {error}'
+        return failures
+
+    def send_callback(self, transcript: Transcript, event: dict) -> str:
+        """POSTs the event to the transcript's callback url, retrying connection errors and 5xx/429 answers.
+
+        :param transcript: The transcript with the callback url and secret.
+        :type transcript: Transcript
+        :param event: The event to send.
+        :type event: dict
+        :return: None once the receiver accepted the event (2xx), else what went wrong on the last attempt.
+        :rtype: str
+        """
+        body = json.dumps(event, default=json_default, separators=(',', ':')).encode('utf-8')
+        for attempt in range(self.callback_attempts):
+            timestamp = str(int(time.time()))
+            headers = {'Content-Type': 'application/json', TIMESTAMP_HEADER: timestamp}
+            if transcript.callback_secret:
+                headers[SIGNATURE_HEADER] = f'sha256={sign_callback(transcript.callback_secret, timestamp, body)}'
+            try:
+                response = ClientProvider.get_http().request(
+                    'POST',
+                    transcript.callback_url,
+                    body=body,
+                    headers=headers,
+                    timeout=self.callback_timeout,
+                    retries=False
+                )
+                if 200 <= response.status < 300:
+                    return None
+                details = f'status {response.status}'
+                if response.status < 500 and response.status != 429:
+                    # The receiver refused the event, sending it again won't help.
+                    break
+            except urllib3.exceptions.HTTPError as exc:
+                details = str(exc)
+            if attempt < self.callback_attempts - 1:
+                time.sleep(random.uniform(0, self.retry_base_delay * 2 ** attempt))
+        return details
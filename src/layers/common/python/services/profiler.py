@@ -0,0 +1,160 @@
+import cProfile
+import functools
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Iterable
+
+from services.s3_service import S3Service
+
+PROFILES_PREFIX = 'profiles'
+DEFAULT_TOP_ALLOCATIONS = 50
+
+logger = logging.getLogger(__name__)
+# tracemalloc is process wide, invocations running at the same time (e.g. local runs) aren't profiled together.
+_profiling = threading.Lock()
+
+
+def profiled(function_name: str, request_ids: Callable[[dict], Iterable[str]]) -> Callable:
+    """Decorates a lambda handler to profile (cProfile and tracemalloc) some of its invocations.
+
+    Turned on by the PROFILING_ENABLED (every invocation) or PROFILING_SAMPLE_RATE (that fraction of the
+    invocations) environment variables, read when the handler is decorated. When both are off the handler is
+    returned as it is, so profiling costs nothing. For every request of a profiled invocation two files are written
+    under profiles/<function>/<request_id>/ in TRANSCRIPTS_BUCKET, named after the invocation (aws_request_id):
+    <invocation>.prof, the cProfile stats (pstats/snakeviz format), and <invocation>.json with the duration, the
+    peak traced memory and the sites holding the most memory at the end of the invocation.
+    tools/profile_report.py aggregates them.
+
+    Threads started during the invocation (e.g. the thread pools of the handler) get a profile of their own, merged
+    into the invocation's: their work shows under the threads' run, not as the handler waiting on futures.
+
+    :param function_name: The name of the function, the first level under profiles/.
+    :type function_name: str
+    :param request_ids: Extracts the request_ids the invocation handles from its event. Invocations without any
+        (e.g. a bulk submission) are stored under their aws_request_id.
+    :type request_ids: Callable[[dict], Iterable[str]]
+    :rtype: Callable
+    """
+    enabled = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+    sample_rate = 1.0 if enabled else float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))
+
+    def decorator(handler: Callable) -> Callable:
+        if sample_rate <= 0:
+            return handler
+
+        bucket = os.environ.get('TRANSCRIPTS_BUCKET')
+        top_allocations = int(os.environ.get('PROFILING_TOP_ALLOCATIONS', DEFAULT_TOP_ALLOCATIONS))
+
+        @functools.wraps(handler)
+        def wrapper(event: dict, context):
+            if random.random() >= sample_rate or not _profiling.acquire(blocking=False):
+                return handler(event, context)
+
+            profile = cProfile.Profile()
+            thread_profiles = []
+            threading.setprofile(_thread_profiler(thread_profiles))
+            # Left running if it was already started, e.g. with PYTHONTRACEMALLOC.
+            was_tracing = tracemalloc.is_tracing()
+            if not was_tracing:
+                tracemalloc.start()
+            started = time.time()
+            error = None
+            profile.enable()
+            try:
+                return handler(event, context)
+            except Exception as exc:
+                error = f'{type(exc).__name__}: {exc}'
+                raise
+            finally:
+                profile.disable()
+                threading.setprofile(None)
+                duration = time.time() - started
+                snapshot = tracemalloc.take_snapshot().filter_traces(
+                    (tracemalloc.Filter(False, tracemalloc.__file__),)
+                )
+                _, peak = tracemalloc.get_traced_memory()
+                if not was_tracing:
+                    tracemalloc.stop()
+                _profiling.release()
+                try:
+                    _save_profile(
+                        bucket,
+                        function_name,
+                        getattr(context, 'aws_request_id', None) or f'{time.time_ns()}',
+                        [request_id for request_id in request_ids(event) if request_id],
+                        _merge_stats(profile, thread_profiles),
+                        {
+                            'function': function_name,
+                            'started': started,
+                            'duration_ms': round(duration * 1000, 3),
+                            'error': error,
+                            'peak_traced_memory': peak,
+                            'allocations': [
+                                {
+                                    'site': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                                    'size': stat.size,
+                                    'count': stat.count
+                                }
+                                for stat in snapshot.statistics('lineno')[:top_allocations]
+                            ]
+                        }
+                    )
+                except Exception:
+                    # Never fail (or hide the error of) the invocation because of its profile.
+                    logger.exception(f'Failed to save the profile of {function_name}!')
+
+        return wrapper
+
+    return decorator
+
+
+def _thread_profiler(profiles: list) -> Callable:
+    """Returns a threading.setprofile hook giving every thread started while it's set a profile of its own.
+    """
+    lock = threading.Lock()
+
+    def start(frame, event, arg) -> None:
+        # Called on the first event of the thread, the profile replaces the hook.
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active (python 3.12+ profiles every thread with the handler's profile).
+            return
+        with lock:
+            profiles.append(profile)
+
+    return start
+
+
+def _merge_stats(profile: cProfile.Profile, thread_profiles: list) -> dict:
+    """Merges the stats of the handler's profile and of the threads it started (disabled when they ended).
+    """
+    stats = pstats.Stats(profile)
+    for thread_profile in list(thread_profiles):
+        stats.add(thread_profile)
+    return stats.stats
+
+
+def _save_profile(
+        bucket: str,
+        function_name: str,
+        invocation_id: str,
+        request_ids: list,
+        stats: dict,
+        summary: dict) -> None:
+    # Same content as Profile.dump_stats, without a local file.
+    data = marshal.dumps(stats)
+    s3_service = S3Service()
+    for request_id in request_ids or [invocation_id]:
+        prefix = f'{PROFILES_PREFIX}/{function_name}/{request_id}/{invocation_id}'
+        s3_service.write_file(bucket, f'{prefix}.prof', data, 'application/octet-stream')
+        s3_service.write_json_file(bucket, f'{prefix}.json', {**summary, 'request_id': request_id}, compress=True)
@@ -0,0 +1,153 @@
+import os
+import threading
+
+import boto3
+import urllib3
+from botocore.config import Config
+
+
+class ClientProvider(object):
+    """
+    Hands out boto3 clients/resources and the urllib3 pool shared by every service of the container.
+    They are created on first use (a function only pays for the services it actually calls) and kept at module
+    level, so warm invocations reuse their connections. Retries, timeouts and pool sizes come from the environment.
+    Clients are thread safe and shared by all threads; resources aren't, so every other thread gets its own resource
+    around the shared client (see get_resource).
+    """
+    __clients = {}
+    __resources = {}
+    # Resources replaced with set_resource, handed out as they are to every thread.
+    __replaced = set()
+    __local = threading.local()
+    __http = None
+    __session = None
+    __lock = threading.Lock()
+
+    @staticmethod
+    def get_config() -> Config:
+        """Returns the botocore config every client is created with.
+        """
+        return Config(
+            retries={
+                'max_attempts': int(os.environ.get('AWS_CLIENT_MAX_ATTEMPTS', '5')),
+                'mode': os.environ.get('AWS_CLIENT_RETRY_MODE', 'standard')
+            },
+            # Has to cover the threads of a function using the same client (batch concurrency * transfer concurrency).
+            max_pool_connections=int(os.environ.get('AWS_CLIENT_POOL_SIZE', '25')),
+            connect_timeout=float(os.environ.get('AWS_CLIENT_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.environ.get('AWS_CLIENT_READ_TIMEOUT', '60'))
+        )
+
+    @staticmethod
+    def _get_session() -> boto3.session.Session:
+        # Sessions are not thread safe, so all clients are created from this one under the lock.
+        if ClientProvider.__session is None:
+            ClientProvider.__session = boto3.session.Session()
+        return ClientProvider.__session
+
+    @staticmethod
+    def get_client(service_name: str, region_name: str = None):
+        """Returns the shared client of the service, creating it on first use.
+
+        :param service_name: The aws service, e.g. 's3'.
+        :type service_name: str
+        :param region_name: The region, defaults to the one of the function.
+        :type region_name: str
+        :return: The boto3 client.
+        """
+        key = (service_name, region_name)
+        client = ClientProvider.__clients.get(key)
+        if client is None:
+            with ClientProvider.__lock:
+                client = ClientProvider.__clients.get(key)
+                if client is None:
+                    client = ClientProvider._get_session().client(
+                        service_name,
+                        region_name=region_name,
+                        config=ClientProvider.get_config()
+                    )
+                    ClientProvider.__clients[key] = client
+        return client
+
+    @staticmethod
+    def get_resource(service_name: str, region_name: str = None):
+        """Returns the resource of the service (e.g. 'dynamodb') for the calling thread, creating it on first use.
+
+        :param service_name: The aws service.
+        :type service_name: str
+        :param region_name: The region, defaults to the one of the function.
+        :type region_name: str
+        :return: The boto3 service resource.
+        """
+        key = (service_name, region_name)
+        resource = ClientProvider.__resources.get(key)
+        if resource is None:
+            with ClientProvider.__lock:
+                resource = ClientProvider.__resources.get(key)
+                if resource is None:
+                    resource = ClientProvider._get_session().resource(
+                        service_name,
+                        region_name=region_name,
+                        config=ClientProvider.get_config()
+                    )
+                    ClientProvider.__resources[key] = resource
+        if key in ClientProvider.__replaced or threading.current_thread() is threading.main_thread():
+            return resource
+
+        # Resources are not thread safe: worker threads get their own, cheap since they share the client (and its
+        # connections). It's kept for the life of the thread, replaced if the shared one was.
+        thread_resources = getattr(ClientProvider.__local, 'resources', None)
+        if thread_resources is None:
+            thread_resources = ClientProvider.__local.resources = {}
+        shared, thread_resource = thread_resources.get(key, (None, None))
+        if shared is not resource:
+            thread_resource = type(resource)(client=resource.meta.client)
+            thread_resources[key] = (resource, thread_resource)
+        return thread_resource
+
+    @staticmethod
+    def get_http() -> urllib3.PoolManager:
+        """Returns the shared pool for plain http(s) requests (e.g. downloading audio files).
+        """
+        if ClientProvider.__http is None:
+            with ClientProvider.__lock:
+                if ClientProvider.__http is None:
+                    ClientProvider.__http = urllib3.PoolManager(
+                        maxsize=int(os.environ.get('HTTP_POOL_SIZE', '10')),
+                        timeout=urllib3.Timeout(
+                            connect=float(os.environ.get('AWS_CLIENT_CONNECT_TIMEOUT', '5')),
+                            read=float(os.environ.get('AWS_CLIENT_READ_TIMEOUT', '60'))
+                        )
+                    )
+        return ClientProvider.__http
+
+    @staticmethod
+    def set_client(service_name: str, client, region_name: str = None) -> None:
+        """Replaces the client of a service (e.g. with a local stand-in), it is handed out from then on.
+        """
+        ClientProvider.__clients[(service_name, region_name)] = client
+
+    @staticmethod
+    def set_resource(service_name: str, resource, region_name: str = None) -> None:
+        """Replaces the resource of a service (e.g. with a local stand-in), it is handed out to every thread from
+        then on.
+        """
+        ClientProvider.__resources[(service_name, region_name)] = resource
+        ClientProvider.__replaced.add((service_name, region_name))
+
+    @staticmethod
+    def set_http(http) -> None:
+        """Replaces the shared http pool (e.g. with a local stand-in).
+        """
+        ClientProvider.__http = http
+
+    @staticmethod
+    def reset() -> None:
+        """Forgets every client, the next calls create new ones.
+        """
+        with ClientProvider.__lock:
+            ClientProvider.__clients = {}
+            ClientProvider.__resources = {}
+            ClientProvider.__replaced = set()
+            ClientProvider.__http = None
+            ClientProvider.__session = None
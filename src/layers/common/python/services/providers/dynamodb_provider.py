@@ -1,4 +1,6 @@
-import boto3
+import threading
+
+from services.providers.client_provider import ClientProvider
 
 
 class DynamoDBProvider(object):
@@ -23,6 +25,19 @@ class DynamoDBProvider(object):
             raise Exception("Please use getInstance instead!")
 
         self.table_name = table_name
-        self.dynamodb = boto3.resource('dynamodb')
-        self.table = self.dynamodb.Table(table_name)
+        # Tables are resources, every thread has its own (see ClientProvider.get_resource).
+        self._local = threading.local()
         DynamoDBProvider.__instance[table_name] = self
+
+    @property
+    def dynamodb(self):
+        return ClientProvider.get_resource('dynamodb')
+
+    @property
+    def table(self):
+        # Created on first use, and again if the thread's resource was replaced.
+        dynamodb = self.dynamodb
+        if getattr(self._local, 'resource', None) is not dynamodb:
+            self._local.table = dynamodb.Table(self.table_name)
+            self._local.resource = dynamodb
+        return self._local.table
@@ -1,16 +1,90 @@
-import boto3
-
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from decimal import Decimal
+import gzip
+import io
 import json
+import os
+import random
+import threading
+import time
+from typing import IO, Any, Callable, Iterator, List, Optional, Sequence
 import urllib3
 
+from services.json_stream import iter_json_array
+from services.providers.client_provider import ClientProvider
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_TRANSFER_CONCURRENCY = 4
+TRANSFER_PART_ATTEMPTS = 3
+# Each range being copied is held in memory, so the ranges in flight are bounded for the whole container: every
+# transfer (e.g. the records of a batch, each with its own concurrency) shares these slots.
+MAX_PARTS_IN_FLIGHT = int(os.environ.get('AUDIO_TRANSFER_MAX_PARTS_IN_FLIGHT', '8'))
+_parts_in_flight = threading.BoundedSemaphore(MAX_PARTS_IN_FLIGHT)
+TRANSFER_HTTP_RETRIES = urllib3.Retry(total=3, backoff_factor=0.5)
+PRESIGNED_URL_EXPIRES_IN = 15 * 60
+# How many bytes copy_audio_file_from_url hands to its inspect callback.
+INSPECT_BYTES = 64 * 1024
+# Where the state of the multipart uploads of copy_audio_file_from_url is kept (the source's validator), so a
+# resumed upload can check the source didn't change since its parts were copied.
+TRANSFER_STATE_PREFIX = 'transfers/'
+
+
+def json_default(value: Any) -> Any:
+    """Encodes the Decimals our models hold (dynamo numbers) as json numbers.
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class _CountingReader(object):
+    """File-like wrapper counting the bytes read from a stream, that first returns the given prefix (bytes
+    already read from the stream).
+    """
+
+    def __init__(self, stream, prefix: bytes = b''):
+        self.stream = stream
+        self.prefix = prefix
+        self.bytes_read = 0
+
+    def read(self, amt: int = None) -> bytes:
+        if not self.prefix:
+            data = self.stream.read(amt)
+        elif amt is None or amt < 0:
+            data = self.prefix + self.stream.read()
+            self.prefix = b''
+        else:
+            data, self.prefix = self.prefix[:amt], self.prefix[amt:]
+        self.bytes_read += len(data)
+        return data
+
+
 class S3Service(object):
-    def __init__(self):
-        self.client = boto3.client('s3')
-        self.http = urllib3.PoolManager()
 
-    def copy_audio_file_from_url(self, url: str, bucket: str, s3_key: str):
-        """Will download (stream) the file from the given URL into the specified s3 location.
+    @property
+    def client(self):
+        return ClientProvider.get_client('s3')
+
+    @property
+    def http(self) -> urllib3.PoolManager:
+        return ClientProvider.get_http()
+
+    def copy_audio_file_from_url(
+            self,
+            url: str,
+            bucket: str,
+            s3_key: str,
+            part_size: int = DEFAULT_PART_SIZE,
+            concurrency: int = DEFAULT_TRANSFER_CONCURRENCY,
+            inspect: Callable[[bytes, Optional[int], Callable[[int, int], bytes]], None] = None) -> int:
+        """Will download the file from the given URL into the specified s3 location.
+
+        When the source supports HTTP Range requests and the file is bigger than one part, byte ranges are
+        downloaded in parallel straight into the parts of a multipart upload. A multipart upload left behind by a
+        previous failed attempt is resumed from its completed parts. Otherwise the file is streamed.
 
         :param url: The URL of the audio file
         :type url: str
@@ -18,26 +92,296 @@ class S3Service(object):
         :type bucket: str
         :param s3_key: The key under which to place the object
         :type s3_key: str
+        :param part_size: The size in bytes of the ranges/parts (at least 5MB, s3's minimum part size).
+        :type part_size: int
+        :param concurrency: How many ranges are downloaded/uploaded at the same time.
+        :type concurrency: int
+        :param inspect: Called before anything is uploaded with the first INSPECT_BYTES of the file, its size (None
+            if unknown) and a function reading length bytes at an offset (None if the source doesn't serve ranges),
+            e.g. to validate the file. An exception it raises aborts the transfer.
+        :type inspect: Callable[[bytes, Optional[int], Callable[[int, int], bytes]], None]
+        :return: The size of the file in bytes.
+        :rtype: int
+        """
+        probe_length = INSPECT_BYTES if inspect else 1
+        probe = self.http.request(
+            'GET', url, headers={'Range': f'bytes=0-{probe_length - 1}'}, preload_content=False
+        )
+        if probe.status >= 400 and probe.status != 416:
+            probe.drain_conn()
+            raise Exception(f'Failed to download {url}, status: {probe.status}!')
+
+        content_range = probe.headers.get('Content-Range', '')
+        size = int(content_range.rsplit('/', 1)[1]) if probe.status == 206 and '/' in content_range else None
+        head = b''
+        if inspect:
+            if probe.status == 206:
+                known_size = size
+            elif probe.status == 416:
+                # Not even the first byte exists.
+                known_size = 0
+            else:
+                known_size = int(probe.headers['Content-Length']) if probe.headers.get('Content-Length') else None
+            if known_size != 0:
+                head = probe.read(probe_length)
+            try:
+                inspect(
+                    head,
+                    known_size,
+                    (lambda start, length: self._read_range(url, start, length)) if probe.status == 206 else None
+                )
+            except Exception:
+                if probe.status == 200:
+                    # Closed rather than drained, the rest of the file is not wanted.
+                    probe.close()
+                else:
+                    probe.drain_conn()
+                raise
+
+        if size is None or size <= part_size:
+            if probe.status == 200:
+                # The source ignored the range, so the probe is already the whole file.
+                stream = _CountingReader(probe, head)
+            elif size is not None and size <= len(head):
+                stream = _CountingReader(io.BytesIO(head))
+            else:
+                probe.drain_conn()
+                stream = _CountingReader(self.http.request('GET', url, preload_content=False))
+            self.client.upload_fileobj(stream, bucket, s3_key)
+            return stream.bytes_read
+
+        probe.drain_conn()
+        # Ranges are only served if the source didn't change since the probe.
+        validator = probe.headers.get('ETag') or probe.headers.get('Last-Modified')
+        self._copy_ranges_to_multipart_upload(url, validator, size, bucket, s3_key, part_size, concurrency)
+        return size
+
+    def _read_range(self, url: str, start: int, length: int) -> bytes:
+        response = self.http.request(
+            'GET', url, headers={'Range': f'bytes={start}-{start + length - 1}'}, retries=TRANSFER_HTTP_RETRIES
+        )
+        if response.status == 416:
+            return b''
+        if response.status != 206:
+            raise Exception(f'Source {url} did not return range {start}-{start + length - 1} '
+                            f'(status {response.status})!')
+        return response.data
+
+    def get_url_version(self, url: str) -> str:
+        """Returns what identifies the current version of the file at the url, as reported by the server.
+
+        :param url: The URL of the file
+        :type url: str
+        :return: The ETag, else the Last-Modified date and size, None if the server reports neither.
+        :rtype: str
+        """
+        # A one byte GET instead of HEAD, some signed urls are only valid for GET.
+        probe = self.http.request('GET', url, headers={'Range': 'bytes=0-0'}, preload_content=False)
+        probe.drain_conn()
+        if probe.status >= 400:
+            return None
+        if probe.headers.get('ETag'):
+            return f'etag:{probe.headers["ETag"]}'
+        content_range = probe.headers.get('Content-Range', '')
+        size = content_range.rsplit('/', 1)[1] if '/' in content_range else probe.headers.get('Content-Length')
+        if probe.headers.get('Last-Modified') and size:
+            return f'modified:{probe.headers["Last-Modified"]}:{size}'
+        return None
+
+    def get_object_fingerprint(self, bucket: str, s3_key: str) -> str:
+        """Returns a fingerprint of the object's content, its ETag (an md5 digest of the content/parts) and size.
+
+        :param bucket: The bucket of the object
+        :type bucket: str
+        :param s3_key: The key of the object
+        :type s3_key: str
+        :rtype: str
+        """
+        head = self.client.head_object(Bucket=bucket, Key=s3_key)
+        return f'{head["ETag"]}:{head["ContentLength"]}'
+
+    def object_exists(self, bucket: str, s3_key: str) -> bool:
+        """Checks whether the key exists in the bucket (needs s3:ListBucket, otherwise s3 answers 403).
+        """
+        try:
+            self.client.head_object(Bucket=bucket, Key=s3_key)
+        except self.client.exceptions.ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def copy_object(self, bucket: str, source_key: str, s3_key: str) -> None:
+        """Copies an object inside the bucket, server side.
+
+        :param bucket: The bucket of both objects
+        :type bucket: str
+        :param source_key: The key of the object to copy
+        :type source_key: str
+        :param s3_key: The key of the copy
+        :type s3_key: str
+        """
+        self.client.copy_object(Bucket=bucket, Key=s3_key, CopySource={'Bucket': bucket, 'Key': source_key})
+
+    def list_keys(self, bucket: str, prefix: str) -> List[str]:
+        """Lists the keys under a prefix (needs s3:ListBucket).
+
+        :param bucket: The bucket to list
+        :type bucket: str
+        :param prefix: The prefix of the keys
+        :type prefix: str
+        :return: The keys, in lexicographic order.
+        :rtype: List[str]
+        """
+        return [
+            obj['Key']
+            for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix)
+            for obj in page.get('Contents', [])
+        ]
+
+    def delete_objects(self, bucket: str, s3_keys: Sequence[str]) -> None:
+        """Deletes the keys, up to 1000 per request.
+
+        :param bucket: The bucket of the objects
+        :type bucket: str
+        :param s3_keys: The keys to delete
+        :type s3_keys: Sequence[str]
+        """
+        for idx in range(0, len(s3_keys), 1000):
+            response = self.client.delete_objects(
+                Bucket=bucket,
+                Delete={'Objects': [{'Key': key} for key in s3_keys[idx:idx + 1000]], 'Quiet': True}
+            )
+            if response.get('Errors'):
+                raise Exception(f'Failed to delete objects from {bucket}: {response["Errors"]}')
+
+    def _find_multipart_upload(self, bucket: str, s3_key: str, part_size: int, size: int, validator: str) -> tuple:
+        """Returns the id and completed parts ({part_number: etag}) of a resumable upload for the key, if any.
+
+        An upload is only resumed when it was started for the same version of the source (its validator, ETag or
+        Last-Modified, is kept under TRANSFER_STATE_PREFIX) and with the same part sizes, otherwise it's aborted.
+        """
+        uploads = self.client.list_multipart_uploads(Bucket=bucket, Prefix=s3_key).get('Uploads', [])
+        uploads = sorted((u for u in uploads if u['Key'] == s3_key), key=lambda u: u['Initiated'])
+        if not uploads:
+            return None, {}
+
+        upload_id = uploads[-1]['UploadId']
+        state = self.read_json_file_if_exists(bucket, f'{TRANSFER_STATE_PREFIX}{s3_key}.json')
+        if not validator or not state or state.get('upload_id') != upload_id or state.get('validator') != validator:
+            # The source changed (or can't be told apart from another version), its parts can't be reused.
+            self.client.abort_multipart_upload(Bucket=bucket, Key=s3_key, UploadId=upload_id)
+            return None, {}
+
+        parts = {}
+        for page in self.client.get_paginator('list_parts').paginate(Bucket=bucket, Key=s3_key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part
+        last_part = -(-size // part_size)
+        expected = {
+            number: (size - (number - 1) * part_size if number == last_part else part_size)
+            for number in range(1, last_part + 1)
+        }
+        if any(expected.get(number) != part['Size'] for number, part in parts.items()):
+            # Left behind with a different part size, can't be resumed.
+            self.client.abort_multipart_upload(Bucket=bucket, Key=s3_key, UploadId=upload_id)
+            return None, {}
+        return upload_id, {number: part['ETag'] for number, part in parts.items()}
+
+    def _copy_range(
+            self,
+            url: str,
+            validator: str,
+            start: int,
+            end: int,
+            bucket: str,
+            s3_key: str,
+            upload_id: str,
+            part_number: int) -> str:
+        """Downloads one byte range and uploads it as a part, retrying transient failures. Returns the part's ETag.
         """
-        self.client.upload_fileobj(
-            self.http.request(
-                'GET',
-                url,
-                preload_content=False
-            ),
-            bucket,
-            s3_key
+        headers = {'Range': f'bytes={start}-{end}'}
+        if validator:
+            headers['If-Range'] = validator
+        for attempt in range(TRANSFER_PART_ATTEMPTS):
+            try:
+                with _parts_in_flight:
+                    response = self.http.request('GET', url, headers=headers, retries=TRANSFER_HTTP_RETRIES)
+                    if response.status != 206:
+                        raise Exception(f'Source {url} did not return range {start}-{end} '
+                                        f'(status {response.status})!')
+                    if len(response.data) != end - start + 1:
+                        raise urllib3.exceptions.ProtocolError(f'Incomplete range {start}-{end} from {url}')
+                    return self.client.upload_part(
+                        Bucket=bucket,
+                        Key=s3_key,
+                        UploadId=upload_id,
+                        PartNumber=part_number,
+                        Body=response.data
+                    )['ETag']
+            except urllib3.exceptions.HTTPError:
+                if attempt == TRANSFER_PART_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0, 2 ** attempt))
+
+    def _copy_ranges_to_multipart_upload(
+            self,
+            url: str,
+            validator: str,
+            size: int,
+            bucket: str,
+            s3_key: str,
+            part_size: int,
+            concurrency: int) -> None:
+        # s3 allows at most 10000 parts per upload
+        part_size = max(part_size, MIN_PART_SIZE, -(-size // MAX_PARTS))
+        state_key = f'{TRANSFER_STATE_PREFIX}{s3_key}.json'
+        upload_id, completed_parts = self._find_multipart_upload(bucket, s3_key, part_size, size, validator)
+        if upload_id is None:
+            upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=s3_key)['UploadId']
+            if validator:
+                self.write_json_file(bucket, state_key, {'upload_id': upload_id, 'validator': validator})
+
+        pending_parts = [
+            (number, start, min(start + part_size, size) - 1)
+            for number, start in enumerate(range(0, size, part_size), start=1)
+            if number not in completed_parts
+        ]
+        # Completed parts are kept on failure, so a retry (e.g. the message being redelivered) resumes from them.
+        # Uploads that are never resumed are cleaned up by the bucket's lifecycle rule.
+        with ThreadPoolExecutor(max_workers=max(min(concurrency, len(pending_parts)), 1)) as executor:
+            futures = {
+                executor.submit(self._copy_range, url, validator, start, end, bucket, s3_key, upload_id, number): number
+                for number, start, end in pending_parts
+            }
+            for future in as_completed(futures):
+                completed_parts[futures[future]] = future.result()
+
+        self.client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=s3_key,
+            UploadId=upload_id,
+            MultipartUpload={
+                'Parts': [
+                    {'PartNumber': number, 'ETag': etag}
+                    for number, etag in sorted(completed_parts.items())
+                ]
+            }
         )
+        if validator:
+            self.delete_objects(bucket, [state_key])
 
-    def create_presigned_url(self, bucket: str, s3_key: str) -> dict:
-        """Creates a presigned url for the given key. Expires in 15 minutes.
+    def create_presigned_url(self, bucket: str, s3_key: str, expires_in: int = PRESIGNED_URL_EXPIRES_IN) -> str:
+        """Creates a presigned url for the given key. Expires in 15 minutes by default.
 
         :param bucket: The bucket to create the presigned url for.
         :type bucket: str
         :param s3_key: The key of the object to generate the rul for.
         :type s3_key: str
-        :return: A dict with two keys: url and expires_at
-        :rtype: dict
+        :param expires_in: How many seconds the url stays valid.
+        :type expires_in: int
+        :return: The presigned url
+        :rtype: str
         """
         return self.client.generate_presigned_url(
             'get_object',
@@ -45,7 +389,7 @@ class S3Service(object):
                 'Bucket': bucket,
                 'Key': s3_key
             },
-            ExpiresIn=15 * 60
+            ExpiresIn=expires_in
         )
 
     def read_json_file(self, bucket: str, s3_key: str) -> dict:
@@ -58,8 +402,134 @@ class S3Service(object):
         :return: The parsed json file as a python dict.
         :rtype: dict
         """
-        obj = self.client.get_object(Bucket=bucket, Key=s3_key).get('Body')
+        response = self.client.get_object(Bucket=bucket, Key=s3_key)
+        obj = response.get('Body')
         if obj:
-            return json.loads(obj.read().decode('utf-8'))
+            data = obj.read()
+            if response.get('ContentEncoding') == 'gzip':
+                data = gzip.decompress(data)
+            return json.loads(data.decode('utf-8'))
 
         raise Exception(f'Failed to read file: {bucket}/{s3_key}')
+
+    def read_file(self, bucket: str, s3_key: str) -> bytes:
+        """Reads the raw bytes of a file.
+
+        :param bucket: Bucket where file is located
+        :type bucket: str
+        :param s3_key: The key of the file to read
+        :type s3_key: str
+        :rtype: bytes
+        """
+        return self.client.get_object(Bucket=bucket, Key=s3_key)['Body'].read()
+
+    def read_file_range(self, bucket: str, s3_key: str, start: int, length: int) -> bytes:
+        """Reads length bytes of a file from the offset start.
+
+        :param bucket: Bucket where file is located
+        :type bucket: str
+        :param s3_key: The key of the file to read
+        :type s3_key: str
+        :param start: The offset of the first byte
+        :type start: int
+        :param length: How many bytes to read
+        :type length: int
+        :rtype: bytes
+        """
+        return self.client.get_object(
+            Bucket=bucket, Key=s3_key, Range=f'bytes={start}-{start + length - 1}'
+        )['Body'].read()
+
+    def open_file(self, bucket: str, s3_key: str):
+        """Opens a file to read it as a stream, the caller closes it.
+
+        :param bucket: Bucket where file is located
+        :type bucket: str
+        :param s3_key: The key of the file to read
+        :type s3_key: str
+        :return: The body of the object, read from s3 as it is consumed.
+        """
+        return self.client.get_object(Bucket=bucket, Key=s3_key)['Body']
+
+    def read_json_file_if_exists(self, bucket: str, s3_key: str) -> dict:
+        """Same as read_json_file, but returns None when the file doesn't exist.
+        """
+        try:
+            return self.read_json_file(bucket, s3_key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def write_json_file(self, bucket: str, s3_key: str, data: dict, compress: bool = False) -> None:
+        """Generic function for saving a python dictionary as a json file.
+
+        :param bucket: Bucket where to save the file
+        :type bucket: str
+        :param s3_key: The key of the json file
+        :type s3_key: str
+        :param data: The data to save, Decimals are written as json numbers.
+        :type data: dict
+        :param compress: Whether to gzip the file (stored with Content-Encoding: gzip, so http clients, e.g. through
+            a presigned url, decompress it transparently).
+        :type compress: bool
+        """
+        body = json.dumps(data, default=json_default, separators=(',', ':')).encode('utf-8')
+        extra_args = {}
+        if compress:
+            body = gzip.compress(body, compresslevel=6)
+            extra_args['ContentEncoding'] = 'gzip'
+        self.client.put_object(
+            Bucket=bucket,
+            Key=s3_key,
+            Body=body,
+            ContentType='application/json',
+            **extra_args
+        )
+
+    def write_file(self, bucket: str, s3_key: str, body: bytes, content_type: str) -> None:
+        """Saves raw bytes as a file.
+
+        :param bucket: Bucket where to save the file
+        :type bucket: str
+        :param s3_key: The key of the file
+        :type s3_key: str
+        :param body: The content of the file.
+        :type body: bytes
+        :param content_type: The content type of the file.
+        :type content_type: str
+        """
+        self.client.put_object(Bucket=bucket, Key=s3_key, Body=body, ContentType=content_type)
+
+    def upload_file(self, bucket: str, s3_key: str, file: IO[bytes], content_type: str) -> None:
+        """Saves a (large) file from a file object, in parts if needed.
+
+        :param bucket: Bucket where to save the file
+        :type bucket: str
+        :param s3_key: The key of the file
+        :type s3_key: str
+        :param file: The content of the file, read from its current position.
+        :type file: IO[bytes]
+        :param content_type: The content type of the file.
+        :type content_type: str
+        """
+        self.client.upload_fileobj(file, bucket, s3_key, ExtraArgs={'ContentType': content_type})
+
+    def iter_json_array(self, bucket: str, s3_key: str, path: Sequence[str]) -> Iterator[Any]:
+        """Streams the elements of an array nested in a json file, without loading the whole file in memory.
+
+        :param bucket: Bucket where file is located
+        :type bucket: str
+        :param s3_key: The key of the json file to read
+        :type s3_key: str
+        :param path: The keys leading to the array, e.g. ('results', 'items').
+        :type path: Sequence[str]
+        :return: The elements of the array, as they are read from s3.
+        :rtype: Iterator[Any]
+        """
+        obj = self.client.get_object(Bucket=bucket, Key=s3_key).get('Body')
+        if not obj:
+            raise Exception(f'Failed to read file: {bucket}/{s3_key}')
+
+        try:
+            yield from iter_json_array(obj, path)
+        finally:
+            obj.close()
@@ -0,0 +1,320 @@
+import gzip
+import json
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Mapping, Optional, Sequence
+
+from analysis.inverted_index import DEFAULT_SHARD_COUNT, Posting, filter_may_contain, find_phrase, \
+    merge_postings, shard_of, split_by_shard, token_filter
+from services.providers.dynamodb_provider import DynamoDBProvider
+from services.s3_service import S3Service
+
+SEARCH_INDEX_PREFIX = 'search_index'
+DEFAULT_SEARCH_CONCURRENCY = 8
+# How long a compaction lease holds (seconds): the longest a lambda runs, its holder is gone by then.
+COMPACTION_LEASE_SECONDS = 900
+
+
+class SearchIndexService(object):
+    """Positional inverted index of the analysed transcripts, persisted in s3, for phrase searches across them.
+
+    Tokens are spread over shards (see shard_of). Indexing a transcript writes one small gzipped segment per shard
+    it has tokens in, under search_index/shard=NNN/segments/, so concurrent analyses never write the same object.
+    The key of a segment carries a filter of its tokens (see token_filter). compact_shard merges the segments of a
+    shard into a single token major file: the postings of every token are gzipped on their own, the shard's
+    manifest maps the tokens to their byte ranges. A search only reads the ranges of the query's tokens and the
+    segments that may hold them, never the Transcribe results. Compactions of the same shard must not run
+    concurrently: with a lock table, a compaction leases its shard first, and compact_due_shard compacts the shards
+    as they fill up from the analyses.
+    """
+
+    def __init__(
+            self,
+            bucket: str,
+            shard_count: int = DEFAULT_SHARD_COUNT,
+            s3_service: S3Service = None,
+            concurrency: int = DEFAULT_SEARCH_CONCURRENCY,
+            lock_table: str = None,
+            compact_segments: int = 500):
+        """
+        :param bucket: The bucket holding the index.
+        :type bucket: str
+        :param shard_count: The number of shards, changing it requires rebuilding the index.
+        :type shard_count: int
+        :param s3_service: The service used to access s3.
+        :type s3_service: S3Service
+        :param concurrency: How many shard files are read/written at the same time.
+        :type concurrency: int
+        :param lock_table: The dynamo table (partition key name) of the compaction leases, None turns
+            compact_due_shard off.
+        :type lock_table: str
+        :param compact_segments: How many segments a shard has when compact_due_shard compacts it.
+        :type compact_segments: int
+        """
+        self.bucket = bucket
+        self.shard_count = shard_count
+        self.s3_service = s3_service or S3Service()
+        self.concurrency = concurrency
+        self.lock_client = DynamoDBProvider.get_instance(lock_table) if lock_table else None
+        self.compact_segments = compact_segments
+
+    @staticmethod
+    def _shard_prefix(shard: int) -> str:
+        return f'{SEARCH_INDEX_PREFIX}/shard={shard:03d}'
+
+    def _manifest_key(self, shard: int) -> str:
+        return f'{self._shard_prefix(shard)}/manifest.json'
+
+    def _segments_prefix(self, shard: int) -> str:
+        return f'{self._shard_prefix(shard)}/segments/'
+
+    def _request_key(self, request_id: str) -> str:
+        return f'{SEARCH_INDEX_PREFIX}/requests/{request_id}.json'
+
+    def index_transcript(self, request_id: str, postings: Mapping[str, List[Posting]]) -> List[int]:
+        """Adds the postings of a transcript to the index, replacing everything the request had in it.
+
+        The shards a request has tokens in are kept under search_index/requests/, so indexing it again also writes
+        an empty segment (a tombstone) to the shards it no longer has tokens in.
+
+        :param request_id: The request of the transcript.
+        :type request_id: str
+        :param postings: The postings of the transcript (see build_postings).
+        :type postings: Mapping[str, List[Posting]]
+        :return: The shards a segment was written to.
+        :rtype: List[int]
+        """
+        # The suffix keeps every write in its own object: the newest segment of a request wins over older ones.
+        suffix = time.time_ns()
+
+        def write_segment(shard: int, shard_postings: dict) -> None:
+            self.s3_service.write_json_file(
+                self.bucket,
+                f'{self._segments_prefix(shard)}{request_id}.{suffix}.{token_filter(shard_postings)}.json',
+                {'request_id': request_id, 'postings': shard_postings},
+                compress=True
+            )
+
+        shards = split_by_shard(postings, self.shard_count)
+        indexed = self.s3_service.read_json_file_if_exists(self.bucket, self._request_key(request_id)) or {}
+        segments = dict(shards)
+        for shard in indexed.get('shards', []):
+            segments.setdefault(shard, {})
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(write_segment, *shard) for shard in segments.items()]:
+                future.result()
+        # Only written once the segments are, a failed indexing is cleaned up when it's retried.
+        self.s3_service.write_json_file(self.bucket, self._request_key(request_id), {'shards': sorted(shards)})
+        return sorted(segments)
+
+    @staticmethod
+    def _segment_order(segment_key: str) -> tuple:
+        """Orders the segments by write time, the key ends with <request_id>.<time_ns>.<token filter>.json.
+        """
+        request_id, suffix = segment_key.rsplit('/', 1)[1].split('.')[:2]
+        return int(suffix), request_id
+
+    def _read_compacted(self, manifest: dict, tokens: Sequence[str] = None) -> Optional[dict]:
+        """Reads the postings of the tokens (all of them if None) from the compacted file of a shard.
+
+        :return: The postings ({token: {request_id: postings}}), None if the file was replaced since the manifest
+            was read.
+        :rtype: Optional[dict]
+        """
+        key = manifest.get('compacted')
+        directory = manifest.get('tokens', {})
+        if not key:
+            return {}
+        try:
+            if tokens is None:
+                data = self.s3_service.read_file(self.bucket, key)
+                blocks = {token: data[start:start + length] for token, (start, length) in directory.items()}
+            else:
+                blocks = {
+                    token: self.s3_service.read_file_range(self.bucket, key, *directory[token])
+                    for token in tokens if token in directory
+                }
+        except self.s3_service.client.exceptions.NoSuchKey:
+            return None
+        return {token: json.loads(gzip.decompress(block)) for token, block in blocks.items()}
+
+    def _load_shard(self, shard: int, tokens: Sequence[str] = None) -> tuple:
+        """Loads the postings of a shard, the compacted file with the pending segments applied on top.
+
+        Only the newest segment of a request counts, it replaces everything the request had in the shard. With
+        tokens, only the ranges of those tokens and the segments whose filter may contain them are read.
+
+        :return: The postings ({token: {request_id: postings}}), the manifest, the keys of the pending segments and
+            of the merged segments not deleted yet.
+        :rtype: tuple
+        """
+        for _ in range(3):
+            manifest = self.s3_service.read_json_file_if_exists(self.bucket, self._manifest_key(shard)) or {}
+            merged = set(manifest.get('segments', []))
+            keys = self.s3_service.list_keys(self.bucket, self._segments_prefix(shard))
+            pending = sorted((key for key in keys if key not in merged), key=self._segment_order)
+            newest = {self._segment_order(key)[1]: key for key in pending}
+            wanted = [
+                key for key in newest.values()
+                if tokens is None
+                or any(filter_may_contain(key.rsplit('/', 1)[1].split('.')[2], token) for token in tokens)
+            ]
+            compacted = self._read_compacted(manifest, tokens)
+            segments = [self.s3_service.read_json_file_if_exists(self.bucket, key) for key in wanted]
+            if compacted is not None and all(segment is not None for segment in segments):
+                break
+            # A compaction replaced the files since the manifest was read, start over from the new one.
+        else:
+            raise Exception(f'Failed to load shard {shard} of the search index, it keeps being compacted!')
+
+        postings: Dict[str, Dict[str, List[Posting]]] = compacted
+        for token_postings in postings.values():
+            for request_id in newest:
+                token_postings.pop(request_id, None)
+        for segment in segments:
+            merge_postings(postings, segment['request_id'], segment['postings'], tokens)
+        postings = {token: token_postings for token, token_postings in postings.items() if token_postings}
+        return postings, manifest, pending, [key for key in keys if key in merged]
+
+    def search(self, phrase: Sequence[str]) -> Dict[str, List[Posting]]:
+        """Finds the transcripts containing the phrase.
+
+        :param phrase: The normalized tokens of the phrase (see Tokenizer.normalize).
+        :type phrase: Sequence[str]
+        :return: The occurrences ([start word index, end word index, start time, end time]) keyed by request_id.
+        :rtype: Dict[str, List[Posting]]
+        """
+        if not phrase:
+            return {}
+        tokens_by_shard: Dict[int, List[str]] = {}
+        for token in set(phrase):
+            tokens_by_shard.setdefault(shard_of(token, self.shard_count), []).append(token)
+
+        postings: Dict[str, Dict[str, List[Posting]]] = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._load_shard, *shard) for shard in tokens_by_shard.items()]
+            for future in futures:
+                postings.update(future.result()[0])
+        return find_phrase(phrase, postings)
+
+    def compact_shard(self, shard: int, holder: str = None) -> int:
+        """Merges the pending segments of a shard into a new compacted file, then deletes them.
+
+        With a lock table, the shard is leased to holder during the compaction, nothing is merged if someone else
+        holds the lease.
+
+        :param shard: The shard to compact.
+        :type shard: int
+        :param holder: Who compacts, e.g. the aws_request_id of the invocation.
+        :type holder: str
+        :return: How many segments were merged.
+        :rtype: int
+        """
+        if self.lock_client is None:
+            return self._compact_shard(shard)
+        holder = holder or uuid.uuid4().hex
+        if not self._claim_compaction(shard, holder):
+            return 0
+        try:
+            return self._compact_shard(shard)
+        finally:
+            self._release_compaction(shard, holder)
+
+    def _compact_shard(self, shard: int) -> int:
+        postings, manifest, pending, stale = self._load_shard(shard)
+        if not pending:
+            return 0
+
+        compacted_key = f'{self._shard_prefix(shard)}/compacted/{time.time_ns()}.bin'
+        # Every token is gzipped on its own, so a search reads (and decompresses) only the ranges of its tokens.
+        blocks, directory, offset = [], {}, 0
+        for token in sorted(postings):
+            block = json.dumps(postings[token], separators=(',', ':')).encode('utf-8')
+            block = gzip.compress(block, compresslevel=6)
+            blocks.append(block)
+            directory[token] = [offset, len(block)]
+            offset += len(block)
+        self.s3_service.write_file(self.bucket, compacted_key, b''.join(blocks), 'application/octet-stream')
+        # Searches switch to the new file with the manifest, the merged segments are skipped until they are gone.
+        self.s3_service.write_json_file(
+            self.bucket,
+            self._manifest_key(shard),
+            {
+                'compacted': compacted_key,
+                'tokens': directory,
+                'segments': stale + pending,
+                'updated': datetime.utcnow().isoformat()
+            },
+            compress=True
+        )
+        # Merged segments a failed deletion left behind stay listed in the manifest until they are gone.
+        obsolete = stale + pending + ([manifest['compacted']] if manifest.get('compacted') else [])
+        self.s3_service.delete_objects(self.bucket, obsolete)
+        return len(pending)
+
+    def compact(self) -> Dict[int, int]:
+        """Compacts every shard of the index (the ones leased by someone else are skipped).
+
+        :return: How many segments were merged, by shard.
+        :rtype: Dict[int, int]
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return dict(zip(range(self.shard_count), executor.map(self.compact_shard, range(self.shard_count))))
+
+    def _lease_key(self, shard: int) -> dict:
+        return {'name': f'{self._shard_prefix(shard)}/compaction'}
+
+    def _claim_compaction(self, shard: int, holder: str) -> bool:
+        """Leases the compaction of a shard, unless someone else holds an unexpired lease on it.
+        """
+        table = self.lock_client.table
+        now = int(time.time())
+        try:
+            table.update_item(
+                Key=self._lease_key(shard),
+                UpdateExpression='SET #holder = :holder, #expires = :expires',
+                ConditionExpression='attribute_not_exists(#holder) OR #expires < :now',
+                ExpressionAttributeNames={'#holder': 'holder', '#expires': 'expires'},
+                ExpressionAttributeValues={
+                    ':holder': holder, ':expires': now + COMPACTION_LEASE_SECONDS, ':now': now
+                }
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def _release_compaction(self, shard: int, holder: str) -> None:
+        table = self.lock_client.table
+        try:
+            table.update_item(
+                Key=self._lease_key(shard),
+                UpdateExpression='REMOVE #holder, #expires',
+                ConditionExpression='#holder = :holder',
+                ExpressionAttributeNames={'#holder': 'holder', '#expires': 'expires'},
+                ExpressionAttributeValues={':holder': holder}
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def compact_due_shard(self, shards: Sequence[int], holder: str = None) -> int:
+        """Compacts one of the shards, picked at random, if it has compact_segments segments or more (and no one
+        else is compacting it). Called after every indexing (with the shards it wrote to), it keeps the segments a
+        search lists and reads bounded without a scheduled compaction: every shard is checked as often as it's
+        written to, at the cost of a listing.
+
+        :param shards: The shards to pick from.
+        :type shards: Sequence[int]
+        :param holder: Who compacts, e.g. the aws_request_id of the invocation.
+        :type holder: str
+        :return: How many segments were merged.
+        :rtype: int
+        """
+        if self.lock_client is None or not shards:
+            return 0
+        shard = random.choice(shards)
+        if len(self.s3_service.list_keys(self.bucket, self._segments_prefix(shard))) < self.compact_segments:
+            return 0
+        return self.compact_shard(shard, holder)
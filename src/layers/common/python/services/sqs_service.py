@@ -1,10 +1,20 @@
 import json
-import boto3
+import random
+import time
+from typing import Dict, List
+
+from services.providers.client_provider import ClientProvider
+
+
+# SQS limit of messages per SendMessageBatch call
+SEND_BATCH_MAX_MESSAGES = 10
 
 
 class SQSService(object):
-    def __init__(self):
-        self.sqs = boto3.client('sqs')
+
+    @property
+    def sqs(self):
+        return ClientProvider.get_client('sqs')
 
     def send_message(self, message: dict, queue_url: str):
         """Sends a message (as encoded json) to the given sqs queue.
@@ -18,3 +28,62 @@ class SQSService(object):
             QueueUrl=queue_url,
             MessageBody=json.dumps(message)
         )
+
+    def change_message_visibility(self, queue_url: str, receipt_handle: str, visibility_timeout: int):
+        """Hides a received message for visibility_timeout seconds from now, e.g. to retry it later than the queue's
+        visibility timeout would.
+
+        :param queue_url: The URL of the queue the message was received from.
+        :type queue_url: str
+        :param receipt_handle: The receipt handle of the message.
+        :type receipt_handle: str
+        :param visibility_timeout: Seconds, at most 12 hours since the message was first received.
+        :type visibility_timeout: int
+        """
+        return self.sqs.change_message_visibility(
+            QueueUrl=queue_url,
+            ReceiptHandle=receipt_handle,
+            VisibilityTimeout=visibility_timeout
+        )
+
+    def send_message_batch(
+            self,
+            messages: List[dict],
+            queue_url: str,
+            max_retries: int = 3,
+            retry_base_delay: float = 0.05) -> Dict[int, str]:
+        """Sends many messages (as encoded json) to the given sqs queue, 10 per SendMessageBatch call.
+
+        Entries the queue rejects because of a transient (server side) error are retried with backoff.
+
+        :param messages: The messages to send.
+        :type messages: List[dict]
+        :param queue_url: The URL of the queue to use.
+        :type queue_url: str
+        :param max_retries: How many times failed entries are retried.
+        :type max_retries: int
+        :param retry_base_delay: The base delay (seconds) of the exponential backoff between retries.
+        :type retry_base_delay: float
+        :return: The error of every message that could not be sent, keyed by its index in messages.
+        :rtype: Dict[int, str]
+        """
+        errors: Dict[int, str] = {}
+        for start in range(0, len(messages), SEND_BATCH_MAX_MESSAGES):
+            pending = list(range(start, min(start + SEND_BATCH_MAX_MESSAGES, len(messages))))
+            attempt = 0
+            while pending:
+                response = self.sqs.send_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[{'Id': str(idx), 'MessageBody': json.dumps(messages[idx])} for idx in pending]
+                )
+                pending = []
+                for failure in response.get('Failed', []):
+                    idx = int(failure['Id'])
+                    if failure.get('SenderFault') or attempt >= max_retries:
+                        errors[idx] = failure.get('Message') or failure.get('Code', 'failed')
+                    else:
+                        pending.append(idx)
+                if pending:
+                    attempt += 1
+                    time.sleep(random.uniform(0, retry_base_delay * 2 ** attempt))
+        return errors
@@ -0,0 +1,86 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+
+
+class StageTimer(object):
+    """Measures the milliseconds a request spends in every stage of the pipeline.
+
+    Stages nest: the time of an inner stage (or of producing the items of a timed iterable) is not counted in the
+    outer one, so e.g. the matching time excludes reading the transcript it consumes as a stream. Durations are
+    added to the given dict (typically Transcript.stage_timings), on_stage(name, milliseconds) is called for
+    every finished stage, e.g. to emit it as a metric.
+    """
+
+    def __init__(self, timings: Dict[str, int] = None, on_stage: Callable[[str, float], None] = None):
+        """
+        :param timings: Where durations are added, by stage name.
+        :type timings: Dict[str, int]
+        :param on_stage: Called with the name and duration (milliseconds) of every finished stage.
+        :type on_stage: Callable[[str, float], None]
+        """
+        self.timings = {} if timings is None else timings
+        self.on_stage = on_stage
+        # [name, started, time spent in nested stages] of the running stages, innermost last
+        self._running = []
+
+    def add(self, name: str, milliseconds: float) -> None:
+        """Adds a duration measured elsewhere (e.g. a queue wait) to a stage.
+
+        :param name: The stage.
+        :type name: str
+        :param milliseconds: The duration.
+        :type milliseconds: float
+        """
+        milliseconds = max(milliseconds, 0)
+        self.timings[name] = self.timings.get(name, 0) + int(round(milliseconds))
+        if self.on_stage:
+            self.on_stage(name, milliseconds)
+
+    def _exclude(self, seconds: float) -> None:
+        if self._running:
+            self._running[-1][2] += seconds
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Times the block as the given stage.
+
+        :param name: The stage.
+        :type name: str
+        """
+        self._running.append([name, time.perf_counter(), 0.0])
+        try:
+            yield
+        finally:
+            _, started, nested = self._running.pop()
+            elapsed = time.perf_counter() - started
+            self._exclude(elapsed)
+            self.add(name, (elapsed - nested) * 1000)
+
+    def timed(self, iterable: Iterable[T], name: str) -> Iterator[T]:
+        """Yields the items of the iterable, timing how long producing them takes as the given stage.
+
+        :param iterable: E.g. the items of a transcript streamed from s3.
+        :type iterable: Iterable[T]
+        :param name: The stage.
+        :type name: str
+        :rtype: Iterator[T]
+        """
+        total = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.perf_counter() - started
+                    total += elapsed
+                    self._exclude(elapsed)
+                yield item
+        finally:
+            self.add(name, total * 1000)
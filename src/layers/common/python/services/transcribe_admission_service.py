@@ -0,0 +1,227 @@
+import math
+import random
+import time
+from decimal import Decimal
+
+from services.providers.dynamodb_provider import DynamoDBProvider
+from services.transcribe_service import TranscribeService
+
+# The key of the item holding the shared state of the admission.
+ADMISSION_KEY = 'transcribe'
+
+
+class TranscribeDeferred(Exception):
+    """Raised when transcribe jobs can't be started yet: over our budget, or throttled by transcribe itself. The
+    request isn't failing, its message should come back later.
+    """
+
+    def __init__(self, message: str, retry_after: float = 0):
+        """
+        :param message: Why the jobs were deferred.
+        :type message: str
+        :param retry_after: How long (seconds) until the budget allows them, 0 if unknown.
+        :type retry_after: float
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TranscribeAdmissionService(object):
+    """Admission control of the transcribe jobs started by all the process_audio invocations, so they stay within
+    the account's quotas: a token bucket limits the rate of StartTranscriptionJob calls and a counter the jobs
+    running at once. Both live in a single dynamo item, updated with conditional writes.
+
+    A slot of the counter is taken when a job is admitted and given back by the analysis of its transcript. Jobs
+    that never write one (e.g. failed jobs) would keep theirs, so while the counter is at the limit it's compared
+    with the jobs transcribe reports in progress, at most every reconcile_seconds (see _reconcile).
+    """
+
+    def __init__(
+            self,
+            ddb_table: str,
+            transcribe_service: TranscribeService,
+            max_jobs: int = 250,
+            start_rate: float = 10,
+            start_burst: float = 10,
+            reconcile_seconds: float = 300,
+            max_conflicts: int = 8,
+            retry_base_delay: float = 0.02):
+        """
+        :param ddb_table: The name of the dynamo table of the admission state (partition key name).
+        :type ddb_table: str
+        :param transcribe_service: Counts the jobs in progress when reconciling.
+        :type transcribe_service: TranscribeService
+        :param max_jobs: How many jobs may run at once.
+        :type max_jobs: int
+        :param start_rate: How many jobs may be started per second, on average.
+        :type start_rate: float
+        :param start_burst: How many jobs may be started at once after a quiet period.
+        :type start_burst: float
+        :param reconcile_seconds: The minimum time between two reconciliations of the counter.
+        :type reconcile_seconds: float
+        :param max_conflicts: How many times an admission is retried when other invocations updated the state
+            between its read and its write.
+        :type max_conflicts: int
+        :param retry_base_delay: The base delay (seconds) of the exponential backoff between those retries.
+        :type retry_base_delay: float
+        """
+        self.dynamo_client = DynamoDBProvider.get_instance(ddb_table)
+        self.transcribe_service = transcribe_service
+        self.max_jobs = max_jobs
+        self.start_rate = start_rate
+        self.start_burst = start_burst
+        self.reconcile_seconds = reconcile_seconds
+        self.max_conflicts = max_conflicts
+        self.retry_base_delay = retry_base_delay
+
+    def _get_state(self) -> dict:
+        response = self.dynamo_client.table.get_item(Key={'name': ADMISSION_KEY}, ConsistentRead=True)
+        return response.get('Item')
+
+    def _tokens(self, state: dict, now: int) -> float:
+        """The tokens of the bucket at now (epoch milliseconds), refilled since the state was written.
+        """
+        if state is None:
+            return float(self.start_burst)
+        elapsed = max(now - int(state['refilled_at']), 0) / 1000
+        return min(float(state['tokens']) + elapsed * self.start_rate, float(self.start_burst))
+
+    def _wait(self, state: dict, jobs: int, now: int) -> float:
+        in_flight = int(state['in_flight']) if state else 0
+        # More jobs than the limit are only admitted when none is running.
+        if in_flight and in_flight + jobs > self.max_jobs:
+            return math.inf
+        tokens = self._tokens(state, now)
+        # Starting many jobs at once (the segments of a recording) is admitted with a single token, the bucket goes
+        # in debt for the others.
+        return (1 - tokens) / self.start_rate if tokens < 1 else 0
+
+    def check(self, jobs: int = 1) -> float:
+        """Whether jobs would be admitted now, without admitting them.
+
+        :param jobs: How many jobs would be started.
+        :type jobs: int
+        :return: 0 if they would, else how long (seconds) until the rate allows them, math.inf if as many jobs as
+            allowed are running.
+        :rtype: float
+        """
+        return self._wait(self._get_state(), jobs, int(time.time() * 1000))
+
+    def acquire(self, jobs: int = 1) -> float:
+        """Admits jobs that are about to be started: takes their slots and the tokens of their starts.
+
+        :param jobs: How many jobs will be started.
+        :type jobs: int
+        :return: 0 if they were admitted, else how long (seconds) until the rate allows them, math.inf if as many
+            jobs as allowed are running.
+        :rtype: float
+        """
+        table = self.dynamo_client.table
+        for attempt in range(self.max_conflicts):
+            state = self._get_state()
+            now = int(time.time() * 1000)
+            wait = self._wait(state, jobs, now)
+            if wait == math.inf and self._reconcile(state, now):
+                continue
+            if wait:
+                return wait
+
+            tokens = Decimal(f'{self._tokens(state, now) - jobs:.3f}')
+            try:
+                if state is None:
+                    table.put_item(
+                        Item={
+                            'name': ADMISSION_KEY, 'in_flight': jobs, 'tokens': tokens, 'refilled_at': now, 'version': 1
+                        },
+                        ConditionExpression='attribute_not_exists(#name)',
+                        ExpressionAttributeNames={'#name': 'name'}
+                    )
+                else:
+                    # Only admissions write the version: slots given back in the meantime don't make this one retry.
+                    table.update_item(
+                        Key={'name': ADMISSION_KEY},
+                        UpdateExpression=(
+                            'SET #tokens = :tokens, #refilled_at = :now, #version = :next ADD #in_flight :jobs'
+                        ),
+                        ConditionExpression='#version = :version',
+                        ExpressionAttributeNames={
+                            '#in_flight': 'in_flight', '#tokens': 'tokens', '#refilled_at': 'refilled_at',
+                            '#version': 'version'
+                        },
+                        ExpressionAttributeValues={
+                            ':tokens': tokens,
+                            ':now': now,
+                            ':next': int(state['version']) + 1,
+                            ':jobs': jobs,
+                            ':version': state['version']
+                        }
+                    )
+                return 0
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                time.sleep(random.uniform(0, self.retry_base_delay * 2 ** attempt))
+        # Contended, the caller tries again a little later.
+        return self.retry_base_delay * 2 ** self.max_conflicts
+
+    def release(self, jobs: int = 1) -> None:
+        """Gives back the slots of jobs that finished (or were admitted but not started).
+
+        :param jobs: How many jobs.
+        :type jobs: int
+        """
+        table = self.dynamo_client.table
+        try:
+            table.update_item(
+                Key={'name': ADMISSION_KEY},
+                UpdateExpression='ADD #in_flight :released',
+                ConditionExpression='#in_flight >= :jobs',
+                ExpressionAttributeNames={'#in_flight': 'in_flight'},
+                ExpressionAttributeValues={':released': -jobs, ':jobs': jobs}
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            # Reconciled below the jobs that were still running, it can't go negative.
+            try:
+                table.update_item(
+                    Key={'name': ADMISSION_KEY},
+                    UpdateExpression='SET #in_flight = :zero',
+                    ConditionExpression='attribute_exists(#in_flight) AND #in_flight < :jobs',
+                    ExpressionAttributeNames={'#in_flight': 'in_flight'},
+                    ExpressionAttributeValues={':zero': 0, ':jobs': jobs}
+                )
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                pass
+
+    def _reconcile(self, state: dict, now: int) -> bool:
+        """Gives back the slots leaked by jobs that never wrote a transcript, if it wasn't reconciled recently.
+
+        The jobs admitted but not started yet (e.g. the segments of a recording being split) aren't reported in
+        progress, so a slot is only given back when the counter was over the jobs in progress at the previous
+        reconciliation too.
+
+        :return: Whether slots were given back.
+        :rtype: bool
+        """
+        reconciled_at = int(state.get('reconciled_at', 0))
+        if now - reconciled_at < self.reconcile_seconds * 1000:
+            return False
+        table = self.dynamo_client.table
+        try:
+            # Claimed, so a single invocation lists the jobs.
+            table.update_item(
+                Key={'name': ADMISSION_KEY},
+                UpdateExpression='SET #reconciled_at = :now',
+                ConditionExpression='attribute_not_exists(#reconciled_at) OR #reconciled_at = :reconciled_at',
+                ExpressionAttributeNames={'#reconciled_at': 'reconciled_at'},
+                ExpressionAttributeValues={':now': now, ':reconciled_at': reconciled_at}
+            )
+            excess = max(int(state['in_flight']) - self.transcribe_service.count_running_jobs(), 0)
+            leaked = min(excess, int(state.get('excess', 0)))
+            table.update_item(
+                Key={'name': ADMISSION_KEY},
+                UpdateExpression='SET #excess = :excess ADD #in_flight :released',
+                ConditionExpression='#in_flight >= :leaked',
+                ExpressionAttributeNames={'#excess': 'excess', '#in_flight': 'in_flight'},
+                ExpressionAttributeValues={':excess': excess, ':released': -leaked, ':leaked': leaked}
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return leaked > 0
@@ -1,19 +1,23 @@
-import boto3
+from models.transcript import FileType, Transcript
+from services.providers.client_provider import ClientProvider
 
-from models.transcript import Transcript
+# The most jobs ListTranscriptionJobs returns at once
+LIST_JOBS_MAX_RESULTS = 100
 
 
 class TranscribeService(object):
 
-    def __init__(self) -> None:
-        self.transcribe_client = boto3.client('transcribe')
+    @property
+    def transcribe_client(self):
+        return ClientProvider.get_client('transcribe')
 
     def start_transcribe_job(
             self,
             transcript: Transcript,
             input_bucket: str,
-            output_bucket: str) -> str:
-        """Starts the aws transcribe job for the given transcript.
+            output_bucket: str,
+            segment: int = None) -> str:
+        """Starts the aws transcribe job for the given transcript, or one of its segments.
 
         :param transcript: The metadata object with the necessary paths.
         :type transcript: Transcript
@@ -21,16 +25,45 @@ class TranscribeService(object):
         :type input_bucket: str
         :param output_bucket: The bucket where transcribe should save the generated transcript.
         :type output_bucket: str
+        :param segment: The index of the segment (see Transcript.transcribe_segments) to transcribe, the whole audio
+            file if None.
+        :type segment: int
         :return: The transcription job's id returned by transcribe.
         :rtype: str
         """
-        job_args = {
-            'TranscriptionJobName': transcript.request_id.hex,
-            'Media': {'MediaFileUri': f's3://{input_bucket}/{transcript.audio_file_path}'},
-            'MediaFormat': transcript.file_type.value,
-            'OutputKey': transcript.transcript_file_path,
-            'OutputBucketName': output_bucket,
-            'LanguageCode': 'en-US'
-        }
-        response = self.transcribe_client.start_transcription_job(**job_args)
+        if segment is None:
+            job_args = {
+                'TranscriptionJobName': transcript.request_id.hex,
+                'Media': {'MediaFileUri': f's3://{input_bucket}/{transcript.audio_file_path}'},
+                # The format probed from the file, the url's extension otherwise.
+                'MediaFormat': (transcript.media_format or transcript.file_type).value,
+                'OutputKey': transcript.transcript_file_path
+            }
+        else:
+            job_args = {
+                'TranscriptionJobName': f'{transcript.request_id.hex}-{segment}',
+                'Media': {'MediaFileUri': f's3://{input_bucket}/{transcript.segment_audio_file_path(segment)}'},
+                'MediaFormat': FileType.WAV.value,
+                'OutputKey': transcript.segment_transcript_file_path(segment)
+            }
+        response = self.transcribe_client.start_transcription_job(
+            **job_args,
+            OutputBucketName=output_bucket,
+            LanguageCode='en-US'
+        )
         return response['TranscriptionJob']
+
+    def count_running_jobs(self) -> int:
+        """Counts the transcription jobs of the account that are in progress, they all count against its quota of
+        concurrent jobs.
+
+        :rtype: int
+        """
+        count = 0
+        list_args = {'Status': 'IN_PROGRESS', 'MaxResults': LIST_JOBS_MAX_RESULTS}
+        while True:
+            response = self.transcribe_client.list_transcription_jobs(**list_args)
+            count += len(response.get('TranscriptionJobSummaries', []))
+            if not response.get('NextToken'):
+                return count
+            list_args['NextToken'] = response['NextToken']
@@ -1,33 +1,255 @@
+import random
+import time
 from datetime import datetime
+from typing import Dict, Iterable, List, Sequence
 
-from models.transcript import Transcript
+from models.transcript import Transcript, TranscriptStatus
 from services.providers.dynamodb_provider import DynamoDBProvider
 
+# DynamoDB limits per BatchGetItem/BatchWriteItem call
+BATCH_GET_MAX_KEYS = 100
+BATCH_WRITE_MAX_ITEMS = 25
+# Who merges the segment transcripts of a split recording (left out of the model, the completed transcript drops it)
+SEGMENT_MERGE_CLAIMANT = 'segment_merge_claimant'
+# When the claim can be taken over (epoch seconds): its claimant's invocation is over by then
+SEGMENT_MERGE_CLAIM_EXPIRES = 'segment_merge_claim_expires'
+# The transcripts of the transcribe jobs whose admission was given back (left out of the model, like the claim)
+TRANSCRIBE_JOBS_RELEASED = 'released_transcribe_jobs'
+
+
+def _chunks(items: List, size: int) -> Iterable[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 
 class TranscriptStorageService(object):
     """Helpers class to store/load transcripts from DynamoDB
     """
 
-    def __init__(self, ddb_table: str):
+    def __init__(self, ddb_table: str, max_batch_retries: int = 8, retry_base_delay: float = 0.05):
         """Will create a new connection to DDB in order to store/retrieve transcripts.
 
         :param ddb_table: The name of the dynamo table to use.
         :type ddb_table: str
+        :param max_batch_retries: How many times unprocessed keys/items of a batch call are retried.
+        :type max_batch_retries: int
+        :param retry_base_delay: The base delay (seconds) of the exponential backoff between retries.
+        :type retry_base_delay: float
         """
         self.dynamo_client = DynamoDBProvider.get_instance(ddb_table)
+        self.max_batch_retries = max_batch_retries
+        self.retry_base_delay = retry_base_delay
+
+    def _backoff(self, attempt: int) -> None:
+        """Sleeps before retrying unprocessed requests (exponential backoff with full jitter).
+        """
+        if attempt > self.max_batch_retries:
+            raise Exception(f'Dynamo batch request still unprocessed after {self.max_batch_retries} retries!')
+        time.sleep(random.uniform(0, self.retry_base_delay * 2 ** attempt))
 
     def put_transcript(self, transcript: Transcript) -> bool:
         """
         Updates dynamodb representation of the model
         """
         transcript.updated = datetime.now()
-        self.dynamo_client.table.put_item(Item=transcript.as_dict())
+        self.dynamo_client.table.put_item(Item=transcript.as_item())
+
+    def put_transcripts(self, transcripts: Iterable[Transcript]) -> None:
+        """Stores many transcripts with as few round trips as possible (25 per BatchWriteItem call).
+
+        :param transcripts: The transcripts to store, if a request_id is repeated the last one wins.
+        :type transcripts: Iterable[Transcript]
+        """
+        now = datetime.now()
+        items: Dict[str, dict] = {}
+        for transcript in transcripts:
+            transcript.updated = now
+            items[transcript.request_id.hex] = transcript.as_item()
+
+        table_name = self.dynamo_client.table_name
+        for chunk in _chunks(list(items.values()), BATCH_WRITE_MAX_ITEMS):
+            request_items = {table_name: [{'PutRequest': {'Item': item}} for item in chunk]}
+            attempt = 0
+            while request_items:
+                response = self.dynamo_client.dynamodb.batch_write_item(RequestItems=request_items)
+                request_items = response.get('UnprocessedItems')
+                if request_items:
+                    attempt += 1
+                    self._backoff(attempt)
+
+    def next_analysis_version(self, request_id: str) -> int:
+        """Atomically reserves the version of a new re-analysis of the request (its own results are version 1).
+
+        :param request_id: The request id of the re-analysed transcript submission.
+        :type request_id: str
+        :return: The reserved version, 2 for the first re-analysis.
+        :rtype: int
+        """
+        response = self.dynamo_client.table.update_item(
+            Key={
+                'request_id': request_id
+            },
+            UpdateExpression='SET #v = if_not_exists(#v, :one) + :one',
+            ConditionExpression='attribute_exists(request_id)',
+            ExpressionAttributeNames={'#v': 'latest_analysis_version'},
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['latest_analysis_version'])
+
+    def add_failed_attempt(self, request_id: str) -> int:
+        """Atomically counts a failed attempt at processing the audio of the request.
+
+        :param request_id: The request id of the transcript submission.
+        :type request_id: str
+        :return: How many attempts failed, this one included.
+        :rtype: int
+        """
+        response = self.dynamo_client.table.update_item(
+            Key={
+                'request_id': request_id
+            },
+            UpdateExpression='ADD #failed :one',
+            ConditionExpression='attribute_exists(request_id)',
+            ExpressionAttributeNames={'#failed': 'failed_attempts'},
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['failed_attempts'])
+
+    def put_pending_attributes(self, transcript: Transcript, attributes: Sequence[str]) -> bool:
+        """Stores some attributes of a transcript, unless it isn't pending anymore.
+
+        Only those attributes are written, so a transcript the analysis already completed (e.g. a short Transcribe
+        job that finished before the process_audio batch did) isn't set back to pending.
+
+        :param transcript: The transcript to store.
+        :type transcript: Transcript
+        :param attributes: The names of the (top level) attributes to store, the unset ones are left out.
+        :type attributes: Sequence[str]
+        :return: False if the transcript wasn't pending anymore and nothing was written.
+        :rtype: bool
+        """
+        item = transcript.as_item()
+        names = {f'#a{idx}': name for idx, name in enumerate(attributes) if name in item}
+        if not names:
+            return True
+        table = self.dynamo_client.table
+        try:
+            table.update_item(
+                Key={
+                    'request_id': transcript.request_id.hex
+                },
+                UpdateExpression='SET ' + ', '.join(f'{alias} = :{alias[1:]}' for alias in names),
+                ConditionExpression='#status = :pending',
+                ExpressionAttributeNames={**names, '#status': 'status'},
+                ExpressionAttributeValues={
+                    **{f':{alias[1:]}': item[name] for alias, name in names.items()},
+                    ':pending': TranscriptStatus.PENDING.value
+                }
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def claim_segment_merge(self, request_id: str, claimant: str, expires_at: int) -> bool:
+        """Claims the merge of the segment transcripts of a pending transcript, so only one invocation runs it when
+        the last segments finish together (or their events are delivered twice).
 
-    def get_transcript(self, request_id: str) -> Transcript:
+        :param request_id: The request id of the transcript submission.
+        :type request_id: str
+        :param claimant: Who merges, the aws_request_id of the invocation: the retries of a failed asynchronous
+            invocation keep it, so they can claim the merge again.
+        :type claimant: str
+        :param expires_at: When (epoch seconds) the claim can be taken over by someone else, e.g. once the
+            claimant's invocation timed out.
+        :type expires_at: int
+        :return: False if the transcript isn't pending or the merge was claimed by someone else.
+        :rtype: bool
+        """
+        table = self.dynamo_client.table
+        try:
+            table.update_item(
+                Key={
+                    'request_id': request_id
+                },
+                UpdateExpression='SET #claim = :claimant, #expires = :expires',
+                ConditionExpression=(
+                    '#status = :pending AND (attribute_not_exists(#claim) OR #claim = :claimant OR #expires < :now)'
+                ),
+                ExpressionAttributeNames={
+                    '#claim': SEGMENT_MERGE_CLAIMANT, '#expires': SEGMENT_MERGE_CLAIM_EXPIRES, '#status': 'status'
+                },
+                ExpressionAttributeValues={
+                    ':claimant': claimant,
+                    ':expires': expires_at,
+                    ':now': int(time.time()),
+                    ':pending': TranscriptStatus.PENDING.value
+                }
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release_segment_merge(self, request_id: str, claimant: str) -> None:
+        """Gives back the merge claimed by claimant (e.g. when it failed), so another invocation can claim it.
+
+        :param request_id: The request id of the transcript submission.
+        :type request_id: str
+        :param claimant: Who claimed the merge.
+        :type claimant: str
+        """
+        table = self.dynamo_client.table
+        try:
+            table.update_item(
+                Key={
+                    'request_id': request_id
+                },
+                UpdateExpression='REMOVE #claim, #expires',
+                ConditionExpression='#claim = :claimant',
+                ExpressionAttributeNames={'#claim': SEGMENT_MERGE_CLAIMANT, '#expires': SEGMENT_MERGE_CLAIM_EXPIRES},
+                ExpressionAttributeValues={':claimant': claimant}
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def mark_transcribe_job_released(self, request_id: str, transcript_path: str) -> bool:
+        """Records that the admission of the transcribe job that wrote transcript_path was given back, once: the
+        retries of an invocation (or a second delivery of the event) don't give it back again.
+
+        :param request_id: The request id of the transcript submission.
+        :type request_id: str
+        :param transcript_path: The key of the transcript written by the job.
+        :type transcript_path: str
+        :return: False if it was already recorded or the transcript isn't pending, the admission isn't given back.
+        :rtype: bool
+        """
+        table = self.dynamo_client.table
+        try:
+            table.update_item(
+                Key={
+                    'request_id': request_id
+                },
+                UpdateExpression='ADD #released :transcripts',
+                ConditionExpression='#status = :pending AND NOT contains(#released, :transcript)',
+                ExpressionAttributeNames={'#released': TRANSCRIBE_JOBS_RELEASED, '#status': 'status'},
+                ExpressionAttributeValues={
+                    ':transcripts': {transcript_path},
+                    ':transcript': transcript_path,
+                    ':pending': TranscriptStatus.PENDING.value
+                }
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def get_transcript(self, request_id: str, load_sentences: bool = True) -> Transcript:
         """Will retrieve a transcript from dynamodb.
 
         :param request_id: The request id of the transcript submission.
         :type request_id: str
+        :param load_sentences: False skips decoding the sentences (see Transcript.from_item).
+        :type load_sentences: bool
         :return: The transcript for the given request_id
         :rtype: Transcript
         """
@@ -36,4 +258,51 @@ class TranscriptStorageService(object):
                 'request_id': request_id
             }
         )
-        return Transcript(**response['Item']) if response.get('Item') else None
+        return Transcript.from_item(response['Item'], load_sentences) if response.get('Item') else None
+
+    def get_transcript_attributes(self, request_id: str, attributes: Sequence[str]) -> dict:
+        """Will retrieve only the given top level attributes of a transcript, e.g. to check its status.
+
+        Nothing is deserialized into models, the values are returned as dynamo hands them back.
+
+        :param request_id: The request id of the transcript submission.
+        :type request_id: str
+        :param attributes: The names of the attributes to read (request_id is always included).
+        :type attributes: Sequence[str]
+        :return: The attributes that are set, None if the transcript doesn't exist.
+        :rtype: dict
+        """
+        # Aliased, since some attribute names (e.g. status) are reserved words in dynamo expressions.
+        names = {f'#a{idx}': name for idx, name in enumerate(dict.fromkeys(['request_id', *attributes]))}
+        response = self.dynamo_client.table.get_item(
+            Key={
+                'request_id': request_id
+            },
+            ProjectionExpression=', '.join(names),
+            ExpressionAttributeNames=names
+        )
+        return response.get('Item')
+
+    def get_transcripts(self, request_ids: Iterable[str]) -> Dict[str, Transcript]:
+        """Will retrieve many transcripts with as few round trips as possible (100 per BatchGetItem call).
+
+        :param request_ids: The request ids of the transcript submissions.
+        :type request_ids: Iterable[str]
+        :return: The transcripts keyed by request_id, ids that don't exist are left out.
+        :rtype: Dict[str, Transcript]
+        """
+        table_name = self.dynamo_client.table_name
+        transcripts: Dict[str, Transcript] = {}
+        for chunk in _chunks(list(dict.fromkeys(request_ids)), BATCH_GET_MAX_KEYS):
+            request_items = {table_name: {'Keys': [{'request_id': request_id} for request_id in chunk]}}
+            attempt = 0
+            while request_items:
+                response = self.dynamo_client.dynamodb.batch_get_item(RequestItems=request_items)
+                for item in response.get('Responses', {}).get(table_name, []):
+                    transcripts[item['request_id']] = Transcript.from_item(item)
+                request_items = response.get('UnprocessedKeys')
+                if request_items:
+                    attempt += 1
+                    self._backoff(attempt)
+
+        return transcripts
@@ -0,0 +1,54 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+# The tests import the common layer the way the functions do (it is the root of the layer's python path), and the
+# in-memory stand-ins of the AWS services from the benchmarks.
+sys.path.insert(0, os.path.join(ROOT, 'src', 'layers', 'common', 'python'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+REGION = 'us-east-1'
+BUCKET = 'test-audio-analysis'
+TABLE = 'test_analysis_requests'
+ADMISSION_TABLE = 'test_transcribe_admission'
+AUDIO_QUEUE_URL = f'https://sqs.{REGION}.amazonaws.com/000000000000/audio_transcribe_queue'
+
+
+def import_function(function: str) -> None:
+    """Puts a function's directory on the path, so that its modules import like they do in the lambda."""
+    path = os.path.join(ROOT, 'src', 'functions', function)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """The in-memory stand-ins of local_backends installed in place of the AWS clients and the http pool."""
+    from local_backends import FakeHttp, InMemoryDynamoDB, InMemoryS3, InMemorySQS
+    from services.providers.client_provider import ClientProvider
+
+    for name, value in {
+        'AWS_DEFAULT_REGION': REGION,
+        'TRANSCRIPTS_TABLE': TABLE,
+        'TRANSCRIPTS_BUCKET': BUCKET,
+        'AUDIO_TRANSCRIBE_QUEUE_URL': AUDIO_QUEUE_URL,
+        'POWERTOOLS_METRICS_NAMESPACE': 'Tests',
+    }.items():
+        monkeypatch.setenv(name, value)
+    backends = SimpleNamespace(
+        s3=InMemoryS3(),
+        sqs=InMemorySQS(),
+        dynamodb=InMemoryDynamoDB({TABLE: 'request_id', ADMISSION_TABLE: 'name'}),
+        http=FakeHttp()
+    )
+    ClientProvider.reset()
+    ClientProvider.set_client('s3', backends.s3)
+    ClientProvider.set_client('sqs', backends.sqs)
+    ClientProvider.set_resource('dynamodb', backends.dynamodb)
+    ClientProvider.set_http(backends.http)
+    yield backends
+    ClientProvider.reset()
@@ -0,0 +1,53 @@
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+from conftest import ADMISSION_TABLE, TABLE, import_function
+
+import_function('analyse_transcript')
+
+from analyse_transcript_helper import AnalyseTrascriptHelper  # noqa: E402
+from models.transcript import FileType, Transcript, TranscriptStatus  # noqa: E402
+from services.transcript_storage_service import TranscriptStorageService  # noqa: E402
+
+
+@pytest.fixture
+def transcript(aws, monkeypatch) -> Transcript:
+    """A pending transcript split in 3 segments, whose jobs were admitted."""
+    monkeypatch.setenv('TRANSCRIBE_ADMISSION_TABLE', ADMISSION_TABLE)
+    now = datetime.now(timezone.utc)
+    transcript = Transcript(
+        request_id=uuid.uuid4(), audio_url='https://audio.example.com/recording.wav', created=now, updated=now,
+        file_type=FileType.WAV, sentences=[]
+    )
+    transcript.transcribe_segments = [[0, 60], [45, 120], [105, 150]]
+    TranscriptStorageService(TABLE).put_transcript(transcript)
+    return transcript
+
+
+def _in_flight(aws) -> int:
+    return int(aws.dynamodb.items(ADMISSION_TABLE)['transcribe']['in_flight'])
+
+
+def test_transcribe_jobs_are_released_once_however_often_their_transcripts_are_analysed(aws, transcript):
+    helper = AnalyseTrascriptHelper()
+    assert helper.admission_service.acquire(3) == 0
+    first, second = transcript.segment_transcript_file_path(0), transcript.segment_transcript_file_path(1)
+
+    # The invocation of the first segment's transcript is retried, the second is analysed with the retry.
+    for paths in ([first], [first], [first, second]):
+        helper.release_transcribe_jobs(sum(helper.claim_transcribe_job_release(transcript, path) for path in paths))
+
+    assert _in_flight(aws) == 1
+
+
+def test_transcripts_not_written_by_a_transcribe_job_release_nothing(aws, transcript):
+    helper = AnalyseTrascriptHelper()
+    assert helper.admission_service.acquire(3) == 0
+
+    # The merged transcript of the segments.
+    assert not helper.claim_transcribe_job_release(transcript, transcript.transcript_file_path)
+    transcript.status = TranscriptStatus.COMPLETED
+    assert not helper.claim_transcribe_job_release(transcript, transcript.segment_transcript_file_path(2))
+    assert _in_flight(aws) == 3
@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+from conftest import AUDIO_QUEUE_URL, BUCKET, TABLE, import_function
+
+import_function('transcripts_api')
+
+from analysis_helper import AnalysisHelper  # noqa: E402
+from local_backends import ClientError  # noqa: E402
+from models.transcript import TranscriptStatus  # noqa: E402
+
+ENTRIES = [(f'https://audio.example.com/{idx}.wav', ['hello there'], '.wav', None) for idx in range(40)]
+
+
+def _statuses(aws, transcripts: list) -> list:
+    items = aws.dynamodb.items(TABLE)
+    return [items[transcript.request_id.hex]['status'] for transcript in transcripts]
+
+
+def _queued(aws) -> set:
+    request_ids = set()
+    while True:
+        messages = aws.sqs.receive_message(QueueUrl=AUDIO_QUEUE_URL, MaxNumberOfMessages=10).get('Messages', [])
+        if not messages:
+            return request_ids
+        request_ids.update(json.loads(message['Body'])['request_id'] for message in messages)
+
+
+def test_a_send_call_that_raises_fails_only_its_own_entries(aws, monkeypatch):
+    helper = AnalysisHelper()
+    transcripts, errors = helper.save_transcript_analysis_requests(ENTRIES[:25])
+    assert errors == {}
+    send_message_batch, calls = aws.sqs.send_message_batch, []
+
+    def send_failing_second_call(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 2:
+            raise ClientError('AccessDenied', 'SendMessageBatch', 'Access denied')
+        return send_message_batch(**kwargs)
+
+    monkeypatch.setattr(aws.sqs, 'send_message_batch', send_failing_second_call)
+    errors = helper.register_transcribe_tasks(transcripts)
+
+    # Entries 10-19 went in the second call.
+    failed = transcripts[10:20]
+    assert set(errors) == {transcript.request_id.hex for transcript in failed}
+    assert _statuses(aws, failed) == [TranscriptStatus.FAILED.value] * 10
+    assert _statuses(aws, transcripts[:10] + transcripts[20:]) == [TranscriptStatus.PENDING.value] * 15
+    reason = aws.dynamodb.items(TABLE)[failed[0].request_id.hex]['failure_reason']
+    assert reason.startswith('Failed to schedule processing:') and 'Access denied' in reason
+    assert _queued(aws) == {transcript.request_id.hex for transcript in transcripts[:10] + transcripts[20:]}
+
+
+def test_entries_the_queue_rejects_are_failed(aws, monkeypatch):
+    helper = AnalysisHelper()
+    transcripts, _ = helper.save_transcript_analysis_requests(ENTRIES[:3])
+    send_message_batch = aws.sqs.send_message_batch
+
+    def reject_second_entry(QueueUrl, Entries, **kwargs):
+        response = send_message_batch(QueueUrl=QueueUrl, Entries=[Entries[0], Entries[2]], **kwargs)
+        response['Failed'] = [
+            {'Id': Entries[1]['Id'], 'SenderFault': True, 'Code': 'InvalidMessageContents', 'Message': 'Invalid'}
+        ]
+        return response
+
+    monkeypatch.setattr(aws.sqs, 'send_message_batch', reject_second_entry)
+    errors = helper.register_transcribe_tasks(transcripts)
+
+    assert errors == {transcripts[1].request_id.hex: 'Invalid'}
+    assert _statuses(aws, transcripts) == ['pending', 'failed', 'pending']
+
+
+def test_a_write_that_fails_part_way_fails_every_entry(aws, monkeypatch):
+    helper = AnalysisHelper()
+    batch_write_item, calls = aws.dynamodb.batch_write_item, []
+
+    def write_failing_second_call(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 2:
+            raise ClientError('ProvisionedThroughputExceededException', 'BatchWriteItem')
+        return batch_write_item(**kwargs)
+
+    monkeypatch.setattr(aws.dynamodb, 'batch_write_item', write_failing_second_call)
+    transcripts, errors = helper.save_transcript_analysis_requests(ENTRIES)
+
+    # The first 25 were written before the second call raised, they aren't left pending.
+    assert set(errors) == {transcript.request_id.hex for transcript in transcripts}
+    assert all(error.startswith('Failed to store the request:') for error in errors.values())
+    assert _statuses(aws, transcripts) == [TranscriptStatus.FAILED.value] * 40
+
+
+@pytest.mark.parametrize('size', [1, 10, 11])
+def test_registered_entries_are_queued_once(aws, size):
+    helper = AnalysisHelper()
+    transcripts, _ = helper.save_transcript_analysis_requests(ENTRIES[:size])
+
+    assert helper.register_transcribe_tasks(transcripts) == {}
+    assert _queued(aws) == {transcript.request_id.hex for transcript in transcripts}
+
+
+def test_reanalyses_are_new_versions_of_the_root_request(aws):
+    helper = AnalysisHelper()
+    (parent,), _ = helper.save_transcript_analysis_requests(ENTRIES[:1])
+    parent.status = TranscriptStatus.COMPLETED
+    parent.transcript_path = parent.transcript_file_path
+    helper.transcript_storage_service.put_transcript(parent)
+    items = [
+        {'type': 'pronunciation', 'alternatives': [{'confidence': '0.99', 'content': word}],
+         'start_time': f'{idx}.000', 'end_time': f'{idx + 1}.000'}
+        for idx, word in enumerate('well hello there friend'.split())
+    ]
+    aws.s3.put_object(
+        Bucket=BUCKET, Key=parent.transcript_path, Body=json.dumps({'results': {'items': items}}).encode('utf-8')
+    )
+
+    first = helper.reanalyse_transcript(parent, ['hello there'])
+    # A re-analysis of the re-analysis is a version of the same root.
+    second = helper.reanalyse_transcript(first, ['there friend', 'goodbye'])
+
+    assert (first.analysis_version, second.analysis_version) == (2, 3)
+    assert first.parent_request_id == second.parent_request_id == parent.request_id
+    assert aws.dynamodb.items(TABLE)[parent.request_id.hex]['latest_analysis_version'] == 3
+    assert [sentence.was_present for sentence in second.sentences] == [True, False]
+    assert second.status == TranscriptStatus.COMPLETED
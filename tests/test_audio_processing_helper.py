@@ -0,0 +1,97 @@
+import io
+import uuid
+import wave
+from datetime import datetime, timezone
+
+import pytest
+
+from conftest import BUCKET, TABLE, import_function
+
+import_function('process_audio')
+
+from audio_processing_helper import AudioProcessingHelper  # noqa: E402
+from models.transcript import FileType, Transcript  # noqa: E402
+from services.audio_probe import AudioProbeError  # noqa: E402
+
+AUDIO_URL = 'https://audio.example.com/recording.wav'
+
+
+def _wav(seconds: int) -> bytes:
+    file = io.BytesIO()
+    with wave.open(file, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(bytes(seconds * 16000 * 2))
+    return file.getvalue()
+
+
+def _transcript(audio_url: str = AUDIO_URL) -> Transcript:
+    now = datetime.now(timezone.utc)
+    return Transcript(
+        request_id=uuid.uuid4(), audio_url=audio_url, created=now, updated=now, file_type=FileType.WAV, sentences=[]
+    )
+
+
+@pytest.mark.parametrize('seconds', [3, 200])
+def test_transfer_audio_file_copies_the_audio_and_sets_what_was_probed(aws, monkeypatch, seconds):
+    # 200s is 6.4MB, more than one 5MB part.
+    monkeypatch.setenv('AUDIO_TRANSFER_PART_SIZE_MB', '5')
+    data = _wav(seconds)
+    aws.http.add_file(AUDIO_URL, data)
+    transcript = _transcript()
+
+    helper = AudioProcessingHelper(TABLE, BUCKET)
+    path = helper.transfer_audio_file(transcript, helper.stage_timer(transcript))
+
+    assert path == transcript.audio_file_path
+    assert aws.s3.get_object(Bucket=BUCKET, Key=path)['Body'].read() == data
+    assert transcript.media_format == FileType.WAV
+    assert transcript.audio_duration == seconds
+    assert transcript.audio_sample_rate == 16000
+    assert 'audio_download' in transcript.stage_timings
+
+
+def test_transfer_audio_file_refuses_what_is_not_audio(aws):
+    aws.http.add_file(AUDIO_URL, b'<html>' + bytes(4096))
+
+    with pytest.raises(AudioProbeError):
+        AudioProcessingHelper(TABLE, BUCKET).transfer_audio_file(_transcript())
+
+
+def test_start_transcribe_task_counts_a_job_started_by_an_earlier_delivery(aws):
+    from local_backends import FakeTranscribe
+    from services.providers.client_provider import ClientProvider
+
+    ClientProvider.set_client('transcribe', FakeTranscribe(aws.s3, lambda job_name: {}, lambda job_name: 60))
+    aws.http.add_file(AUDIO_URL, _wav(3))
+    transcript = _transcript()
+    helper = AudioProcessingHelper(TABLE, BUCKET)
+    helper.transfer_audio_file(transcript)
+
+    assert helper.start_transcribe_task(transcript) == 1
+    # The message is delivered again while the job runs.
+    assert helper.start_transcribe_task(transcript) == 1
+
+
+def test_set_transcript_requests_failed_leaves_transcripts_that_are_not_pending(aws):
+    from models.transcript import TranscriptStatus
+    from services.transcript_storage_service import TranscriptStorageService
+
+    pending, completed = _transcript(), _transcript()
+    completed.status = TranscriptStatus.COMPLETED
+    completed.latest_analysis_version = 2
+    storage = TranscriptStorageService(TABLE)
+    storage.put_transcripts([pending, completed])
+
+    failed = AudioProcessingHelper(TABLE, BUCKET).set_transcript_requests_failed(
+        [pending, completed], {pending.request_id.hex: 'Not audio', completed.request_id.hex: 'Timed out'}
+    )
+
+    assert failed == [pending]
+    items = aws.dynamodb.items(TABLE)
+    assert items[pending.request_id.hex]['status'] == TranscriptStatus.FAILED.value
+    assert items[pending.request_id.hex]['failure_reason'] == 'Not audio'
+    assert items[completed.request_id.hex]['status'] == TranscriptStatus.COMPLETED.value
+    assert items[completed.request_id.hex]['latest_analysis_version'] == 2
+    assert 'failure_reason' not in items[completed.request_id.hex]
@@ -0,0 +1,118 @@
+import io
+import random
+import wave
+
+import pytest
+
+from services import audio_splitter
+from services.audio_splitter import WavSplitter, segment_bounds
+
+RATE = 8000
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_SIZE = CHANNELS * SAMPLE_WIDTH
+
+
+class _Stream(object):
+    """Only has read, like the body of an s3 object."""
+
+    def __init__(self, data: bytes):
+        self._data = io.BytesIO(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._data.read(size)
+
+
+def _wav(frames: int) -> tuple:
+    """Returns a WAV file of random frames and its frames."""
+    data = random.Random(frames).randbytes(frames * FRAME_SIZE)
+    file = io.BytesIO()
+    with wave.open(file, 'wb') as wav:
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(SAMPLE_WIDTH)
+        wav.setframerate(RATE)
+        wav.writeframes(data)
+    return file.getvalue(), data
+
+
+def _segments(splitter: WavSplitter) -> list:
+    segments = []
+    for idx, file in splitter.iter_segments():
+        with wave.open(file, 'rb') as wav:
+            segments.append((idx, wav.getparams(), wav.readframes(wav.getnframes() + 1)))
+    return segments
+
+
+@pytest.fixture(autouse=True)
+def small_copies(monkeypatch):
+    # Frames are copied in chunks that don't line up with the segments.
+    monkeypatch.setattr(audio_splitter, 'COPY_FRAMES', 777)
+
+
+@pytest.mark.parametrize('total, segment, overlap', [
+    (1000, 1000, 100), (1001, 1000, 100), (10000, 1000, 0), (10000, 3000, 250), (123457, 10000, 1000)
+])
+def test_segment_bounds_cover_the_audio_with_exact_overlaps(total, segment, overlap):
+    bounds = segment_bounds(total, segment, overlap)
+
+    assert bounds[0][0] == 0
+    assert bounds[-1][1] == total
+    assert all(end - start <= segment for start, end in bounds)
+    assert all(previous[1] - start == overlap for previous, (start, _) in zip(bounds, bounds[1:]))
+    # The fewest segments: one less couldn't cover the audio.
+    assert len(bounds) == 1 or (len(bounds) - 1) * (segment - overlap) + overlap < total
+
+
+@pytest.mark.parametrize('segment_seconds, overlap_seconds', [(3, 0.5), (2.5, 0), (1, 0.25), (20, 1)])
+def test_segments_hold_exactly_their_frames(segment_seconds, overlap_seconds):
+    wav, data = _wav(10 * RATE + 37)
+    splitter = WavSplitter(_Stream(wav), segment_seconds, overlap_seconds)
+
+    segments = _segments(splitter)
+
+    assert [idx for idx, _, _ in segments] == list(range(len(splitter.bounds)))
+    for (idx, params, frames), (start, end) in zip(segments, splitter.bounds):
+        assert (params.nchannels, params.sampwidth, params.framerate) == (CHANNELS, SAMPLE_WIDTH, RATE)
+        assert params.nframes == end - start
+        assert frames == data[start * FRAME_SIZE:end * FRAME_SIZE]
+
+
+def test_bounds_in_seconds():
+    wav, _ = _wav(10 * RATE)
+    splitter = WavSplitter(_Stream(wav), 4, 1)
+
+    assert [[float(start), float(end)] for start, end in splitter.bounds_seconds()] == [
+        [start / RATE, end / RATE] for start, end in splitter.bounds
+    ]
+
+
+def test_truncated_file_ends_with_its_last_frame():
+    wav, data = _wav(10 * RATE)
+    truncated = wav[:len(wav) - RATE * FRAME_SIZE]
+    available = len(data) - RATE * FRAME_SIZE
+    splitter = WavSplitter(_Stream(truncated), 3, 0.5)
+
+    segments = _segments(splitter)
+
+    assert len(segments) == len(splitter.bounds)
+    for (_, _, frames), (start, end) in zip(segments, splitter.bounds):
+        assert frames == data[start * FRAME_SIZE:min(end * FRAME_SIZE, available)]
+
+
+def test_file_ending_before_a_segment_fails():
+    wav, _ = _wav(10 * RATE)
+    splitter = WavSplitter(_Stream(wav[:len(wav) - 3 * RATE * FRAME_SIZE]), 3, 0.5)
+
+    with pytest.raises(Exception, match='ends before its segment'):
+        _segments(splitter)
+
+
+def test_known_duration_shorter_than_the_header():
+    wav, data = _wav(10 * RATE)
+    truncated = wav[:len(wav) - 3 * RATE * FRAME_SIZE]
+    splitter = WavSplitter(_Stream(truncated), 3, 0.5, duration=7)
+
+    assert splitter.bounds[-1][1] == 7 * RATE
+    for (_, params, frames), (start, end) in zip(_segments(splitter), splitter.bounds):
+        assert params.nframes == end - start
+        assert frames == data[start * FRAME_SIZE:end * FRAME_SIZE]
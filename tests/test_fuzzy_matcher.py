@@ -0,0 +1,131 @@
+from decimal import Decimal
+
+import pytest
+
+from analysis.fuzzy_matcher import FuzzyPhraseMatcher
+from analysis.transcript_analyzer import TranscriptAnalyzer
+from models.analysis_options import AnalysisOptions
+from models.sentence import Sentence
+
+CANCEL = 'i would like to cancel'
+
+
+class _Ids(dict):
+    """Gives every word a token id as it's first seen."""
+
+    def __missing__(self, word: str) -> int:
+        self[word] = len(self)
+        return self[word]
+
+    def of(self, text: str) -> list:
+        return [self[word] for word in text.split()]
+
+
+def _matches(phrases: list, text: str, max_errors: int, alternatives: dict = None) -> list:
+    ids = _Ids()
+    matcher = FuzzyPhraseMatcher([ids.of(phrase) for phrase in phrases], max_errors)
+    alternatives = {position: tuple(ids.of(words)) for position, words in (alternatives or {}).items()}
+    return list(matcher.iter_matches(ids.of(text), alternatives))
+
+
+def test_short_phrases_get_fewer_errors():
+    matcher = FuzzyPhraseMatcher([[1], [1, 2], [1, 2, 3], [1, 2, 3, 4, 5], [1, 2, 3, 4, 5, 6, 7]], 2)
+
+    assert matcher.allowed_errors == [0, 0, 1, 2, 2]
+
+
+def test_empty_phrases_never_match():
+    assert _matches(['', 'a b c'], 'a b c', 1) == [(1, 0, 2, 0)]
+
+
+@pytest.mark.parametrize('text, expected', [
+    (CANCEL, (0, 0, 4, 0)),
+    ('i would love to cancel', (0, 0, 4, 1)),
+    ('i would really like to cancel', (0, 0, 5, 1)),
+    ('i would love two stop', None),
+    ('i would love really to cancel', (0, 0, 5, 2)),
+    ('i should love to cancel', (0, 0, 4, 2)),
+    ('i should love two cancel', None),
+])
+def test_substitutions_and_insertions_count_against_the_budget(text, expected):
+    assert _matches([CANCEL], text, 2) == ([expected] if expected else [])
+
+
+def test_the_budget_is_the_smaller_of_max_errors_and_the_phrase_s():
+    assert _matches([CANCEL], 'i should love to cancel', 1) == []
+    # Two words, no error allowed whatever max_errors.
+    assert _matches(['thank you'], 'thank yo', 3) == []
+
+
+def test_an_occurrence_never_starts_with_a_wrong_word():
+    assert _matches([CANCEL], 'so we would like to cancel', 2) == []
+
+
+def test_matches_are_found_in_the_middle_of_the_transcript():
+    text = 'hello yes i would like to cancel my order please and i would love to cancel it'
+
+    assert _matches([CANCEL, 'my order'], text, 2) == [(0, 2, 6, 0), (1, 7, 8, 0), (0, 11, 15, 1)]
+
+
+def test_exact_occurrences_overlap_approximate_ones_do_not():
+    assert _matches(['a b a'], 'a b a b a', 1) == [(0, 0, 2, 0), (0, 2, 4, 0)]
+    # "a x a" (a substitution) ends where a later occurrence could start, it's reported once.
+    assert _matches(['a b c a'], 'a b x a b c a', 1) == [(0, 0, 3, 1), (0, 3, 6, 0)]
+
+
+def test_alternatives_are_accepted_without_an_error():
+    text = 'i wood like two cancel'
+
+    assert _matches([CANCEL], text, 2) == [(0, 0, 4, 2)]
+    assert _matches([CANCEL], text, 2, {1: 'would', 3: 'to too'}) == [(0, 0, 4, 0)]
+    assert _matches([CANCEL], text, 2, {1: 'could'}) == [(0, 0, 4, 2)]
+
+
+def _items(*words) -> list:
+    """Transcribe items of the words, a word or (word, confidence, alternative, confidence)."""
+    items = []
+    for position, word in enumerate(words):
+        word = word if isinstance(word, tuple) else (word, '0.99')
+        alternatives = [
+            {'content': content, 'confidence': confidence} for content, confidence in zip(word[::2], word[1::2])
+        ]
+        items.append({
+            'type': 'pronunciation', 'alternatives': alternatives,
+            'start_time': f'{position:.3f}', 'end_time': f'{position + 1:.3f}'
+        })
+    return items
+
+
+def _analyse(items: list, **options) -> Sentence:
+    sentence = Sentence(CANCEL)
+    TranscriptAnalyzer([sentence], AnalysisOptions(**options)).analyse(items)
+    return sentence
+
+
+def test_low_confidence_alternatives_are_ignored():
+    items = _items('i', ('wood', '0.6', 'would', '0.3'), 'like', 'to', 'cancel')
+
+    assert _analyse(items, max_errors=1).occurrences[0].errors == 0
+    assert _analyse(items, max_errors=1, min_confidence='0.2').occurrences[0].errors == 0
+    assert _analyse(items, max_errors=1, min_confidence='0.5').occurrences[0].errors == 1
+    # Below the confidence, a word is no word at all: an error even when it's the right one.
+    items = _items('i', ('would', '0.1'), 'like', 'to', 'cancel')
+    assert _analyse(items, max_errors=1, min_confidence='0.5').occurrences[0].errors == 1
+    assert not _analyse(items, min_confidence='0.5').was_present
+
+
+def test_the_score_is_the_share_of_exact_words_of_the_best_occurrence():
+    approximate = _items('i', 'would', 'love', 'to', 'cancel')
+    sentence = _analyse(approximate, max_errors=2)
+    assert sentence.match_score == Decimal('0.8')
+    assert [occurrence.errors for occurrence in sentence.occurrences] == [1]
+
+    sentence = _analyse(_items('i', 'could', 'love', 'to', 'cancel'), max_errors=2)
+    assert sentence.match_score == Decimal('0.6')
+
+    sentence = _analyse(approximate + _items('and', 'i', 'would', 'like', 'to', 'cancel'), max_errors=2)
+    assert sentence.match_score == Decimal(1)
+    assert [occurrence.errors for occurrence in sentence.occurrences] == [1, 0]
+    assert sentence.occurrence_count == 2
+
+    assert _analyse(_items('i', 'would', 'like', 'to', 'cancel')).match_score == Decimal(1)
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from analysis.phrase_matcher import PhraseMatcher
+
+
+def _matches(phrases: list, text: str) -> set:
+    """The occurrences found, as (phrase, start position, end position)."""
+    matcher = PhraseMatcher([phrase.split() for phrase in phrases])
+    return {
+        (phrases[phrase_idx], end - matcher.phrase_lengths[phrase_idx] + 1, end)
+        for phrase_idx, end in matcher.iter_matches(text.split())
+    }
+
+
+def _expected(phrases: list, text: str) -> set:
+    """Every occurrence of every phrase, the slow way."""
+    tokens = text.split()
+    return {
+        (phrase, start, start + len(phrase.split()) - 1)
+        for phrase in phrases if phrase
+        for start in range(len(tokens) - len(phrase.split()) + 1)
+        if tokens[start:start + len(phrase.split())] == phrase.split()
+    }
+
+
+def test_overlapping_and_repeated_occurrences_are_all_found():
+    assert _matches(['a a', 'a b a'], 'a a a b a b a') == {
+        ('a a', 0, 1), ('a a', 1, 2), ('a b a', 2, 4), ('a b a', 4, 6)
+    }
+
+
+def test_phrases_sharing_a_prefix():
+    phrases = ['thank you', 'thank you very much', 'thank goodness']
+
+    assert _matches(phrases, 'well thank you very much and thank goodness') == {
+        ('thank you', 1, 2), ('thank you very much', 1, 4), ('thank goodness', 6, 7)
+    }
+    # A longer phrase breaking off doesn't hide the shorter one it starts with.
+    assert _matches(phrases, 'thank you very little') == {('thank you', 0, 1)}
+
+
+def test_phrases_ending_inside_others_are_found_through_the_failure_links():
+    phrases = ['can i help you', 'help you', 'you']
+
+    assert _matches(phrases, 'can i help you') == {
+        ('can i help you', 0, 3), ('help you', 2, 3), ('you', 3, 3)
+    }
+    # The matcher falls back from "can i" to the start of "can i help you" again.
+    assert _matches(phrases, 'can can i help you') == {
+        ('can i help you', 1, 4), ('help you', 3, 4), ('you', 4, 4)
+    }
+
+
+@pytest.mark.parametrize('text', ['hello there', 'hello', 'there hello'])
+def test_phrases_at_the_start_and_end_of_the_transcript(text):
+    assert _matches(['hello', 'there', 'hello there'], text) == _expected(['hello', 'there', 'hello there'], text)
+
+
+def test_empty_phrases_and_transcripts_never_match():
+    assert _matches(['', 'hello'], 'hello') == {('hello', 0, 0)}
+    assert _matches(['hello'], '') == set()
+    assert PhraseMatcher([]).phrase_lengths == []
+
+
+def test_repeated_phrases_are_reported_under_each_index():
+    matcher = PhraseMatcher([['good', 'morning'], ['good', 'morning']])
+
+    assert list(matcher.iter_matches(['good', 'morning'])) == [(0, 1), (1, 1)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_phrases_match_like_a_brute_force_search(seed):
+    rng = random.Random(seed)
+    words = 'a b c d'.split()
+    phrases = [' '.join(rng.choices(words, k=rng.randint(1, 4))) for _ in range(rng.randint(1, 8))]
+    text = ' '.join(rng.choices(words, k=60))
+
+    assert _matches(phrases, text) == _expected(phrases, text)
@@ -0,0 +1,55 @@
+import pytest
+
+from conftest import ADMISSION_TABLE, BUCKET
+
+from services.search_index_service import SearchIndexService
+
+
+def _postings(*words: str) -> dict:
+    """The postings of a transcript of the words, a second each."""
+    postings = {}
+    for position, word in enumerate(words):
+        postings.setdefault(word, []).append([position, position, position, position + 1])
+    return postings
+
+
+@pytest.fixture
+def index(aws) -> SearchIndexService:
+    # A single shard, so every transcript writes to it.
+    return SearchIndexService(BUCKET, shard_count=1, lock_table=ADMISSION_TABLE, compact_segments=3)
+
+
+def _segments(aws) -> list:
+    response = aws.s3.list_objects_v2(Bucket=BUCKET, Prefix='search_index/shard=000/segments/')
+    return [obj['Key'] for obj in response.get('Contents', [])]
+
+
+def test_a_shard_is_compacted_once_it_has_enough_segments(aws, index):
+    shards = index.index_transcript('a', _postings('hello', 'there', 'friend'))
+    shards += index.index_transcript('b', _postings('hello', 'friend'))
+    assert shards == [0, 0]
+    assert index.compact_due_shard(shards, 'invocation') == 0
+    assert len(_segments(aws)) == 2
+
+    # Indexed again: its older segment is replaced.
+    shards = index.index_transcript('a', _postings('there', 'friend', 'hello'))
+    assert index.compact_due_shard(shards, 'invocation') == 3
+
+    assert _segments(aws) == []
+    assert index.search(['hello', 'friend']) == {'b': [[0, 1, 0, 2]]}
+    assert index.search(['friend', 'hello']) == {'a': [[1, 2, 1, 3]]}
+
+
+def test_a_shard_someone_else_compacts_is_left_alone(aws, index):
+    for request_id in 'abc':
+        shards = index.index_transcript(request_id, _postings('hello'))
+    assert index._claim_compaction(0, 'other')
+
+    assert index.compact_due_shard(shards, 'invocation') == 0
+    assert index.compact_shard(0, 'invocation') == 0
+    assert len(_segments(aws)) == 3
+
+    index._release_compaction(0, 'other')
+    assert index.compact_due_shard(shards, 'invocation') == 3
+    # The lease was given back.
+    assert index.compact_shard(0, 'other') == 0 and index._claim_compaction(0, 'other')
@@ -0,0 +1,160 @@
+import json
+import random
+
+import pytest
+
+from analysis.segment_merger import TranscriptFileWriter, merge_segment_items
+from services.audio_splitter import segment_bounds
+
+
+def _word(content: str, start: float, end: float) -> dict:
+    return {
+        'type': 'pronunciation',
+        'alternatives': [{'confidence': '0.99', 'content': content}],
+        'start_time': f'{start:.3f}',
+        'end_time': f'{end:.3f}'
+    }
+
+
+def _punctuation(content: str) -> dict:
+    return {'type': 'punctuation', 'alternatives': [{'confidence': '0.0', 'content': content}]}
+
+
+def _recording(words: int, seed: int = 0, vocabulary: int = 50) -> list:
+    """The items of a whole recording: words 0.2-0.6s long, 0.21-0.5s apart, some followed by punctuation.
+
+    A small vocabulary repeats words often, also right after each other. The pauses are longer than twice the
+    timing differences between segments (see _transcribe_segments), otherwise a repeated word can't be told apart
+    from the same word timed differently.
+    """
+    rng = random.Random(seed)
+    items, time = [], 0.0
+    for _ in range(words):
+        start = time + rng.uniform(0.21, 0.5)
+        time = start + rng.uniform(0.2, 0.6)
+        items.append(_word(f'w{rng.randrange(vocabulary)}', start, time))
+        if rng.random() < 0.15:
+            items.append(_punctuation(rng.choice('.,?')))
+    return items
+
+
+def _transcribe_segments(items: list, bounds: list, jitter: float, seed: int = 0) -> list:
+    """What every segment's transcription job returns: the words heard in full in the segment, timed from its
+    start give or take jitter seconds, with the punctuation that follows them.
+    """
+    rng = random.Random(seed)
+    segments = []
+    for start, end in bounds:
+        segment, inside = [], False
+        for item in items:
+            if item['type'] == 'punctuation':
+                if inside:
+                    segment.append(dict(item, id=len(segment)))
+                continue
+            inside = start <= float(item['start_time']) and float(item['end_time']) <= end
+            if inside:
+                shift = rng.uniform(-jitter, jitter)
+                word = dict(item, id=len(segment))
+                word['start_time'] = f'{max(float(item["start_time"]) - start + shift, 0):.3f}'
+                word['end_time'] = f'{float(item["end_time"]) - start + shift:.3f}'
+                segment.append(word)
+        segments.append(segment)
+    return segments
+
+
+def _contents(items: list) -> list:
+    return [item['alternatives'][0]['content'] for item in items]
+
+
+def _write(items: list) -> dict:
+    """The transcript TranscriptFileWriter writes of the items."""
+    writer = TranscriptFileWriter('job')
+    try:
+        for item in items:
+            writer.add(item)
+        return json.loads(writer.finish().read())
+    finally:
+        writer.close()
+
+
+@pytest.mark.parametrize('segment, overlap, jitter', [
+    (60, 10, 0), (60, 10, 0.02), (30, 5, 0.05), (20, 4, 0.1), (45, 15, 0.1)
+])
+@pytest.mark.parametrize('seed', range(3))
+def test_merged_items_neither_drop_nor_repeat_words_at_the_cuts(segment, overlap, jitter, seed):
+    items = _recording(600, seed)
+    # Milliseconds, with a second of silence at the end.
+    total = int(max(float(item.get('end_time', 0)) for item in items) * 1000) + 1000
+    bounds = [(start / 1000, end / 1000) for start, end in segment_bounds(total, segment * 1000, overlap * 1000)]
+    assert len(bounds) > 2
+
+    merged = list(merge_segment_items(_transcribe_segments(items, bounds, jitter, seed), bounds))
+
+    assert _contents(merged) == _contents(items)
+    assert [item['id'] for item in merged] == list(range(len(merged)))
+    for got, expected in zip(merged, items):
+        if 'start_time' in expected:
+            assert abs(float(got['start_time']) - float(expected['start_time'])) <= jitter + 0.001
+            assert abs(float(got['end_time']) - float(expected['end_time'])) <= jitter + 0.001
+
+
+def test_repeated_word_across_the_cut_is_kept_once_per_utterance():
+    # "no no" spoken around the middle of the overlap [8, 12]: both segments hear both words.
+    items = [_word('yes', 1, 1.5), _word('no', 9.6, 9.9), _word('no', 10.1, 10.4), _word('bye', 15, 15.5)]
+    bounds = [(0, 12), (8, 20)]
+    earlier = [dict(_word('yes', 1, 1.5)), _word('no', 9.6, 9.9), _word('no', 10.1, 10.4)]
+    # The later segment times the first "no" a little later, across the middle of the first one.
+    later = [_word('no', 1.7, 2.0), _word('no', 2.1, 2.4), _word('bye', 7, 7.5)]
+
+    merged = list(merge_segment_items([earlier, later], bounds))
+
+    assert _contents(merged) == _contents(items)
+    assert [float(item['start_time']) for item in merged] == [1, 9.6, 10.1, 15]
+
+
+def test_punctuation_follows_the_word_it_belongs_to():
+    bounds = [(0, 12), (8, 20)]
+    # The word before the comma is cut (kept from the later segment), the earlier segment's comma goes with it.
+    earlier = [_word('hello', 1, 1.5), _word('there', 9.9, 10.3), _punctuation(',')]
+    later = [_word('there', 1.9, 2.3), _punctuation(','), _word('friend', 3, 3.5), _punctuation('.')]
+
+    merged = list(merge_segment_items([earlier, later], bounds))
+
+    assert _contents(merged) == ['hello', 'there', ',', 'friend', '.']
+    assert _write(merged)['results']['transcripts'] == [{'transcript': 'hello there, friend.'}]
+
+
+def test_segments_are_consumed_one_after_the_other():
+    bounds = [(0, 12), (8, 20)]
+    consumed = []
+
+    def segment(idx, items):
+        consumed.append(idx)
+        yield from items
+
+    segments = (segment(idx, items) for idx, items in enumerate([[_word('a', 1, 2)], [_word('b', 5, 6)]]))
+    merged = merge_segment_items(segments, bounds)
+
+    assert _contents([next(merged)]) == ['a'] and consumed == [0]
+    assert _contents(list(merged)) == ['b'] and consumed == [0, 1]
+
+
+def test_transcript_file_writer_writes_transcribe_format():
+    items = [_word('hello', 1, 1.5), _punctuation(','), _word('quote"back\\slash', 2, 3), _punctuation('.')]
+    items += _recording(50)
+
+    document = _write(items)
+
+    assert document['jobName'] == 'job'
+    assert document['status'] == 'COMPLETED'
+    assert document['results']['items'] == items
+    # Words are separated by a space, punctuation is attached to the word before it.
+    words = []
+    for content, item in zip(_contents(items), items):
+        if item['type'] == 'punctuation':
+            words[-1] += content
+        else:
+            words.append(content)
+    text = document['results']['transcripts'][0]['transcript']
+    assert text.startswith('hello, quote"back\\slash. ')
+    assert text.split(' ') == words
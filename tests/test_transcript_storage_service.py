@@ -0,0 +1,156 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import pytest
+
+from conftest import TABLE
+
+from local_backends import InMemoryDynamoDB
+from models.transcript import FileType, Transcript
+from services import transcript_storage_service
+from services.providers.client_provider import ClientProvider
+from services.transcript_storage_service import TranscriptStorageService
+
+
+class _ThrottledDynamoDB(InMemoryDynamoDB):
+    """Processes at most `processed` keys/items of every batch call, the rest come back unprocessed."""
+
+    def __init__(self, processed: int):
+        super().__init__({TABLE: 'request_id'})
+        self.processed = processed
+        self.batch_sizes = []
+
+    def batch_write_item(self, RequestItems: dict, **_) -> dict:
+        requests = RequestItems[TABLE]
+        self.batch_sizes.append(len(requests))
+        super().batch_write_item({TABLE: requests[:self.processed]})
+        return {'UnprocessedItems': {TABLE: requests[self.processed:]} if requests[self.processed:] else {}}
+
+    def batch_get_item(self, RequestItems: dict, **_) -> dict:
+        keys = RequestItems[TABLE]['Keys']
+        self.batch_sizes.append(len(keys))
+        response = super().batch_get_item({TABLE: {'Keys': keys[:self.processed]}})
+        response['UnprocessedKeys'] = {TABLE: {'Keys': keys[self.processed:]}} if keys[self.processed:] else {}
+        return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list:
+    """The backoff delays slept, instead of sleeping them."""
+    sleeps = []
+    monkeypatch.setattr(transcript_storage_service.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def _dynamodb(processed: int = 1000) -> _ThrottledDynamoDB:
+    """Installs the stand-in, the aws fixture resets the clients after the test."""
+    dynamodb = _ThrottledDynamoDB(processed)
+    ClientProvider.set_resource('dynamodb', dynamodb)
+    return dynamodb
+
+
+def _transcripts(count: int) -> list:
+    now = datetime.now(timezone.utc)
+    return [
+        Transcript(
+            request_id=uuid.uuid4(), audio_url=f'https://audio.example.com/{idx}.wav', created=now, updated=now,
+            file_type=FileType.WAV, sentences=[]
+        )
+        for idx in range(count)
+    ]
+
+
+def test_put_transcripts_writes_25_per_call(aws, sleeps):
+    dynamodb = _dynamodb()
+    transcripts = _transcripts(60)
+
+    TranscriptStorageService(TABLE).put_transcripts(transcripts + transcripts[:5])
+
+    assert dynamodb.batch_sizes == [25, 25, 10]
+    assert set(dynamodb.items(TABLE)) == {transcript.request_id.hex for transcript in transcripts}
+    assert sleeps == []
+
+
+def test_get_transcripts_reads_100_per_call(aws, sleeps):
+    dynamodb = _dynamodb()
+    transcripts = _transcripts(230)
+    TranscriptStorageService(TABLE).put_transcripts(transcripts)
+    dynamodb.batch_sizes.clear()
+    request_ids = [transcript.request_id.hex for transcript in transcripts]
+
+    found = TranscriptStorageService(TABLE).get_transcripts(request_ids + request_ids[:7] + [uuid.uuid4().hex])
+
+    assert dynamodb.batch_sizes == [100, 100, 31]
+    assert set(found) == set(request_ids)
+    assert found[request_ids[0]].audio_url == transcripts[0].audio_url
+    assert sleeps == []
+
+
+def test_unprocessed_items_are_retried_with_a_growing_backoff(aws, sleeps):
+    dynamodb = _dynamodb(processed=10)
+    transcripts = _transcripts(30)
+
+    TranscriptStorageService(TABLE, retry_base_delay=0.05).put_transcripts(transcripts)
+
+    # The first 25 are written 10 at a time, the last 5 at once.
+    assert dynamodb.batch_sizes == [25, 15, 5, 5]
+    assert len(dynamodb.items(TABLE)) == 30
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.1 and 0 <= sleeps[1] <= 0.2
+
+
+def test_unprocessed_keys_are_retried_with_a_growing_backoff(aws, sleeps):
+    dynamodb = _dynamodb()
+    transcripts = _transcripts(120)
+    TranscriptStorageService(TABLE).put_transcripts(transcripts)
+    dynamodb.processed, dynamodb.batch_sizes = 40, []
+
+    found = TranscriptStorageService(TABLE, retry_base_delay=0.05).get_transcripts(
+        transcript.request_id.hex for transcript in transcripts
+    )
+
+    assert dynamodb.batch_sizes == [100, 60, 20, 20]
+    assert len(found) == 120
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.1 and 0 <= sleeps[1] <= 0.2
+
+
+def test_a_batch_left_unprocessed_fails_after_max_batch_retries(aws, sleeps):
+    _dynamodb(processed=0)
+    transcripts = _transcripts(3)
+
+    with pytest.raises(Exception, match='unprocessed after 4 retries'):
+        TranscriptStorageService(TABLE, max_batch_retries=4).put_transcripts(transcripts)
+    assert len(sleeps) == 4
+    with pytest.raises(Exception, match='unprocessed after 4 retries'):
+        TranscriptStorageService(TABLE, max_batch_retries=4).get_transcripts(['a', 'b'])
+
+
+def test_next_analysis_version_counts_up_from_2(aws):
+    storage = TranscriptStorageService(TABLE)
+    parent, other = _transcripts(2)
+    storage.put_transcripts([parent, other])
+
+    assert [storage.next_analysis_version(parent.request_id.hex) for _ in range(3)] == [2, 3, 4]
+    assert storage.next_analysis_version(other.request_id.hex) == 2
+    assert aws.dynamodb.items(TABLE)[parent.request_id.hex]['latest_analysis_version'] == 4
+
+
+def test_concurrent_reanalyses_get_distinct_versions(aws):
+    storage = TranscriptStorageService(TABLE)
+    parent, = _transcripts(1)
+    storage.put_transcript(parent)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        versions = list(executor.map(lambda _: storage.next_analysis_version(parent.request_id.hex), range(40)))
+
+    assert sorted(versions) == list(range(2, 42))
+
+
+def test_next_analysis_version_of_an_unknown_request_raises(aws):
+    storage = TranscriptStorageService(TABLE)
+
+    with pytest.raises(storage.dynamo_client.table.meta.client.exceptions.ConditionalCheckFailedException):
+        storage.next_analysis_version(uuid.uuid4().hex)
+    assert aws.dynamodb.items(TABLE) == {}
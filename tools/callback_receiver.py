@@ -0,0 +1,84 @@
+"""Stand-in receiver for the completion callbacks, to try them out locally.
+
+Listens for POSTs, verifies their X-Signature with the callback_secret returned at submit time and prints the
+events. --fail-first N answers the first N callbacks with a 503, to see the sender's retries.
+
+Usage:
+    python tools/callback_receiver.py [--port 8080] [--secret <callback_secret>] [--fail-first 0]
+
+Point the callback_url of a request at it (e.g. through a tunnel). It only needs the standard library, so the
+verification below doubles as a reference for real receivers.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Same as services/notification_service.py
+SIGNATURE_HEADER = 'X-Signature'
+TIMESTAMP_HEADER = 'X-Signature-Timestamp'
+
+# Signatures older than this are refused, so a captured callback can't be replayed later.
+MAX_SIGNATURE_AGE = 300
+
+
+def sign_callback(secret: str, timestamp: str, body: bytes) -> str:
+    return hmac.new(secret.encode('utf-8'), timestamp.encode('utf-8') + b'.' + body, hashlib.sha256).hexdigest()
+
+
+def make_handler(secret: str, fail_first: int):
+    state = {'received': 0}
+
+    class CallbackHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            state['received'] += 1
+            if state['received'] <= fail_first:
+                print(f'#{state["received"]} answering 503 on purpose')
+                return self._answer(503)
+
+            if secret:
+                timestamp = self.headers.get(TIMESTAMP_HEADER, '')
+                expected = f'sha256={sign_callback(secret, timestamp, body)}'
+                if not hmac.compare_digest(expected, self.headers.get(SIGNATURE_HEADER, '')):
+                    print(f'#{state["received"]} bad signature')
+                    return self._answer(401)
+                if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > MAX_SIGNATURE_AGE:
+                    print(f'#{state["received"]} stale timestamp {timestamp!r}')
+                    return self._answer(401)
+
+            print(f'#{state["received"]} {json.dumps(json.loads(body), indent=2)}')
+            self._answer(204)
+
+        def _answer(self, status: int) -> None:
+            self.send_response(status)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return CallbackHandler
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--secret', help='The callback_secret of the request, signatures are not checked without it.')
+    parser.add_argument('--fail-first', type=int, default=0)
+    args = parser.parse_args()
+
+    server = HTTPServer(('127.0.0.1', args.port), make_handler(args.secret, args.fail_first))
+    print(f'Listening on http://127.0.0.1:{args.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
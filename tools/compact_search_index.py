@@ -0,0 +1,43 @@
+"""Compacts the search index: merges the segments every analysis leaves per shard into the shard's compacted file.
+
+The analyses compact the shards they write to once they have SEARCH_INDEX_COMPACT_SEGMENTS segments, this compacts
+them all right away (e.g. after a bulk re-analysis). Pass the table of the analyses' compaction leases
+(SEARCH_INDEX_LOCK_TABLE), the shards they are compacting are skipped.
+
+Usage:
+    python tools/compact_search_index.py --bucket <transcripts bucket> --lock-table <table> [--shards 64] [--shard N ...]
+
+Needs boto3 and credentials allowed to list, read, write and delete under search_index/ and to update the table.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'layers', 'common', 'python'))
+
+from analysis.inverted_index import DEFAULT_SHARD_COUNT  # noqa: E402
+from services.search_index_service import SearchIndexService  # noqa: E402
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--shards', type=int, default=DEFAULT_SHARD_COUNT, help='Must match SEARCH_INDEX_SHARDS.')
+    parser.add_argument('--shard', type=int, nargs='*', help='Only compact these shards.')
+    parser.add_argument('--lock-table', help='Must match SEARCH_INDEX_LOCK_TABLE, without it nothing else may compact.')
+    args = parser.parse_args()
+
+    service = SearchIndexService(args.bucket, shard_count=args.shards, lock_table=args.lock_table)
+    if args.shard:
+        merged = {shard: service.compact_shard(shard) for shard in args.shard}
+    else:
+        merged = service.compact()
+    for shard, count in sorted(merged.items()):
+        if count:
+            print(f'shard {shard:03d}: merged {count} segment(s)')
+    print(f'Merged {sum(merged.values())} segment(s) in {sum(1 for count in merged.values() if count)} shard(s)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""Aggregates the profiles of sampled invocations (see services/profiler.py) into a hot-spot report: the functions
+the time went to, summed over all the profiles, and the sites holding the most memory.
+
+Profiles are read from the bucket (profiles/<function>/<request_id>/<invocation>.prof|.json), or from a local copy
+of that tree (e.g. made with `aws s3 sync s3://<bucket>/profiles profiles`).
+
+Usage:
+    python tools/profile_report.py (--bucket <transcripts bucket> | --dir profiles) [--function process_audio]
+                                   [--request-id <request_id>] [--sort cumulative|tottime] [--limit 30]
+                                   [--allocations 20]
+
+Needs boto3 and credentials allowed to list and read under profiles/ when reading from the bucket.
+"""
+import argparse
+import gzip
+import json
+import marshal
+import os
+import pstats
+import sys
+from collections import defaultdict
+from typing import Iterator, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'layers', 'common', 'python'))
+
+from services.profiler import PROFILES_PREFIX  # noqa: E402
+
+
+class _LoadedProfile(object):
+    """What pstats.Stats accepts besides file names: an object with the stats of a profile."""
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+def iter_profile_files(args: argparse.Namespace) -> Iterator[Tuple[str, bytes]]:
+    """Yields the (path, content) of every profile file of the selected function and request."""
+    prefix = '/'.join(part for part in (args.function, args.request_id) if part)
+    if args.dir:
+        root = os.path.join(args.dir, prefix)
+        for directory, _, names in os.walk(root):
+            for name in sorted(names):
+                with open(os.path.join(directory, name), 'rb') as file:
+                    yield os.path.join(directory, name), file.read()
+        return
+
+    from services.s3_service import S3Service
+    s3_service = S3Service()
+    for key in s3_service.list_keys(args.bucket, f'{PROFILES_PREFIX}/{prefix}'):
+        yield key, s3_service.read_file(args.bucket, key)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--bucket')
+    source.add_argument('--dir', help='Local copy of the profiles/ tree.')
+    parser.add_argument('--function')
+    parser.add_argument('--request-id', help='Only the profiles of this request (needs --function).')
+    parser.add_argument('--sort', choices=('cumulative', 'tottime'), default='cumulative')
+    parser.add_argument('--limit', type=int, default=30, help='How many functions to list.')
+    parser.add_argument('--allocations', type=int, default=20, help='How many allocation sites to list.')
+    args = parser.parse_args()
+    if args.request_id and not args.function:
+        parser.error('--request-id needs --function')
+
+    stats = None
+    profiled_invocations = set()
+    # An invocation handling a batch is stored once per request, it's only counted once.
+    summaries = {}
+    request_ids = set()
+    for path, content in iter_profile_files(args):
+        invocation, extension = os.path.splitext(os.path.basename(path))
+        if extension == '.prof' and invocation not in profiled_invocations:
+            profiled_invocations.add(invocation)
+            profile = _LoadedProfile(marshal.loads(content))
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        elif extension == '.json':
+            # Stored gzipped, downloaded copies aren't decompressed.
+            summary = json.loads(gzip.decompress(content) if content[:2] == b'\x1f\x8b' else content)
+            summaries[invocation] = summary
+            request_ids.add(summary['request_id'])
+
+    if not summaries:
+        print('No profiles found.')
+        return 1
+
+    summaries = list(summaries.values())
+    durations = sorted(summary['duration_ms'] for summary in summaries)
+    errors = sum(1 for summary in summaries if summary.get('error'))
+    print(f'{len(summaries)} profiled invocation(s) of {len(request_ids)} request(s), {errors} failed')
+    print(f'duration ms: p50 {durations[len(durations) // 2]:.1f}, max {durations[-1]:.1f}; '
+          f'peak traced memory: max {max(summary["peak_traced_memory"] for summary in summaries) / 2 ** 20:.1f} MiB')
+
+    if stats is not None:
+        print(f'\nTop {args.limit} functions by {args.sort}, over all the profiles:')
+        stats.strip_dirs().sort_stats(args.sort).print_stats(args.limit)
+
+    # site -> [total size, total count, profiles it appears in]
+    sites = defaultdict(lambda: [0, 0, 0])
+    for summary in summaries:
+        for allocation in summary['allocations']:
+            site = sites[allocation['site']]
+            site[0] += allocation['size']
+            site[1] += allocation['count']
+            site[2] += 1
+    print(f'Top {args.allocations} sites holding memory at the end of the invocations:')
+    print(f'{"avg KiB":>10} {"avg blocks":>11} {"profiles":>9}  site')
+    for site, (size, count, seen) in sorted(sites.items(), key=lambda item: -item[1][0])[:args.allocations]:
+        print(f'{size / seen / 1024:>10.1f} {count / seen:>11.0f} {seen:>9}  {site}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())